@@ -1,39 +1,429 @@
 import random
-from typing import List, Dict, Any, Optional
+import time
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Optional, Iterable
+
+from fastapi.logger import logger
+
+from app.sharedState import SharedState, SlotsFull, INDEX
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_BALANCE_CONFIG = {
+    "policy": "round_robin",  # round_robin / smooth_wrr / least_in_flight / p2c
+    "ewma_alpha": 0.3,
+    "failure_threshold": 5,  # 连续失败多少次熔断，0 表示不熔断
+    "cooldown": 30,  # 熔断多少秒后放一个请求试探
+    "probe_timeout": 300,  # 试探请求超过多少秒还没有结束 (比如 worker 被杀掉) 就当作丢失，再放一个
+}
+
+
+class ProviderStats:
+    """一个渠道 (provider + 模型) 的运行状态，被所有使用这个渠道的 Balance 共享
+
+    记录首字耗时和输出速度的 EWMA、错误率、正在进行的请求数，以及熔断状态。
+    熔断打开 cooldown 秒后进入半开状态，只放一个请求试探，成功就恢复，失败继续熔断；
+    试探超过 probe_timeout 秒没有结束时再放一个。
+    """
+
+    def __init__(self, key: str, config: Dict):
+        self.key = key
+        self.alpha = config["ewma_alpha"]
+        self.failure_threshold = config["failure_threshold"]
+        self.cooldown = config["cooldown"]
+        self.probe_timeout = config["probe_timeout"]
+        self.ttft: Optional[float] = None  # 秒
+        self.tps: Optional[float] = None  # tokens/秒
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = 0.0  # 试探请求开始的时间，0 表示没有
+
+    def _ewma(self, old: Optional[float], value: float) -> float:
+        return value if old is None else old + self.alpha * (value - old)
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self.probing = 0.0
+        return self.state == HALF_OPEN and (not self.probing or now - self.probing >= self.probe_timeout)
+
+    def start(self):
+        self.in_flight += 1
+        self.requests += 1
+        if self.state == HALF_OPEN:
+            self.probing = time.monotonic()
+
+    def first_chunk(self, ttft: float):
+        self.ttft = self._ewma(self.ttft, ttft)
+
+    def finish(self, success: Optional[bool], tokens: int = 0, duration: float = 0.0):
+        """请求结束，success 为 None 表示客户端取消，不算渠道的好坏"""
+        self.in_flight = max(0, self.in_flight - 1)
+        if success is None:
+            self.probing = 0.0
+            return
+        if success:
+            self.error_rate = self._ewma(self.error_rate, 0.0)
+            if tokens and duration > 0:
+                self.tps = self._ewma(self.tps, tokens / duration)
+            self.failures = 0
+            self.state = CLOSED
+            self.probing = 0.0
+            return
+        self.error_rate = self._ewma(self.error_rate, 1.0)
+        self.errors += 1
+        self.failures += 1
+        self.probing = 0.0
+        if self.state == HALF_OPEN or (self.failure_threshold and self.failures >= self.failure_threshold):
+            if self.state != OPEN:
+                logger.warning(f"渠道 {self.key} 熔断 {self.cooldown} 秒，连续失败 {self.failures} 次")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def score(self) -> float:
+        """越小越好，还没有数据的渠道优先被试探"""
+        if self.ttft is None:
+            return 0.0
+        return self.ttft * (self.in_flight + 1) * (1 + 4 * self.error_rate)
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "state": self.state,
+            "ttft": round(self.ttft, 4) if self.ttft is not None else None,
+            "tps": round(self.tps, 2) if self.tps is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class SharedProviderStats(ProviderStats):
+    """多进程模式下的渠道状态，保存在 SharedState 里
+
+    每次读写都在共享锁里先载入最新的值，调用 ProviderStats 原来的逻辑，再写回，
+    所有 worker 看到同一个熔断状态、正在进行的请求数和 EWMA。
+    start/finish 同时记下这个 worker 自己的 in_flight 和试探，worker 中途退出时主进程用 release_worker 扣掉。
+    """
+
+    def __init__(self, key: str, config: Dict, shared: SharedState):
+        super().__init__(key, config)
+        self.shared = shared
+        self.shared_key = f"stats:{key}"
+
+    def _load(self, values):
+        ttft, tps = values[INDEX["ttft"]], values[INDEX["tps"]]
+        self.ttft = None if ttft != ttft else ttft  # NaN 表示还没有数据
+        self.tps = None if tps != tps else tps
+        self.error_rate = values[INDEX["error_rate"]]
+        self.in_flight = int(values[INDEX["in_flight"]])
+        self.requests = int(values[INDEX["requests"]])
+        self.errors = int(values[INDEX["errors"]])
+        self.state = STATES[int(values[INDEX["state"]])]
+        self.failures = int(values[INDEX["failures"]])
+        self.opened_at = values[INDEX["opened_at"]]
+        self.probing = values[INDEX["probing"]]
+
+    def _store(self, values):
+        values[INDEX["ttft"]] = float("nan") if self.ttft is None else self.ttft
+        values[INDEX["tps"]] = float("nan") if self.tps is None else self.tps
+        values[INDEX["error_rate"]] = self.error_rate
+        values[INDEX["in_flight"]] = self.in_flight
+        values[INDEX["requests"]] = self.requests
+        values[INDEX["errors"]] = self.errors
+        values[INDEX["state"]] = STATES.index(self.state)
+        values[INDEX["failures"]] = self.failures
+        values[INDEX["opened_at"]] = self.opened_at
+        values[INDEX["probing"]] = self.probing
+
+    def _sync(self, method, *args):
+        try:
+            with self.shared.transaction(self.shared_key) as values:
+                self._load(values)
+                result = method(self, *args)
+                self._store(values)
+        except SlotsFull:
+            return method(self, *args)  # 共享的槽用完了，只在这个进程里记录
+        return result
+
+    def available(self, now: float) -> bool:
+        return self._sync(ProviderStats.available, now)
+
+    def _sync_owned(self, method, *args):
+        try:
+            with self.shared.transaction(self.shared_key) as values, \
+                    self.shared.transaction(self.shared.owner_key(self.shared_key)) as owned:
+                self._load(values)
+                in_flight, probing = self.in_flight, self.probing
+                method(self, *args)
+                self._store(values)
+                owned[INDEX["in_flight"]] = max(0.0, owned[INDEX["in_flight"]] + self.in_flight - in_flight)
+                if self.probing != probing:
+                    owned[INDEX["probing"]] = self.probing
+        except SlotsFull:
+            method(self, *args)
+
+    def start(self):
+        self._sync_owned(ProviderStats.start)
+
+    def first_chunk(self, ttft: float):
+        self._sync(ProviderStats.first_chunk, ttft)
+
+    def finish(self, success: Optional[bool], tokens: int = 0, duration: float = 0.0):
+        self._sync_owned(ProviderStats.finish, success, tokens, duration)
+
+    def to_dict(self):
+        try:
+            self._load(self.shared.read(self.shared_key))
+        except SlotsFull:
+            pass
+        return super().to_dict()
+
 
 class Provider:
-    def __init__(self, data: Dict[str, Any]):
+    def __init__(self, data: Dict[str, Any], stats: Optional[ProviderStats] = None):
         self.data = data
+        self.key = provider_key(data)
+        self.weight = data.get('weight', 1)
+        self.stats = stats or ProviderStats(self.key, DEFAULT_BALANCE_CONFIG)
+        self.current_weight = 0  # smooth_wrr 使用
+
+
+def provider_key(data: Dict[str, Any]) -> str:
+    return f"{data.get('provider', '')}_{data.get('name', '')}:{data.get('original_model', '')}"
+
 
 class Balance:
-    def __init__(self, name: str, providers_data: List[Dict[str, Any]]):
+    def __init__(self, name: str, providers_data: List[Dict[str, Any]], policy: str = "round_robin",
+                 stats: Optional[Dict[str, ProviderStats]] = None, config: Optional[Dict] = None,
+                 shared: Optional[SharedState] = None):
         self.name = name
-        self.providers = {data['name']: Provider(data) for data in providers_data}
-        self.weights = {name: provider.data.get('weight', 1) for name, provider in self.providers.items()}
+        # 配置里的模型名，没有渠道时是兜底模型；请求里的模型名是任意的，共享的计数器按这个分
+        self.route = next((data["original_model"] for data in providers_data if data.get("original_model")), name)
+        self.source = providers_data
+        self.config = {**DEFAULT_BALANCE_CONFIG, **(config or {})}
+        self.shared = shared
+        stats = {} if stats is None else stats
+        providers = {}
+        for data in providers_data:
+            key = provider_key(data)
+            if key not in stats:
+                stats[key] = SharedProviderStats(key, self.config, shared) if shared else ProviderStats(key, self.config)
+            providers[data['name']] = Provider(data, stats[key])
+        self.providers = providers
+        self.weights = {name: provider.weight for name, provider in self.providers.items()}
         self.provider_names = list(self.providers.keys())
         self.current_index = -1
         self.current_weight = 0
-        
-        print(f"初始化的Balance名称: {self.name}")
-        print("初始化的提供者:", list(self.providers.keys()))
-        print("初始化的权重:", self.weights)
-
-    def next(self) -> Optional[Provider]:
-        while True:
-            if self.current_weight == 0:
-                for _ in range(len(self.provider_names)):
-                    self.current_index = (self.current_index + 1) % len(self.provider_names)
-                    current_name = self.provider_names[self.current_index]
-                    self.current_weight = self.weights[current_name]
-                    if self.current_weight > 0:
-                        break
-                else:
-                    return None
+        self.policy = policy
+        # 对冲请求用：这个模型最近的首字耗时，以及请求数、对冲数、对冲胜出数
+        self.ttft_samples = deque(maxlen=256)
+        self._ttft_percentile = None
+        self._ttft_dirty = 0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._select = {
+            "round_robin": self._round_robin,
+            "smooth_wrr": self._smooth_wrr,
+            "least_in_flight": self._least_in_flight,
+            "p2c": self._p2c,
+        }.get(policy)
+        if self._select is None:
+            logger.warning(f"未知的负载均衡策略 {policy}，使用 round_robin")
+            self.policy = "round_robin"
+            self._select = self._round_robin
+        if shared is not None and self.policy in ("round_robin", "smooth_wrr"):
+            # 多进程时每个 worker 各自轮询会打乱权重，改为所有 worker 共用一个计数器在固定的调度序列上取
+            self.sequence = self._build_sequence(self.policy)
+            self._select = self._shared_sequence
 
-            current_name = self.provider_names[self.current_index]
-            provider = self.providers[current_name]
+        logger.info(f"初始化的Balance名称: {self.name} 策略: {self.policy} 权重: {self.weights}")
+
+    def next(self, exclude: Optional[Iterable[str]] = None) -> Optional[Provider]:
+        """选择一个渠道，跳过 exclude 里的渠道 key 和熔断中的渠道
+
+        所有渠道都熔断时仍然按策略选一个，总比直接报错好。
+        """
+        exclude = exclude or ()
+        now = time.monotonic()
+        candidates = [p for p in self.providers.values() if p.weight > 0 and p.key not in exclude]
+        if not candidates:
+            return None
+        healthy = [p for p in candidates if p.stats.available(now)]
+        return self._select(healthy or candidates)
+
+    def _round_robin(self, candidates: List[Provider]) -> Provider:
+        """原来的加权轮询：同一个渠道连续使用 weight 次再换下一个"""
+        names = {p.data['name'] for p in candidates}
+        if self.current_weight > 0 and self.provider_names[self.current_index] in names:
             self.current_weight -= 1
-            return provider
+            return self.providers[self.provider_names[self.current_index]]
+        for _ in range(len(self.provider_names)):
+            self.current_index = (self.current_index + 1) % len(self.provider_names)
+            current_name = self.provider_names[self.current_index]
+            if current_name in names:
+                self.current_weight = self.weights[current_name] - 1
+                return self.providers[current_name]
+        return candidates[0]
+
+    @staticmethod
+    def _smooth_wrr(candidates: List[Provider]) -> Provider:
+        """nginx 的平滑加权轮询，权重大的渠道不会被连续选中"""
+        total = 0
+        best = None
+        for p in candidates:
+            p.current_weight += p.weight
+            total += p.weight
+            if best is None or p.current_weight > best.current_weight:
+                best = p
+        best.current_weight -= total
+        return best
+
+    @staticmethod
+    def _least_in_flight(candidates: List[Provider]) -> Provider:
+        return min(candidates, key=lambda p: (p.stats.in_flight / p.weight, random.random()))
+
+    @staticmethod
+    def _p2c(candidates: List[Provider]) -> Provider:
+        """随机按权重挑两个，选首字耗时和负载更低的那个"""
+        if len(candidates) == 1:
+            return candidates[0]
+        a, b = random.choices(candidates, weights=[p.weight for p in candidates], k=2)
+        if a is b:
+            b = random.choice([p for p in candidates if p is not a])
+        return a if a.stats.score() <= b.stats.score() else b
+
+    def _build_sequence(self, policy: str) -> List[str]:
+        """一个周期的调度顺序，round_robin 是每个渠道连续 weight 次，smooth_wrr 是 nginx 平滑加权轮询的结果"""
+        providers = [p for p in self.providers.values() if p.weight > 0]
+        if policy == "round_robin":
+            return [p.data['name'] for p in providers for _ in range(p.weight)]
+        current = {p.data['name']: 0 for p in providers}
+        total = sum(p.weight for p in providers)
+        sequence = []
+        for _ in range(total):
+            for p in providers:
+                current[p.data['name']] += p.weight
+            best = max(providers, key=lambda p: current[p.data['name']])
+            current[best.data['name']] -= total
+            sequence.append(best.data['name'])
+        return sequence
+
+    def _shared_sequence(self, candidates: List[Provider]) -> Provider:
+        """共享计数器对应的渠道不可用时，顺着调度序列往后找"""
+        names = {p.data['name'] for p in candidates}
+        sequence = self.sequence
+        if sequence:
+            try:
+                seq = int(self.shared.incr(f"balance:{self.policy}:{self.route}"))
+            except SlotsFull:
+                self.current_index += 1  # 共享的槽用完了，退回进程内的计数器
+                seq = self.current_index
+            for i in range(len(sequence)):
+                name = sequence[(seq + i) % len(sequence)]
+                if name in names:
+                    return self.providers[name]
+        return candidates[0]
+
+    def record_ttft(self, ttft: float):
+        self.ttft_samples.append(ttft)
+        self._ttft_dirty += 1
+
+    def ttft_percentile(self, percentile: float = 0.9, min_samples: int = 20) -> Optional[float]:
+        """最近首字耗时的分位数，样本不够时返回 None；每 16 个新样本才重新排序一次"""
+        if len(self.ttft_samples) < min_samples:
+            return None
+        if self._ttft_percentile is None or self._ttft_percentile[0] != percentile or self._ttft_dirty >= 16:
+            samples = sorted(self.ttft_samples)
+            index = min(len(samples) - 1, int(len(samples) * percentile))
+            self._ttft_percentile = (percentile, samples[index])
+            self._ttft_dirty = 0
+        return self._ttft_percentile[1]
+
+    def allow_hedge(self, max_ratio: float) -> bool:
+        """对冲请求数不超过总请求数的 max_ratio，限制额外的上游花费"""
+        return self.hedges < max_ratio * self.requests
+
+    def hedge_stats(self):
+        return {
+            "model": self.name,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_rate": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "win_rate": round(self.hedge_wins / self.hedges, 4) if self.hedges else 0.0,
+            "ttft_p90": self.ttft_percentile(0.9),
+        }
+
+    def stats(self):
+        return [p.stats.to_dict() for p in self.providers.values()]
+
+
+def hedge_primary(pending):
+    """对冲计时的主请求：还在等待的最近一次非对冲请求
+
+    换渠道重试后从新的请求重新计时，失败的请求已经用掉的时间不算，否则重试一发出去就会被对冲。
+    没有在等待的主请求时返回 None。
+    """
+    primary = None
+    for attempt in pending:
+        if not attempt.hedged and (primary is None or attempt.start_time > primary.start_time):
+            primary = attempt
+    return primary
+
+
+class BalanceManager:
+    """按模型共享 Balance，渠道状态按渠道共享
+
+    同一个模型不管是哪个 api_key 请求，都使用同一个 Balance，
+    权限已经在 get_user_provider 里检查过了。
+    模型名称来自请求 (没有渠道时会用兜底模型)，最多保留 max_size 个最近用过的 Balance，避免被随意的名称撑满内存。
+    """
+
+    def __init__(self, config: Optional[Dict] = None, shared: Optional[SharedState] = None, max_size: int = 10000):
+        self.config = {**DEFAULT_BALANCE_CONFIG, **(config or {})}
+        self.shared = shared  # 多进程模式下的共享状态，单进程为 None
+        self.max_size = max_size
+        self.balances: "OrderedDict[str, Balance]" = OrderedDict()
+        self.provider_stats: Dict[str, ProviderStats] = {}
+        self.attempts: Dict[int, int] = {}  # 第几次尝试成功: 次数
+
+    def get(self, model: str, providers_data: List[Dict[str, Any]]) -> Balance:
+        balance = self.balances.get(model)
+        if balance is None or balance.source is not providers_data:
+            balance = Balance(model, providers_data, self.config["policy"], self.provider_stats, self.config,
+                              self.shared)
+            self.balances[model] = balance
+            while len(self.balances) > self.max_size:
+                self.balances.popitem(last=False)
+        self.balances.move_to_end(model)
+        return balance
+
+    def record_attempt(self, attempt: int):
+        self.attempts[attempt] = self.attempts.get(attempt, 0) + 1
+
+    def stats(self):
+        return {
+            "policy": self.config["policy"],
+            "attempts": dict(sorted(self.attempts.items())),
+            "models": [balance.hedge_stats() for balance in self.balances.values()],
+            "providers": [s.to_dict() for s in self.provider_stats.values()],
+        }
+
 
 if __name__ == "__main__":
     providers_data = [
@@ -66,7 +456,7 @@ if __name__ == "__main__":
         }
     ]
     balance = Balance("MyBalance", providers_data)
-    balance2 = Balance("MyBalance2", providers_data)
+    balance2 = Balance("MyBalance2", providers_data, "smooth_wrr")
     print("开始选择提供者:")
     for i in range(9):
         provider = balance.next()
@@ -74,4 +464,3 @@ if __name__ == "__main__":
         provider = balance2.next()
         print(f"第 {i+1} 次选择: {provider.data['name']}")
     print("选择结束")
-
@@ -7,6 +7,102 @@ from patsy.user_util import balanced
 from app.Balance import Balance
 
 
+class _PrefixTrie:
+    """xxx* 通配符的前缀树，按模型名称逐字符查找，耗时只和模型名称长度有关"""
+    __slots__ = ("root",)
+
+    def __init__(self, prefixes):
+        self.root = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+    def match(self, model_name: str) -> bool:
+        node = self.root
+        if None in node:
+            return True
+        for char in model_name:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class _TokenRule:
+    """一个 token 允许使用的模型，精确名称用 set，通配符用前缀树"""
+    __slots__ = ("allow_all", "exact", "trie")
+
+    def __init__(self, models):
+        models = set(models or [])
+        self.allow_all = "all" in models
+        self.exact = frozenset(m for m in models if not m.endswith("*"))
+        self.trie = _PrefixTrie(m[:-1] for m in models if m.endswith("*"))
+
+    def allowed(self, model_name: str) -> bool:
+        return self.allow_all or model_name in self.exact or self.trie.match(model_name)
+
+
+class RoutingIndex:
+    """update_config 编译出来的只读路由索引
+
+    token 用 dict 查找，通配符用前缀树匹配，(token, 模型) 解析出来的渠道列表会缓存下来。
+    重新加载配置时整体替换成新的索引，缓存也就跟着一起失效，不会读到一半新一半旧的数据。
+    返回的渠道列表是共享的，调用方不要修改。
+    """
+
+    def __init__(self, tokensKV: Dict[str, Dict], providersKV: Dict[str, List[Dict]], server_default,
+                 max_cache_size: int = 10000):
+        self.providersKV = providersKV
+        self.server_default = server_default
+        self.has_all_token = "all" in tokensKV
+        self.rules: Dict[str, _TokenRule] = {
+            api_key: _TokenRule(token.get("model", [])) for api_key, token in tokensKV.items()
+        }
+        self.max_cache_size = max_cache_size
+        self.cache: Dict[Tuple[str, str], Tuple[List[Dict], str]] = {}
+
+    def verify_token(self, api_key: str) -> bool:
+        return self.has_all_token or api_key in self.rules
+
+    def resolve(self, api_key: str, model_name: str) -> Tuple[List[Dict], str]:
+        if self.has_all_token:
+            api_key = "all"
+        key = (api_key, model_name)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._resolve(api_key, model_name)
+            # 模型名称来自请求，限制缓存大小避免被随意的名称撑满内存
+            if len(self.cache) < self.max_cache_size:
+                self.cache[key] = result
+        return result
+
+    def _resolve(self, api_key: str, model_name: str) -> Tuple[List[Dict], str]:
+        rule = self.rules.get(api_key)
+        if rule is None:
+            return [], "没有授权"
+
+        if not rule.allowed(model_name):
+            return [], f"用户无权使用模型: {model_name}"
+
+        usability_model = self.providersKV.get(model_name, [])
+        if not usability_model:
+            if not self.server_default:
+                return [], f"模型:{model_name}没有可用渠道"
+            usability_model = self.providersKV.get(self.server_default, [])
+            if not usability_model:
+                return [], f"模型:{model_name}没有可用渠道,也没有设置兜底模型 server.default_model"
+            return usability_model, ""
+
+        if rule.allow_all:
+            return usability_model, ""
+        # providersKV 里渠道的 original_model 都等于 model_name，上面已经检查过权限，不需要再逐个过滤
+        return usability_model, "成功"
+
+
 class apiDB:
     def __init__(self, content: str):
         # 初始化数据结构
@@ -16,6 +112,7 @@ class apiDB:
         self.providersKV: Dict[str, List[Dict]] = {}  # 按原始模型名称存储提供者信息
         self.server_default: str = ""  # 服务器默认模型
         self.config_server: Dict = {}  # 服务器配置
+        self.routing = RoutingIndex({}, {}, "")  # 编译好的路由索引
 
         try:
             conf = yaml.safe_load(content)
@@ -83,15 +180,18 @@ class apiDB:
 
         self.config_server = config_data['server']
         self.server_default = self.config_server.get("default_model", False)
+        # 一次赋值替换整个索引，旧的解析缓存随之失效
+        self.routing = RoutingIndex(self.tokensKV, self.providersKV, self.server_default)
 
         # logger.info(json.dumps(config_data, indent=4, ensure_ascii=False))
 
     def verify_token(self, api_key: str) -> bool:
         """验证API密钥是否有效"""
-        if 'all' in self.tokens:
-            api_key = 'all'
+        return self.routing.verify_token(api_key)
 
-        return api_key in self.tokens
+    def get_token_config(self, api_key: str) -> Dict:
+        """api.yaml 中这个 token 的配置，比如 hedge 开关"""
+        return self.tokensKV.get(api_key) or self.tokensKV.get('all') or {}
 
     def get_all_provider(self):
         return self.providers
@@ -110,47 +210,11 @@ class apiDB:
 
     def get_user_provider(self, api_key: str, model_name: str) -> Tuple[List[Dict], str]:
         """获取用户可用的提供者列表"""
-        if 'all' in self.tokens:
-            api_key = 'all'
-
-        if api_key not in self.tokens:
-            return [], "没有授权"
-
-        user_use_model = set(self.tokensKV[api_key].get('model', []))
-
-        if "all" not in user_use_model and not any(is_model_allowed(um, model_name) for um in user_use_model):
-            return [], f"用户无权使用模型: {model_name}"
-
-        usability_model = self.providersKV.get(model_name, [])
-        if not usability_model:
-            if not self.server_default:
-                return [], f"模型:{model_name}没有可用渠道"
-            usability_model = self.providersKV.get(self.server_default, [])
-            if not usability_model:
-                return [], f"模型:{model_name}没有可用渠道,也没有设置兜底模型 server.default_model"
-            return usability_model, ""
-
-        if "all" in user_use_model:
-            return usability_model, ""
-
-        filtered_usability_model = []
-        for model in usability_model:
-            # 检查用户是否有权限使用该模型
-            for user_model in user_use_model:
-                if user_model.endswith('*'):
-                    # 如果用户模型以*结尾，检查原始模型名称是否以*之前的部分开头
-                    if model['original_model'].startswith(user_model[:-1]):
-                        filtered_usability_model.append(model)
-                        break
-                elif user_model == model['original_model']:
-                    filtered_usability_model.append(model)
-                    break
-
-        return filtered_usability_model, "成功"
+        return self.routing.resolve(api_key, model_name)
 
     def get_all_models(self, api_key):
         # 返回openai的models格式
-        if api_key not in self.tokens:
+        if api_key not in self.tokensKV:
             return []
 
         user_models = self.tokensKV[api_key].get('model', [])
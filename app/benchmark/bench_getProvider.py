@@ -0,0 +1,69 @@
+import copy
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.provider.chatManager import chatManager
+from app.provider.openai.openaiProvider import openaiProvider
+from app.provider.gemini.geminiProvider import geminiProvider
+from app.provider.vertexai.vertexaiClaudeProvider import vertexaiClaudeProvider
+from app.provider.vertexai.vertexaiGeminiProvider import vertexaiGeminiProvider
+from app.provider.cloudflare.CloudflareProvider import CloudflareProvider
+
+
+def build_manager():
+    manager = chatManager()
+    http_config = {"max_connections": 200, "timeout": {"connect": 10, "read": 300}}
+    providers = {
+        "openai_bench": openaiProvider("sk-bench", "https://api.openai.com/v1"),
+        "gemini_bench": geminiProvider("key-bench"),
+        "vertexai_claude_bench": vertexaiClaudeProvider("project", "client", "secret", "refresh"),
+        "vertexai_gemini_bench": vertexaiGeminiProvider("project", "client", "secret", "refresh"),
+        "cloudflare_bench": CloudflareProvider("key-bench", "account"),
+    }
+    for name, chat in providers.items():
+        chat.setHttpConfig(http_config)
+        manager.set_chat(name, chat)
+    return manager
+
+
+def old_get_provider(manager, name):
+    """原来的方式: 每个请求 deepcopy 一份 provider 再改开关"""
+    chat = copy.deepcopy(manager.chats[name])
+    chat._cache = False
+    chat._debug = False
+    chat._db_cache = False
+    return chat
+
+
+def new_get_provider(manager, name):
+    chat = manager.chat(name)
+    ctx = chat.new_context("0123456789abcdef", "gpt-4o")
+    ctx.cache = False
+    ctx.debug = False
+    ctx.db_cache = False
+    return chat, ctx
+
+
+def bench(fn, manager, name, number, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(manager, name)
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+
+def run(number=20000, repeat=5):
+    manager = build_manager()
+    print(f"{'provider':<28} {'旧 us':>10} {'新 us':>10} {'加速':>8}")
+    for name in manager.chats:
+        t_old = bench(old_get_provider, manager, name, number, repeat)
+        t_new = bench(new_get_provider, manager, name, number, repeat)
+        print(f"{name:<28} {t_old * 1e6:>10.2f} {t_new * 1e6:>10.2f} {t_old / t_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,76 @@
+"""所有 SSEHandler 的吞吐和内存基准，顺便维护 test/golden 里的 golden 文件
+
+python app/benchmark/bench_handlers.py                 跑基准
+python app/benchmark/bench_handlers.py --update-golden 修改了 handler 的输出格式后重新生成 golden 文件
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+import ujson as json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.benchmark.handlerFixtures import (golden_fixtures, golden_path, handler_classes, normalize,
+                                          recorded_fixtures, replay, synthetic_fixtures, GOLDEN_DIR)
+
+
+def chunk_count(fixture):
+    return len(fixture.payload) if fixture.mode == "sse" else 1
+
+
+def measure(fixture, handler_cls, repeat):
+    """返回 (最快一次的秒数, 每块新增的内存块数, 峰值内存字节)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        replay(fixture, handler_cls)
+        best = min(best, time.perf_counter() - start)
+
+    # 每块分配：一次回放前后存活的内存块差值，handler 和输出都留着，反映累加的开销
+    before = sys.getallocatedblocks()
+    kept = replay(fixture, handler_cls)
+    blocks = sys.getallocatedblocks() - before
+    del kept
+
+    tracemalloc.start()
+    replay(fixture, handler_cls)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, blocks / chunk_count(fixture), peak
+
+
+def run(repeat=5, tokens=20000):
+    classes = handler_classes()
+    fixtures = recorded_fixtures() + synthetic_fixtures(tokens)
+    print(f"{'数据':<48} {'块数':>7} {'块/秒':>11} {'MB/秒':>8} {'块分配/块':>9} {'峰值 KB':>9}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = []
+        for fixture in fixtures:
+            seconds, blocks, peak = measure(fixture, classes[fixture.handler], repeat)
+            rows.append((fixture, seconds, blocks, peak))
+    for fixture, seconds, blocks, peak in rows:
+        chunks = chunk_count(fixture)
+        print(f"{fixture.name[:48]:<48} {chunks:>7} {chunks / seconds:>11.0f} "
+              f"{fixture.size / seconds / 1e6:>8.2f} {blocks:>9.2f} {peak / 1024:>9.1f}")
+
+
+def update_golden():
+    classes = handler_classes()
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    for fixture in golden_fixtures():
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = normalize(*replay(fixture, classes[fixture.handler]))
+        with open(golden_path(fixture), "w", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False, indent=2))
+            f.write("\n")
+        print(f"写入 {golden_path(fixture)}")
+
+
+if __name__ == "__main__":
+    if "--update-golden" in sys.argv:
+        update_golden()
+    else:
+        run()
@@ -0,0 +1,64 @@
+import glob
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.provider.openaiSSEHandler import openaiSSEHandler
+from app.provider.sseFramer import SSEFramer, SSEBlockFramer
+
+PROVIDER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "provider")
+
+
+def load_events():
+    """读取录制的 openai 格式 sse 数据，每个事件作为上游的一个网络包"""
+    files = sorted(glob.glob(os.path.join(PROVIDER_DIR, "debugfile", "debugdata", "*openai*_sse.txt")))
+    events = []
+    for file_name in files:
+        with open(file_name, "r", encoding="utf-8") as f:
+            events.extend((line.strip() + "\n\n").encode("utf-8") for line in f if line.strip().startswith("data:"))
+    return events
+
+
+def parsed(events, stats=True):
+    """原来的流程: 切分解码 -> json.loads -> 重新编码"""
+    framer = SSEFramer()
+    handler = openaiSSEHandler("0123456789abcdef", "gpt-4o")
+    for chunk in events:
+        for event in framer.feed(chunk):
+            handler.handle_SSE_data_line(event.data)
+    return handler.get_stats() if stats else None
+
+
+def passthrough(events, stats=True):
+    framer = SSEBlockFramer()
+    handler = openaiSSEHandler("0123456789abcdef", "gpt-4o")
+    for chunk in events:
+        block = framer.feed(chunk)
+        if block:
+            handler.handle_SSE_raw(block)
+    return handler.get_stats() if stats else None
+
+
+def bench(fn, events, repeat, stats):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(events, stats)
+        best = min(best, time.perf_counter() - start)
+    return best / len(events)
+
+
+def run(repeat=20):
+    events = load_events() * 20
+    assert parsed(events)["full_message_content"] == passthrough(events)["full_message_content"]
+    print(f"事件数: {len(events)}")
+    print(f"{'每个事件':<16} {'旧 us':>10} {'新 us':>10} {'加速':>8}")
+    for name, stats in (("转发", False), ("转发+统计", True)):
+        t_old = bench(parsed, events, repeat, stats)
+        t_new = bench(passthrough, events, repeat, stats)
+        print(f"{name:<16} {t_old * 1e6:>10.3f} {t_new * 1e6:>10.3f} {t_old / t_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    run()
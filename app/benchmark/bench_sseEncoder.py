@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+
+import ujson as json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.provider.sseEncoder import SSEChunkEncoder
+
+TOKENS = ["你好", "，", " world", "\"quote\"", "\n", "The", " quick", " brown", " fox", "。"]
+
+
+def old_chunk(custom_id, model, text):
+    """原来的方式: 每块拼字典、time.time()、json.dumps，再在 baseProvider 和 main 里拼字符串"""
+    chunk = {
+        "id": f"chatcmpl-{custom_id}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "system_fingerprint": None,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {},
+                "logprobs": None,
+                "finish_reason": None
+            }
+        ]
+    }
+    chunk["choices"][0]["delta"] = {"content": text}
+    line = "data: " + f"{json.dumps(chunk)}"
+    return (line + "\n\n").encode("utf-8")  # Starlette 发送前的编码
+
+
+def new_chunk(encoder, text):
+    return encoder.content(text)
+
+
+def bench(number, repeat):
+    custom_id, model = "0123456789abcdef", "gpt-4o"
+    tokens = TOKENS * (number // len(TOKENS))
+    best_old = best_new = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in tokens:
+            old_chunk(custom_id, model, text)
+        best_old = min(best_old, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        encoder = SSEChunkEncoder(custom_id, model)  # 每个流编译一次
+        for text in tokens:
+            new_chunk(encoder, text)
+        best_new = min(best_new, time.perf_counter() - start)
+    return best_old / len(tokens), best_new / len(tokens)
+
+
+def run(number=200000, repeat=5):
+    t_old, t_new = bench(number, repeat)
+    print(f"{'每块耗时':<12} {'旧 us':>10} {'新 us':>10} {'加速':>8}")
+    print(f"{'content':<12} {t_old * 1e6:>10.3f} {t_new * 1e6:>10.3f} {t_old / t_new:>7.1f}x")
+    print(f"每秒可编码块数: 旧 {1 / t_old:,.0f}  新 {1 / t_new:,.0f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,93 @@
+import codecs
+import glob
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.provider.sseFramer import SSEFramer
+
+PROVIDER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "provider")
+
+
+def load_streams():
+    """读取录制的 sse 数据，还原为上游发送的格式 (每个事件以空行结尾)"""
+    files = sorted(glob.glob(os.path.join(PROVIDER_DIR, "debugfile", "debugdata", "*_sse.txt")))
+    streams = []
+    for file_name in files:
+        with open(file_name, "r", encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.strip().startswith("data:")]
+        if lines:
+            streams.append((os.path.basename(file_name), lines))
+    return streams
+
+
+def to_wire(lines, newline="\n"):
+    return "".join(line + newline + newline for line in lines).encode("utf-8")
+
+
+def chunked(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def old_splitter(chunks):
+    """原来 get_api_data 的切分方式: aiter_text() + buffer.split('\\n', 1)"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    out = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            line = line.strip()
+            if line.startswith('data:'):
+                out.append(line[5:].strip())
+    return out
+
+
+def new_framer(chunks):
+    framer = SSEFramer()
+    out = []
+    for chunk in chunks:
+        for event in framer.feed(chunk):
+            out.append(event.data)
+    for event in framer.flush():
+        out.append(event.data)
+    return out
+
+
+def bench(fn, chunks, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(chunk_sizes=(512, 16 * 1024, 256 * 1024), repeat=20, synthetic_copies=200):
+    streams = load_streams()
+    all_lines = [line for _, line_list in streams for line in line_list]
+    cases = [(name, lines) for name, lines in streams]
+    # 把所有录制数据拼接多次，模拟一个网络包里有大量事件的长输出
+    cases.append((f"synthetic x{synthetic_copies}", all_lines * synthetic_copies))
+
+    print(f"{'数据':<60} {'chunk':>8} {'事件数':>8} {'旧 ms':>10} {'新 ms':>10} {'加速':>8}")
+    for name, lines in cases:
+        for newline in ("\n", "\r\n"):
+            wire = to_wire(lines, newline)
+            for size in chunk_sizes:
+                chunks = chunked(wire, size)
+                old_out = old_splitter(chunks)
+                new_out = new_framer(chunks)
+                assert old_out == new_out, f"{name} 输出不一致"
+                rep = repeat if len(lines) < 10000 else max(1, repeat // 10)
+                t_old = bench(old_splitter, chunks, rep)
+                t_new = bench(new_framer, chunks, rep)
+                label = f"{name[:52]} {'CRLF' if newline == chr(13) + chr(10) else 'LF'}"
+                print(f"{label:<60} {size:>8} {len(new_out):>8} {t_old * 1000:>10.3f} {t_new * 1000:>10.3f} "
+                      f"{t_old / t_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,175 @@
+"""录制的上游数据和合成的大流，供 bench_handlers 和 test_handlerGolden 共用
+
+录制数据来自 provider/debugfile 下的 debugdata、savebody 和 provider/自留测试数据：
+以 data: 开头的按流式回放 handle_SSE_data_line，整个文件是 json 对象的按非流式回放 handle_data_line，
+json 数组格式的分块响应和请求体 (sendbody、自留测试数据 里的请求) 不是 handler 的输入，跳过。
+"""
+import glob
+import os
+import re
+
+import ujson as json
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROVIDER_DIR = os.path.join(APP_DIR, "provider")
+FIXTURE_DIRS = [
+    os.path.join(PROVIDER_DIR, "debugfile", "debugdata"),
+    os.path.join(PROVIDER_DIR, "debugfile", "savebody"),
+    os.path.join(PROVIDER_DIR, "自留测试数据"),
+]
+GOLDEN_DIR = os.path.join(APP_DIR, "test", "golden")
+CREATED = re.compile(r'"created":\s*\d+')
+
+
+def handler_classes():
+    from app.provider.openaiSSEHandler import openaiSSEHandler
+    from app.provider.gemini.geminiSSEHandler import geminiSSEHandler
+    from app.provider.vertexai.claudeSSEHandler import claudeSSEHandler
+    from app.provider.cohere.cohereProvider import cohereSSEHandler
+    from app.provider.merlin.merlinProvider import merlinSSEHandler
+    return {
+        "openai": openaiSSEHandler,
+        "gemini": geminiSSEHandler,
+        "claude": claudeSSEHandler,
+        "cohere": cohereSSEHandler,
+        "merlin": merlinSSEHandler,
+    }
+
+
+class Fixture:
+    def __init__(self, name, handler, mode, payload):
+        self.name = name
+        self.handler = handler  # handler_classes 里的名字
+        self.mode = mode  # sse / data
+        self.payload = payload  # sse: 行的列表  data: 整个响应文本
+
+    @property
+    def size(self):
+        if self.mode == "sse":
+            return sum(len(line.encode("utf-8")) for line in self.payload)
+        return len(self.payload.encode("utf-8"))
+
+
+def _handler_for(file_name):
+    name = file_name.lower()
+    if "claude" in name:
+        return "claude"
+    if "gemini" in name:
+        return "gemini"
+    return "openai"
+
+
+def recorded_fixtures():
+    fixtures = []
+    for directory in FIXTURE_DIRS:
+        for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            name = f"{os.path.basename(directory)}_{os.path.basename(path)[:-4]}"
+            lines = [line.strip() for line in text.splitlines() if line.strip()]
+            if lines and all(line.startswith(("data:", "event:")) for line in lines):
+                fixtures.append(Fixture(name, _handler_for(path), "sse", lines))
+                continue
+            try:
+                data = json.loads(text)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and "messages" not in data:
+                fixtures.append(Fixture(name, _handler_for(path), "data", text))
+    return fixtures
+
+
+def _openai_chunk(delta, finish_reason=None, usage=None):
+    chunk = {"id": "chatcmpl-synthetic", "object": "chat.completion.chunk", "created": 1, "model": "gpt-4o",
+             "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    if usage:
+        chunk["usage"] = usage
+    return "data: " + json.dumps(chunk, ensure_ascii=False)
+
+
+def synthetic_fixtures(tokens=2000):
+    """合成的长输出，token 内容固定，结果可以做成 golden 文件"""
+    words = ["你好", "，", "world", " \"quote\"", "\n", "def f(x):", " return", " x", "。", "😀"]
+    text = [words[i % len(words)] for i in range(tokens)]
+    arguments = ['{"code": "' if i == 0 else ("print(%d)\\n" % i) for i in range(tokens // 4)] + ['"}']
+
+    openai = [_openai_chunk({"role": "assistant", "content": ""})]
+    openai += [_openai_chunk({"content": t}) for t in text]
+    openai.append(_openai_chunk({"tool_calls": [
+        {"index": 0, "id": "call_0", "type": "function", "function": {"name": "run", "arguments": ""}}]}))
+    openai += [_openai_chunk({"tool_calls": [{"index": 0, "function": {"arguments": a}}]}) for a in arguments]
+    openai.append(_openai_chunk({}, "tool_calls",
+                                {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": tokens + 10}))
+    openai.append("data: [DONE]")
+
+    def claude_event(event):
+        return "data: " + json.dumps(event, ensure_ascii=False)
+
+    claude = [claude_event({"type": "message_start", "message": {"id": "msg_synthetic", "model": "claude",
+                                                                 "usage": {"input_tokens": 10}}}),
+              claude_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text"}})]
+    claude += [claude_event({"type": "content_block_delta", "index": 0,
+                             "delta": {"type": "text_delta", "text": t}}) for t in text]
+    claude.append(claude_event({"type": "content_block_start", "index": 1,
+                                "content_block": {"type": "tool_use", "id": "toolu_0", "name": "run", "input": {}}}))
+    claude += [claude_event({"type": "content_block_delta", "index": 1,
+                             "delta": {"type": "input_json_delta", "partial_json": a}}) for a in arguments]
+    claude.append(claude_event({"type": "message_delta", "delta": {"stop_reason": "tool_use"},
+                                "usage": {"output_tokens": tokens}}))
+    claude.append(claude_event({"type": "message_stop"}))
+
+    gemini = ["data: " + json.dumps({"candidates": [{"content": {"parts": [{"text": t}], "role": "model"}}],
+                                     "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": i,
+                                                       "totalTokenCount": 10 + i}}, ensure_ascii=False)
+              for i, t in enumerate(text)]
+    gemini.append("data: " + json.dumps({"candidates": [{"content": {"parts": []}, "finishReason": "STOP"}],
+                                         "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": tokens,
+                                                           "totalTokenCount": 10 + tokens}}))
+
+    merlin = ["data: " + json.dumps({"status": "success", "data": {"content": t}}, ensure_ascii=False)
+              for t in text]
+    merlin.append("data: " + json.dumps({"status": "system", "data": {"content": " ", "eventType": "DONE"}}))
+
+    return [
+        Fixture(f"synthetic_openai_{tokens}", "openai", "sse", openai),
+        Fixture(f"synthetic_claude_{tokens}", "claude", "sse", claude),
+        Fixture(f"synthetic_gemini_{tokens}", "gemini", "sse", gemini),
+        Fixture(f"synthetic_cohere_{tokens}", "cohere", "sse", text),
+        Fixture(f"synthetic_merlin_{tokens}", "merlin", "sse", merlin),
+    ]
+
+
+def replay(fixture, handler_cls, custom_id="golden", model="golden-model"):
+    """把数据喂给 handler，返回 (handler, 输出块的列表)"""
+    handler = handler_cls(custom_id, model)
+    out = []
+    if fixture.mode == "sse":
+        for line in fixture.payload:
+            chunk = handler.handle_SSE_data_line(line)
+            if chunk:
+                out.append(chunk)
+    else:
+        chunk = handler.handle_data_line(fixture.payload)
+        if chunk:
+            out.append(chunk)
+    return handler, out
+
+
+def normalize(handler, out):
+    """golden 文件的内容：输出块 (created 时间戳置 0) 和 get_stats"""
+    chunks = []
+    for chunk in out:
+        if isinstance(chunk, bytes):
+            chunks.append(CREATED.sub('"created":0', chunk.decode("utf-8")))
+        else:
+            chunks.append({**chunk, "created": 0})
+    return {"chunks": chunks, "stats": handler.get_stats()}
+
+
+def golden_path(fixture):
+    return os.path.join(GOLDEN_DIR, fixture.name + ".json")
+
+
+def golden_fixtures():
+    """golden 文件覆盖全部录制数据和小规模的合成数据"""
+    return recorded_fixtures() + synthetic_fixtures(tokens=40)
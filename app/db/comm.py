@@ -1,6 +1,13 @@
 import os
+import threading
 import pytz
 from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
 
 from app.api_data import db
 
@@ -32,4 +39,98 @@ def convert_to_local_time(db_time):
     """将数据库时间转换为本地时间"""
     if db_time.tzinfo is None:
         db_time = pytz.UTC.localize(db_time)
-    return db_time.astimezone(TIMEZONE)
\ No newline at end of file
+    return db_time.astimezone(TIMEZONE)
+
+
+# 所有数据库模块共用一个 engine 和 sessionmaker，每个新连接都会设置这些 pragma，可以在 server.db_pragmas 里覆盖
+DEFAULT_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",  # 只对新建的数据库生效，删除的空间可以由 payloadJob 在线回收
+    "journal_mode": "WAL",  # 写日志和后台查询互不阻塞
+    "synchronous": "NORMAL",  # WAL 下只在 checkpoint 时 fsync，断电最多丢最近的几个事务，不会损坏数据库
+    "cache_size": -65536,  # 负数单位是 KiB，每个连接 64MB 页缓存
+    "mmap_size": 268435456,  # 256MB 内存映射读
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,  # 毫秒，其他连接或者进程在写的时候等待而不是马上报 database is locked
+}
+
+_engine: Optional[Engine] = None
+_Session: Optional[sessionmaker] = None
+_synced_tables = set()
+_lock = threading.Lock()
+
+
+def create_db_engine(url: str, pragmas: Optional[Dict] = None, pool_size: int = 5, max_overflow: int = 10) -> Engine:
+    """创建 engine，sqlite 文件数据库使用连接池并且在每个连接上设置 pragmas"""
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+    pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+    memory = url in ("sqlite://", "sqlite:///:memory:")
+    options = {"connect_args": {"check_same_thread": False, "timeout": pragmas["busy_timeout"] / 1000}}
+    if not memory:
+        options.update(pool_size=pool_size, max_overflow=max_overflow)
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # 先设置 busy_timeout，后面的 pragma 遇到别的连接在写时也会等待
+        cursor.execute(f"PRAGMA busy_timeout={pragmas['busy_timeout']}")
+        new_database = cursor.execute("PRAGMA page_count").fetchone()[0] == 0
+        for name, value in pragmas.items():
+            if memory and name in ("journal_mode", "mmap_size"):
+                continue
+            if name == "auto_vacuum" and not new_database:
+                continue  # 已经有表的数据库设置了也不生效，还要拿写锁
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+def get_engine() -> Engine:
+    global _engine, _Session
+    with _lock:
+        if _engine is None:
+            _engine = create_db_engine(
+                DB_PATH,
+                db.config_server.get("db_pragmas"),
+                db.config_server.get("db_pool_size", 5),
+                db.config_server.get("db_max_overflow", 10),
+            )
+            _Session = sessionmaker(bind=_engine)
+    return _engine
+
+
+def get_session_factory() -> sessionmaker:
+    get_engine()
+    return _Session
+
+
+def sync_table_structure(metadata, engine: Optional[Engine] = None):
+    """建表和补充缺少的列，每个进程每张表只执行一次"""
+    engine = engine or get_engine()
+    with _lock:
+        tables = [(name, table) for name, table in metadata.tables.items() if (id(engine), name) not in _synced_tables]
+        if not tables:
+            return
+        inspector = inspect(engine)
+        with engine.connect() as connection:
+            for table_name, table in tables:
+                if not inspector.has_table(table_name):
+                    table.create(engine, checkfirst=True)
+                    print(f"创建表 {table_name}")
+                else:
+                    existing_column_names = {col['name'] for col in inspector.get_columns(table_name)}
+                    for column in table.columns:
+                        if column.name not in existing_column_names:
+                            column_type = column.type.compile(engine.dialect)
+                            try:
+                                connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}'))
+                                connection.commit()
+                                print(f"向表 {table_name} 添加列 {column.name}")
+                            except SQLAlchemyError as e:
+                                print(f"向表 {table_name} 添加列 {column.name} 时出错: {str(e)}")
+                                connection.rollback()
+                    for index in table.indexes:
+                        index.create(engine, checkfirst=True)
+                _synced_tables.add((id(engine), table_name))
@@ -1,6 +1,6 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, inspect, text
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, inspect, text, insert, or_
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.exc import OperationalError, SQLAlchemyError, IntegrityError
 import datetime
 import uuid
@@ -8,44 +8,23 @@ import hashlib
 from dataclasses import dataclass
 
 from app.db.reqCache import ReqCache
-from app.db.reqLogs import ReqLog
+from app.db.reqLogs import (ReqLog, ReqLogPayload, STAT_FIELDS, payload_row, load_payload, add_stats, stats_of_logs,
+                             change_stats, insert_logs, sync_search_index, index_logs)
 
-from app.db.comm import db, DB_PATH
+from app.db.comm import db, DB_PATH, get_current_time, get_engine, get_session_factory, sync_table_structure
 
 Base = declarative_base()
 
 
 class RequestLogger:
     def __init__(self):
-        self.engine = create_engine(DB_PATH)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = get_engine()
+        self.Session = get_session_factory()
         self.sync_table_structure()
 
     def sync_table_structure(self):
-        inspector = inspect(self.engine)
-
-        with self.engine.connect() as connection:
-            for table_name, table in Base.metadata.tables.items():
-                if not inspector.has_table(table_name):
-                    # 如果表不存在，创建它
-                    table.create(self.engine)
-                    print(f"创建表 {table_name}")
-                else:
-                    # 如果表存在，检查并添加缺失的列
-                    existing_columns = inspector.get_columns(table_name)
-                    existing_column_names = {col['name'] for col in existing_columns}
-
-                    for column in table.columns:
-                        if column.name not in existing_column_names:
-                            column_type = column.type.compile(self.engine.dialect)
-                            try:
-                                sql = text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}')
-                                connection.execute(sql)
-                                connection.commit()
-                                print(f"向表 {table_name} 添加列 {column.name}")
-                            except SQLAlchemyError as e:
-                                print(f"向表 {table_name} 添加列 {column.name} 时出错: {str(e)}")
-                                connection.rollback()
+        sync_table_structure(ReqLog.metadata, self.engine)
+        sync_search_index(self.engine)
 
     def _generate_md5(self, data):
         return hashlib.md5(data.encode('utf-8')).hexdigest()
@@ -64,12 +43,19 @@ class RequestLogger:
                 completion=completion,
                 quota=quota,
                 uri=uri,
-                request_data=request_data,
-                response_data=response_data,
+                request_data="",
+                response_data="",
                 status='completed',
                 md5=md5
             )
             session.add(new_log)
+            session.flush()
+            index_logs(session, new_log.id, new_log.id)
+            session.add(ReqLogPayload(**payload_row(new_log.id, new_log.time, request_data, response_data)))
+            add_stats(session, stats_of_logs([{
+                "time": new_log.time, "model": model, "token": token, "service_provider": service_provider,
+                "prompt": prompt, "completion": completion, "quota": quota,
+            }]))
             session.commit()
             return req_id
         except Exception as e:
@@ -78,18 +64,45 @@ class RequestLogger:
         finally:
             session.close()
 
+    def insert_req_logs(self, logs):
+        """一个事务批量写入完整的请求日志，由 RequestLogSink 在后台线程调用
+
+        请求和响应内容压缩后写入 req_log_payloads，req_logs 里只留空字符串。
+        """
+        rows = []
+        for log in logs:
+            row = dict(log)
+            row.setdefault("status", "completed")
+            row.setdefault("attempt", 1)
+            row["md5"] = self._generate_md5(row.get("request_data", ""))
+            rows.append(row)
+        with self.Session() as session:
+            try:
+                insert_logs(session, rows)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise e
+
     def update_req_log(self, req_id, prompt, completion, quota, response_data, api_status, api_error):
         session = self.Session()
         try:
             log = session.query(ReqLog).filter_by(req_id=req_id).first()
             if log:
+                old = {name: getattr(log, name) for name in STAT_FIELDS}
                 log.prompt = prompt
                 log.completion = completion
                 log.quota = quota
-                log.response_data = response_data
+                payload = session.get(ReqLogPayload, log.id)
+                if payload is None:
+                    log.response_data = response_data
+                else:
+                    request_data = load_payload(session, log.id)["request_data"]
+                    session.merge(ReqLogPayload(**payload_row(log.id, log.time, request_data, response_data)))
                 log.status = 'completed'
                 log.api_status = api_status
                 log.api_error = api_error
+                change_stats(session, old, {name: getattr(log, name) for name in STAT_FIELDS})
                 session.commit()
             else:
                 raise ValueError(f"未找到请求ID为 {req_id} 的日志")
@@ -112,14 +125,14 @@ class RequestLogger:
 
 class CacheManager:
     def __init__(self):
-        self.engine = create_engine(DB_PATH)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = get_engine()
+        self.Session = get_session_factory()
         self.sync_table_structure()
 
     def sync_table_structure(self):
-        Base.metadata.create_all(self.engine)
+        sync_table_structure(ReqCache.metadata, self.engine)
 
-    def add_to_cache(self, md5, req, resp):
+    def add_to_cache(self, md5, req, resp, expires_at=None):
         session = self.Session()
         try:
             existing_cache = session.query(ReqCache).filter_by(md5=md5).first()
@@ -128,9 +141,10 @@ class CacheManager:
                 existing_cache.req = req
                 existing_cache.resp = resp
                 existing_cache.hit_count = 0  # 重置命中次数
+                existing_cache.expires_at = expires_at
             else:
                 # 如果缓存不存在，创建新的缓存项
-                new_cache = ReqCache(md5=md5, req=req, resp=resp)
+                new_cache = ReqCache(md5=md5, req=req, resp=resp, expires_at=expires_at)
                 session.add(new_cache)
             session.commit()
             # print(f"缓存已{'更新' if existing_cache else '添加'}")
@@ -149,13 +163,51 @@ class CacheManager:
                 cache.hit_count += 1
                 session.commit()
                 return CacheData(md5=cache.md5, req=cache.req, resp=cache.resp, hit_count=cache.hit_count,
-                                 created_at=cache.created_at, updated_at=cache.updated_at)
+                                 created_at=cache.created_at, updated_at=cache.updated_at,
+                                 expires_at=cache.expires_at)
             return None
         except Exception as e:
             raise e
         finally:
             session.close()
 
+    def find_cache(self, md5, now=None):
+        """只读查询没有过期的缓存，命中次数由调用方批量写回"""
+        now = now or datetime.datetime.utcnow()
+        with self.Session() as session:
+            cache = session.query(ReqCache).filter(
+                ReqCache.md5 == md5,
+                or_(ReqCache.expires_at.is_(None), ReqCache.expires_at > now)
+            ).first()
+            if cache is None:
+                return None
+            return CacheData(md5=cache.md5, req=cache.req, resp=cache.resp, hit_count=cache.hit_count,
+                             created_at=cache.created_at, updated_at=cache.updated_at,
+                             expires_at=cache.expires_at)
+
+    def add_hit_counts(self, hits):
+        """批量累加命中次数 hits: {md5: 次数}"""
+        with self.Session() as session:
+            try:
+                for md5, count in hits.items():
+                    session.query(ReqCache).filter(ReqCache.md5 == md5).update(
+                        {ReqCache.hit_count: ReqCache.hit_count + count}, synchronize_session=False)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise e
+
+    def delete_expired(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        with self.Session() as session:
+            try:
+                count = session.query(ReqCache).filter(ReqCache.expires_at <= now).delete(synchronize_session=False)
+                session.commit()
+                return count
+            except Exception as e:
+                session.rollback()
+                raise e
+
     def update_cache_hit_count(self, md5):
         session = self.Session()
         try:
@@ -178,6 +230,7 @@ class CacheData:
     hit_count: int
     created_at: datetime.datetime
     updated_at: datetime.datetime
+    expires_at: datetime.datetime = None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from app.log import logger
+
+
+class RequestLogSink:
+    """请求日志异步批量写入
+
+    请求只把日志放进有界队列，后台任务按数量或时间凑成一批，在线程里用一个事务写入，
+    不会让事件循环等待 sqlite 的提交。队列快满时丢掉请求和响应内容只保留统计，
+    满了直接丢弃并计数，日志永远不会拖慢请求。
+    """
+
+    def __init__(self, request_logger, max_size: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 1.0, high_watermark: float = 0.8):
+        self.request_logger = request_logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.high_watermark = int(max_size * high_watermark)
+        self.queue: Optional[asyncio.Queue] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._closing = False
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"请求日志批量写入已启动 队列:{self.max_size} 批量:{self.batch_size} 间隔:{self.flush_interval}s")
+
+    def put(self, record: Dict) -> bool:
+        """放入一条日志，永远不会阻塞，返回 False 表示被丢弃"""
+        if self.queue is None:
+            self.dropped += 1
+            return False
+        size = self.queue.qsize()
+        if self.queue.full():
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"请求日志队列已满，已丢弃 {self.dropped} 条日志")
+            return False
+        if size >= self.high_watermark:
+            record["request_data"] = ""
+            record["response_data"] = ""
+            self.truncated += 1
+        self.queue.put_nowait(record)
+        self.enqueued += 1
+        if size + 1 >= self.batch_size:
+            self._full.set()
+        return True
+
+    async def _run(self):
+        queue = self.queue
+        while True:
+            if self._closing and queue.empty():
+                break
+            first = await queue.get()
+            if first is None:
+                break
+            if queue.qsize() + 1 < self.batch_size and not self._closing:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [first]
+            while len(batch) < self.batch_size and not queue.empty():
+                record = queue.get_nowait()
+                if record is not None:
+                    batch.append(record)
+            await self._write(batch)
+
+    async def _write(self, batch: List[Dict]):
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.request_logger.insert_req_logs, batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"批量写入请求日志失败 {len(batch)} 条: {e}")
+            return
+        cost = time.perf_counter() - start
+        if cost > 1:
+            logger.warning(f"批量写入 {len(batch)} 条请求日志耗时 {cost:.2f}s")
+
+    async def stop(self, timeout: float = 10):
+        """停止后台任务，把队列里剩下的日志写完"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._full.set()
+        if self.queue.empty():
+            self.queue.put_nowait(None)
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            logger.warning(f"请求日志写入超时，剩余 {self.queue.qsize()} 条未写入")
+            self._task = None
+            return
+        self._task = None
+        rest = []
+        while not self.queue.empty():
+            record = self.queue.get_nowait()
+            if record is not None:
+                rest.append(record)
+        if rest:
+            await self._write(rest)
+
+    def stats(self):
+        return {
+            "queue_size": self.queue.qsize() if self.queue else 0,
+            "queue_max_size": self.max_size,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
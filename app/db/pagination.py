@@ -0,0 +1,153 @@
+"""后台列表的分页：游标 (keyset) 分页和缓存的近似总数
+
+amis 的 crud 只会传 page 和 per_page，所以游标保存在服务端：每返回一页就记下这一页最后一行的排序键，
+翻到下一页时用 WHERE (排序列, id) < 上一页最后一行 代替 OFFSET，走索引直接定位，和翻到第几页无关。
+跳页时从最近的一个已知页往后 OFFSET，只跳过中间几页。
+
+总数不再每次 count：先用已经看到的行数估计，后台线程 count 后缓存 ttl 秒，过期后先返回旧值再后台刷新。
+缓存在进程内，多进程部署时每个 worker 各自一份。
+
+列表只查询摘要字段，大的文本字段在 SQL 里截成预览，完整内容由详情接口读取。
+"""
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy import func, tuple_
+
+CACHE_TTL = 30  # 秒
+MAX_KEYS = 256  # 最多缓存多少种查询条件
+PREVIEW_LENGTH = 200  # 列表里大文本字段的预览字符数
+
+
+class CountCache:
+    """列表总数的缓存，过期后先返回旧值，后台线程重新 count"""
+
+    def __init__(self, ttl: float = CACHE_TTL, background: bool = True):
+        self.ttl = ttl
+        self.background = background
+        self.values: "OrderedDict[Hashable, Tuple[int, float]]" = OrderedDict()
+        self.refreshing = set()
+        self.generation = 0  # clear 之后，之前开始的 count 结果作废
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, count: Callable[[], int]) -> Optional[int]:
+        """返回缓存的总数，还没有时返回 None；没有或者过期时后台执行 count"""
+        with self.lock:
+            cached = self.values.get(key)
+            if cached is not None and time.monotonic() - cached[1] < self.ttl:
+                return cached[0]
+            if key in self.refreshing:
+                return cached[0] if cached else None
+            self.refreshing.add(key)
+        if self.background:
+            threading.Thread(target=self.refresh, args=(key, count), daemon=True).start()
+            return cached[0] if cached else None
+        return self.refresh(key, count)
+
+    def refresh(self, key: Hashable, count: Callable[[], int]) -> Optional[int]:
+        generation = self.generation
+        try:
+            value = count()
+        except Exception as e:
+            print(f"统计总数时出错: {e}")
+            value = None
+        with self.lock:
+            self.refreshing.discard(key)
+            if value is not None and generation == self.generation:
+                self.values[key] = (value, time.monotonic())
+                self.values.move_to_end(key)
+                while len(self.values) > MAX_KEYS:
+                    self.values.popitem(last=False)
+        return value
+
+    def clear(self):
+        """修改或者删除数据后调用"""
+        with self.lock:
+            self.values.clear()
+            self.generation += 1
+
+
+class PageCursors:
+    """每种查询条件下每一页最后一行的排序键，ttl 秒内有效"""
+
+    def __init__(self, ttl: float = CACHE_TTL):
+        self.ttl = ttl
+        self.pages: "OrderedDict[Hashable, Dict[int, Tuple[tuple, float]]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def nearest(self, key: Hashable, page: int) -> Tuple[int, Optional[tuple]]:
+        """page 之前最近的一个已知页和它的游标，没有时返回 (0, None)"""
+        now = time.monotonic()
+        with self.lock:
+            pages = self.pages.get(key, {})
+            known = [p for p, (_, at) in pages.items() if p < page and now - at < self.ttl]
+            if not known:
+                return 0, None
+            best = max(known)
+            return best, pages[best][0]
+
+    def set(self, key: Hashable, page: int, cursor: tuple):
+        with self.lock:
+            self.pages.setdefault(key, {})[page] = (cursor, time.monotonic())
+            self.pages.move_to_end(key)
+            while len(self.pages) > MAX_KEYS:
+                self.pages.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+
+def keyset_page(query, keys, descending: bool, page: int, per_page: int, cursors: Optional[PageCursors],
+                cache_key: Hashable):
+    """按 keys 分页查询第 page 页，keys 是排序列，最后一个必须是唯一的 id
+
+    cursors 为 None 时只用 OFFSET (比如按截断成预览的字段排序，取不到完整的排序键)。
+    排序列可以为 NULL 时也只用 OFFSET：(排序列, id) < 游标 对 NULL 的行结果是 NULL，这些行会从后面的页里漏掉。
+    返回 (这一页的行, 后面是否还有)。
+    """
+    if any(getattr(getattr(key, "expression", key), "nullable", False) for key in keys):
+        cursors = None
+    known_page, cursor = cursors.nearest(cache_key, page) if cursors is not None else (0, None)
+    if cursor is not None:
+        target = keys[0] if len(keys) == 1 else tuple_(*keys)
+        value = cursor[0] if len(keys) == 1 else cursor
+        query = query.filter(target < value if descending else target > value)
+    skip = (page - known_page - 1) * per_page
+    query = query.order_by(*[key.desc() if descending else key for key in keys])
+    rows = query.offset(skip).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    if rows and cursors is not None:
+        cursors.set(cache_key, page, tuple(getattr(rows[-1], key.key) for key in keys))
+    return rows, has_next
+
+
+def approximate_total(counts: CountCache, cache_key: Hashable, count: Callable[[], int],
+                      page: int, per_page: int, rows: int, has_next: bool) -> int:
+    """缓存的总数，至少要能翻到已经看到的下一页"""
+    seen = (page - 1) * per_page + rows + (1 if has_next else 0)
+    return max(counts.get(cache_key, count) or 0, seen)
+
+
+def list_columns(model, previews=(), hidden=(), length: int = PREVIEW_LENGTH):
+    """列表查询的字段：previews 里的字段只取前 length 个字符，hidden 里的不查"""
+    columns = []
+    for column in model.__table__.columns:
+        if column.key in hidden:
+            continue
+        attr = getattr(model, column.key)
+        columns.append(func.substr(attr, 1, length).label(column.key) if column.key in previews else attr)
+    return columns
+
+
+def row_to_dict(row) -> dict:
+    result = {}
+    for key, value in row._mapping.items():
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        result[key] = value
+    return result
@@ -0,0 +1,106 @@
+"""请求日志里请求和响应内容的压缩
+
+安装了 zstandard 时用 zstd，否则用标准库的 gzip (zlib)。每条记录保存自己用的压缩方式，
+以后换了压缩方式旧数据也能读出来。很短的内容压缩不划算，直接保存原文。
+"""
+import codecs
+import zlib
+from typing import Iterator, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖
+    zstandard = None
+
+ZSTD = "zstd"
+GZIP = "gzip"
+RAW = ""
+
+MIN_COMPRESS_SIZE = 256  # 字节
+CHUNK_SIZE = 65536  # 流式解压每次输出的字节数
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+
+def default_codec() -> str:
+    return ZSTD if zstandard is not None else GZIP
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == ZSTD:
+        # ZstdCompressor 不能跨线程共用，每次新建，开销只有几微秒
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if codec == GZIP:
+        return zlib.compress(data, GZIP_LEVEL)
+    return data
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("这条日志用 zstd 压缩，需要安装 zstandard 才能读取")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == GZIP:
+        return zlib.decompress(data)
+    return data
+
+
+def encode(request_data: Optional[str], response_data: Optional[str],
+           codec: Optional[str] = None) -> Tuple[str, Optional[bytes], Optional[bytes], int]:
+    """压缩一条日志的请求和响应，返回 (压缩方式, 请求, 响应, 原始字节数)"""
+    request = (request_data or "").encode("utf-8")
+    response = (response_data or "").encode("utf-8")
+    size = len(request) + len(response)
+    codec = default_codec() if codec is None else codec
+    if size < MIN_COMPRESS_SIZE:
+        codec = RAW
+    return codec, _compress(request, codec), _compress(response, codec), size
+
+
+def decode(codec: str, data: Optional[bytes]) -> str:
+    if not data:
+        return ""
+    return _decompress(data, codec).decode("utf-8")
+
+
+def _iter_decompress(data: bytes, codec: str, chunk_size: int) -> Iterator[bytes]:
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("这条日志用 zstd 压缩，需要安装 zstandard 才能读取")
+        yield from zstandard.ZstdDecompressor().read_to_iter(data, write_size=chunk_size)
+    elif codec == GZIP:
+        decompressor = zlib.decompressobj()
+        pending = data
+        while pending:
+            # max_length 限制每次解压出来的大小，高压缩比的内容也不会一次展开
+            yield decompressor.decompress(pending, chunk_size)
+            pending = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    else:
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+
+def iter_decode(codec: str, data: Optional[bytes], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """边解压边输出，内存占用和内容大小无关"""
+    if not data:
+        return
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in _iter_decompress(data, codec, chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def decode_prefix(codec: str, data: Optional[bytes], limit: int) -> Tuple[str, bool]:
+    """只解压前 limit 个字符，返回 (内容, 是否被截断)"""
+    parts, length = [], 0
+    for text in iter_decode(codec, data):
+        parts.append(text)
+        length += len(text)
+        if length > limit:
+            return "".join(parts)[:limit], True
+    return "".join(parts), False
@@ -0,0 +1,191 @@
+"""请求日志内容的保留期限和在线压缩
+
+后台每隔 interval 秒执行一次，每一步都是小批量的短事务，不会长时间占用写锁:
+1. 把旧版本写在 req_logs 里的请求和响应内容压缩后搬到 req_log_payloads，清空 req_logs 里的原文
+2. 删除超过 retention_days 天的内容 (配置了 archive_dir 时先追加到 gzip 压缩的 jsonl 文件)，req_logs 的统计字段保留
+3. 数据库是 auto_vacuum=INCREMENTAL 时归还空闲页，再做一次 WAL checkpoint
+
+多进程部署时通过共享状态保证同一时间只有一个 worker 执行。
+
+也可以手动执行一次:
+    python app/db/payloadJob.py --retention-days 30
+旧数据库不是 INCREMENTAL 的，加 --full-vacuum 离线转换一次 (会锁住数据库直到完成)。
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import os
+import sys
+import time
+from typing import Dict, Optional
+
+import ujson as json
+from sqlalchemy import delete, select, text, update
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.db import payloadCodec
+from app.db.comm import get_current_time, get_engine, get_session_factory, sync_table_structure
+from app.db.reqLogs import ReqLog, ReqLogPayload, payload_row
+from app.log import logger
+from app.sharedState import INDEX
+
+
+class PayloadJob:
+    def __init__(self, retention_days: float = 0, archive_dir: str = "", interval: float = 3600,
+                 batch_size: int = 500, vacuum_pages: int = 2000, shared=None, engine=None, session_factory=None):
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.shared = shared
+        self.engine = engine or get_engine()
+        self.Session = session_factory or get_session_factory()
+        sync_table_structure(ReqLog.metadata, self.engine)
+        self._compacted_id = 0  # 这个 id 之前的旧日志已经搬完
+        self._task: Optional[asyncio.Task] = None
+        self.last_result: Dict = {}
+
+    def _cutoff(self, now: datetime.datetime) -> Optional[datetime.datetime]:
+        if not self.retention_days:
+            return None
+        return now - datetime.timedelta(days=self.retention_days)
+
+    def compact(self) -> int:
+        """把 req_logs 里的旧内容搬到 req_log_payloads"""
+        moved = 0
+        while True:
+            with self.Session() as session:
+                rows = session.execute(
+                    select(ReqLog.id, ReqLog.time, ReqLog.request_data, ReqLog.response_data)
+                    .where(ReqLog.id > self._compacted_id)
+                    .where((ReqLog.request_data != "") | ((ReqLog.response_data != "") & ReqLog.response_data.isnot(None)))
+                    .order_by(ReqLog.id)
+                    .limit(self.batch_size)
+                ).all()
+                if not rows:
+                    return moved
+                existing = set(session.scalars(
+                    select(ReqLogPayload.log_id).where(ReqLogPayload.log_id.in_([r.id for r in rows]))))
+                payloads = [payload_row(r.id, r.time, r.request_data, r.response_data) for r in rows
+                            if r.id not in existing]
+                if payloads:
+                    session.execute(ReqLogPayload.__table__.insert(), payloads)
+                session.execute(update(ReqLog).where(ReqLog.id.in_([r.id for r in rows]))
+                                .values(request_data="", response_data=""))
+                session.commit()
+                moved += len(payloads)
+                self._compacted_id = rows[-1].id
+
+    def purge(self, cutoff: datetime.datetime) -> int:
+        """删除 cutoff 之前的内容，req_logs 里的记录保留"""
+        purged = 0
+        while True:
+            with self.Session() as session:
+                rows = session.execute(
+                    select(ReqLogPayload).where(ReqLogPayload.time < cutoff)
+                    .order_by(ReqLogPayload.time).limit(self.batch_size)
+                ).scalars().all()
+                if not rows:
+                    return purged
+                if self.archive_dir:
+                    self._archive(rows)
+                session.execute(delete(ReqLogPayload).where(ReqLogPayload.log_id.in_([r.log_id for r in rows])))
+                session.commit()
+                purged += len(rows)
+
+    def _archive(self, rows):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"payloads-{datetime.date.today():%Y%m%d}.jsonl.gz")
+        # gzip 追加写入会生成多段压缩流，gzip.open 读取时会自动连起来
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({
+                    "log_id": row.log_id,
+                    "time": row.time.isoformat() if row.time else None,
+                    "request_data": payloadCodec.decode(row.codec, row.request_data),
+                    "response_data": payloadCodec.decode(row.codec, row.response_data),
+                }, ensure_ascii=False) + "\n")
+
+    def vacuum(self) -> int:
+        """归还空闲页，返回归还前的空闲页数；数据库不是 INCREMENTAL 时只做 checkpoint"""
+        if self.engine.dialect.name != "sqlite":
+            return 0
+        with self.engine.connect() as connection:
+            freelist = connection.execute(text("PRAGMA freelist_count")).scalar() or 0
+            incremental = connection.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+        if freelist and incremental:
+            # sqlite3 模块的 execute 只 step 一次，只会释放一页；executescript 会一直执行到结束
+            raw = self.engine.raw_connection()
+            try:
+                raw.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+            finally:
+                raw.close()
+        with self.engine.connect() as connection:
+            connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)")).fetchall()
+        return freelist
+
+    def full_vacuum(self):
+        """离线把旧数据库转换成 auto_vacuum=INCREMENTAL，会锁住整个数据库"""
+        with self.engine.connect() as connection:
+            connection.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+            connection.execute(text("VACUUM"))
+
+    def _claim(self, now: float) -> bool:
+        """多进程时只让一个 worker 在一个周期里执行"""
+        if self.shared is None:
+            return True
+        with self.shared.transaction("payload_job") as values:
+            if now - values[INDEX["counter"]] < self.interval * 0.9:
+                return False
+            values[INDEX["counter"]] = now
+        return True
+
+    def run_once(self, now: Optional[datetime.datetime] = None) -> Dict:
+        start = time.perf_counter()
+        # req_logs.time 保存的是不带时区的本地时间
+        cutoff = self._cutoff(now or get_current_time().replace(tzinfo=None))
+        result = {"compacted": self.compact()}
+        result["purged"] = self.purge(cutoff) if cutoff else 0
+        result["freelist_pages"] = self.vacuum()
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        self.last_result = result
+        return result
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if self._claim(time.time()):
+                try:
+                    result = await asyncio.to_thread(self.run_once)
+                    if result["compacted"] or result["purged"]:
+                        logger.info(f"整理请求日志内容 {result}")
+                except Exception as e:
+                    logger.error(f"整理请求日志内容失败: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="整理请求日志内容")
+    parser.add_argument("--retention-days", type=float, default=0, help="只保留最近多少天的内容，0 表示不删除")
+    parser.add_argument("--archive-dir", default="", help="删除前先追加到这个目录下的 jsonl.gz 文件")
+    parser.add_argument("--full-vacuum", action="store_true", help="离线转换成 auto_vacuum=INCREMENTAL 并回收全部空间")
+    args = parser.parse_args(argv)
+    job = PayloadJob(args.retention_days, args.archive_dir)
+    print(job.run_once())
+    if args.full_vacuum:
+        job.full_vacuum()
+        print("VACUUM 完成")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""从 req_logs 重新生成统计用的 req_stats 表
+
+升级到有 req_stats 的版本后执行一次，之后写日志时会自动累加。服务运行时也可以执行，汇总期间写日志会等待，日志很多时在低峰执行。
+    python app/db/rebuildStats.py
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.db.reqLogs import RequestLogger
+
+
+def main():
+    start = time.perf_counter()
+    max_id = RequestLogger().rebuild_stats()
+    print(f"已汇总 id <= {max_id} 的日志，耗时 {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
+import codecs
 import os
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, inspect, text, or_
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, inspect, text, or_, func, select
 from sqlalchemy.orm import declarative_base, sessionmaker, class_mapper
 from sqlalchemy.exc import OperationalError, SQLAlchemyError, IntegrityError
 import datetime
@@ -8,10 +9,60 @@ import uuid
 import hashlib
 from dataclasses import dataclass
 
-from app.db.comm import db, DB_PATH
+from app.db.comm import db, DB_PATH, get_engine, get_session_factory, sync_table_structure
+from app.db.pagination import CountCache, PageCursors, keyset_page, approximate_total, list_columns, row_to_dict
+from app.db.responseCache import invalidate_keys
 
 Base = declarative_base()
 
+PAYLOAD_FIELDS = ("req", "resp")
+CHUNK_SIZE = 65536  # 流式输出完整内容时每次读取的字节数
+
+
+class BlobChunks:
+    """逐段输出一个 sqlite blob 的 utf-8 内容
+
+    创建时已经占用了连接池里的一个连接，读完、出错或者调用 close() 时关闭 blob 并归还连接。
+    客户端中途断开时迭代不会继续，由调用方 close() (StreamingResponse 的 background)，还没开始读也能释放。
+    """
+
+    def __init__(self, raw, blob):
+        self.raw = raw
+        self.blob = blob
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.blob is None:
+            raise StopIteration
+        try:
+            while True:
+                chunk = self.blob.read(CHUNK_SIZE)
+                text = self.decoder.decode(chunk, final=not chunk)
+                if not chunk:
+                    self.close()
+                if text:
+                    return text
+                if not chunk:
+                    raise StopIteration
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        blob, self.blob = self.blob, None
+        if blob is None:
+            return
+        try:
+            blob.close()
+        finally:
+            self.raw.close()
+
+    def __del__(self):
+        self.close()
+
 
 class ReqCache(Base):
     __tablename__ = 'req_cache'
@@ -24,36 +75,18 @@ class ReqCache(Base):
     req = Column(Text, nullable=False, comment='请求数据')
     resp = Column(Text, nullable=False, comment='响应数据')
     hit_count = Column(Integer, nullable=False, default=0, comment='命中次数')
+    expires_at = Column(DateTime(timezone=True), nullable=True, index=True, comment='过期时间')
 
 class RequestCacheManager:
     def __init__(self):
-        self.engine = create_engine(DB_PATH)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = get_engine()
+        self.Session = get_session_factory()
         self.sync_table_structure()
 
     def sync_table_structure(self):
-        inspector = inspect(self.engine)
-
-        with self.engine.connect() as connection:
-            for table_name, table in Base.metadata.tables.items():
-                if not inspector.has_table(table_name):
-                    table.create(self.engine)
-                    print(f"创建表 {table_name}")
-                else:
-                    existing_columns = inspector.get_columns(table_name)
-                    existing_column_names = {col['name'] for col in existing_columns}
-
-                    for column in table.columns:
-                        if column.name not in existing_column_names:
-                            column_type = column.type.compile(self.engine.dialect)
-                            try:
-                                sql = text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}')
-                                connection.execute(sql)
-                                connection.commit()
-                                print(f"向表 {table_name} 添加列 {column.name}")
-                            except SQLAlchemyError as e:
-                                print(f"向表 {table_name} 添加列 {column.name} 时出错: {str(e)}")
-                                connection.rollback()
+        sync_table_structure(Base.metadata, self.engine)
+        self.counts = CountCache()
+        self.cursors = PageCursors()
 
     def to_dict(self, obj):
         if obj is None:
@@ -67,31 +100,43 @@ class RequestCacheManager:
         return result
 
     def index(self, keywords, per_page, page, order_by="id", order_dir="desc"):
+        """后台缓存列表，按 id 或者 (排序列, id) 游标分页，总数是缓存的近似值，请求内容只取预览"""
+        keywords = (keywords or "").strip()
         session = self.Session()
         try:
-            query = session.query(ReqCache)
+            # 列表只显示请求的预览，不查响应
+            query = session.query(*list_columns(ReqCache, ("req",), ("resp",)))
             if keywords:
-                query = query.filter(or_(
-                    ReqCache.md5.like(f"%{keywords}%"),
-                    ReqCache.req.like(f"%{keywords}%"),
-                    ReqCache.resp.like(f"%{keywords}%")
-                ))
-            
-            total = query.count()
-            
-            if order_dir.lower() == "desc":
-                query = query.order_by(getattr(ReqCache, order_by).desc())
-            else:
-                query = query.order_by(getattr(ReqCache, order_by))
-            
-            caches = query.offset((page - 1) * per_page).limit(per_page).all()
-            return [self.to_dict(cache) for cache in caches], total
+                query = query.filter(self.search_filter(keywords))
+            keys = (ReqCache.id,) if order_by == "id" else (getattr(ReqCache, order_by), ReqCache.id)
+            descending = order_dir.lower() == "desc"
+            cursors = None if order_by in PAYLOAD_FIELDS else self.cursors
+            caches, has_next = keyset_page(query, keys, descending, page, per_page, cursors,
+                                           (keywords, order_by, descending, per_page))
+            total = approximate_total(self.counts, keywords, lambda: self.count(keywords),
+                                      page, per_page, len(caches), has_next)
+            return [row_to_dict(cache) for cache in caches], total
         except SQLAlchemyError as e:
             print(f"查询缓存时出错: {str(e)}")
             return [], 0
         finally:
             session.close()
 
+    @staticmethod
+    def search_filter(keywords):
+        return or_(
+            ReqCache.md5.like(f"%{keywords}%"),
+            ReqCache.req.like(f"%{keywords}%"),
+            ReqCache.resp.like(f"%{keywords}%")
+        )
+
+    def count(self, keywords=""):
+        with self.Session() as session:
+            query = session.query(func.count(ReqCache.id))
+            if keywords:
+                query = query.filter(self.search_filter(keywords))
+            return query.scalar()
+
     def insert(self, cache_data):
         session = self.Session()
         try:
@@ -106,17 +151,50 @@ class RequestCacheManager:
         finally:
             session.close()
 
-    def find_one(self, cache_id):
+    def find_one(self, cache_id, limit=None):
+        """limit 不为空时 req 和 resp 最多返回 limit 个字符，被截断时 req_truncated / resp_truncated 为 True"""
         session = self.Session()
         try:
-            cache = session.query(ReqCache).filter(ReqCache.id == cache_id).first()
-            return self.to_dict(cache)
+            if limit is None:
+                cache = session.query(ReqCache).filter(ReqCache.id == cache_id).first()
+                return self.to_dict(cache)
+            row = session.query(*list_columns(ReqCache, PAYLOAD_FIELDS, length=limit + 1)).filter(
+                ReqCache.id == cache_id).first()
+            if row is None:
+                return None
+            data = row_to_dict(row)
+            for field in PAYLOAD_FIELDS:
+                value = data[field] or ""
+                data[field], data[f"{field}_truncated"] = value[:limit], len(value) > limit
+            return data
         except SQLAlchemyError as e:
             print(f"查找缓存时出错: {str(e)}")
             return None
         finally:
             session.close()
 
+    def open_payload(self, cache_id, field):
+        """返回逐段输出 req 或 resp 完整内容的迭代器，缓存不存在时返回 None
+
+        sqlite 用增量 blob 读取，每次只读 CHUNK_SIZE 字节，不会把整个字段读进内存。
+        """
+        if field not in PAYLOAD_FIELDS:
+            return None
+        with self.Session() as session:
+            if session.query(ReqCache.id).filter(ReqCache.id == cache_id).first() is None:
+                return None
+        raw = self.engine.raw_connection()
+        connection = getattr(raw, "driver_connection", None)
+        if not hasattr(connection, "blobopen"):  # 不是 sqlite 或者 Python 3.11 以前
+            raw.close()
+            return iter([(self.find_one(cache_id) or {}).get(field) or ""])
+        try:
+            blob = connection.blobopen(ReqCache.__tablename__, field, cache_id, readonly=True)
+        except Exception:
+            raw.close()
+            raise
+        return BlobChunks(raw, blob)
+
     def update(self, cache_data):
         session = self.Session()
         try:
@@ -124,8 +202,13 @@ class RequestCacheManager:
             if cache_id is None:
                 raise ValueError("更新缓存时需要提供id")
             
+            md5 = session.query(ReqCache.md5).filter(ReqCache.id == cache_id).scalar()
             session.query(ReqCache).filter(ReqCache.id == cache_id).update(cache_data)
             session.commit()
+            self.counts.clear()
+            self.cursors.clear()
+            # 改了 md5 时新旧两条都要作废
+            invalidate_keys([md5, cache_data.get("md5")])
             return True
         except SQLAlchemyError as e:
             session.rollback()
@@ -139,8 +222,12 @@ class RequestCacheManager:
         try:
             cache = session.query(ReqCache).filter(ReqCache.id == cache_id).first()
             if cache:
+                md5 = cache.md5
                 session.delete(cache)
                 session.commit()
+                self.counts.clear()
+                self.cursors.clear()
+                invalidate_keys([md5])
                 return True
             return False
         except SQLAlchemyError as e:
@@ -153,8 +240,12 @@ class RequestCacheManager:
     def bulk_delete(self, cache_ids):
         session = self.Session()
         try:
+            md5s = session.scalars(select(ReqCache.md5).where(ReqCache.id.in_(cache_ids))).all()
             session.query(ReqCache).filter(ReqCache.id.in_(cache_ids)).delete(synchronize_session=False)
             session.commit()
+            self.counts.clear()
+            self.cursors.clear()
+            invalidate_keys(md5s)
             return True
         except SQLAlchemyError as e:
             session.rollback()
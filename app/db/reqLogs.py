@@ -1,12 +1,15 @@
 import datetime
 import os
 import random
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, inspect, text, or_, func
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, LargeBinary, inspect, text, or_, func, case, cast, column, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker, class_mapper
 from sqlalchemy.exc import OperationalError, SQLAlchemyError, IntegrityError
 import uuid
 import hashlib
-from app.db.comm import db, DB_PATH, get_current_time, TIMEZONE
+from app.db.comm import db, DB_PATH, get_current_time, TIMEZONE, get_engine, get_session_factory, sync_table_structure
+from app.db import payloadCodec
+from app.db.pagination import CountCache, PageCursors, keyset_page, approximate_total, list_columns, row_to_dict
 
 Base = declarative_base()
 
@@ -15,7 +18,7 @@ class ReqLog(Base):
     __tablename__ = 'req_logs'
 
     id = Column(Integer, primary_key=True, autoincrement=True, comment='主键ID')
-    time = Column(DateTime(timezone=True), nullable=False, default=get_current_time, comment='请求时间')
+    time = Column(DateTime(timezone=True), nullable=False, default=get_current_time, index=True, comment='请求时间')
     req_id = Column(String(36), nullable=False, index=True, comment='请求ID')
     service_provider = Column(String(50), nullable=False, comment='服务提供商')
     token = Column(String(100), nullable=False, comment='用户令牌')
@@ -28,6 +31,7 @@ class ReqLog(Base):
     response_data = Column(Text, nullable=True, comment='响应数据')
     api_status = Column(String(10), nullable=True, comment='api状态码')
     api_error = Column(Text, nullable=True, comment='api错误信息')
+    attempt = Column(Integer, nullable=True, default=1, comment='第几次尝试成功')
     status = Column(String(20), nullable=False, default='pending', comment='请求态')
     created_at = Column(DateTime(timezone=True), nullable=False, default=datetime.datetime.utcnow, comment='创建时间')
     updated_at = Column(DateTime(timezone=True), nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow,
@@ -35,37 +39,232 @@ class ReqLog(Base):
     md5 = Column(String(32), nullable=False, index=True, comment='MD5哈希，于缓存')
 
 
+class ReqLogPayload(Base):
+    """请求和响应内容单独存放并压缩，req_logs 只保留用来筛选和统计的短字段
+
+    以前的日志内容还在 req_logs.request_data / response_data 里，由 payloadJob 慢慢搬过来。
+    """
+    __tablename__ = 'req_log_payloads'
+
+    log_id = Column(Integer, primary_key=True, autoincrement=False, comment='req_logs.id')
+    time = Column(DateTime(timezone=True), nullable=False, index=True, comment='请求时间，按天数清理时使用')
+    codec = Column(String(10), nullable=False, default='', comment='压缩方式 zstd / gzip，空表示没有压缩')
+    size = Column(Integer, nullable=False, default=0, comment='压缩前的字节数')
+    request_data = Column(LargeBinary, nullable=True, comment='请求数据')
+    response_data = Column(LargeBinary, nullable=True, comment='响应数据')
+
+
+def payload_row(log_id, time, request_data, response_data, codec=None):
+    codec, request, response, size = payloadCodec.encode(request_data, response_data, codec)
+    return {"log_id": log_id, "time": time, "codec": codec, "size": size,
+            "request_data": request, "response_data": response}
+
+
+class ReqStat(Base):
+    """按小时、模型、令牌、渠道汇总的用量，写日志时在同一个事务里增量累加，统计接口只读这张表
+
+    日期和小时是本地时间，和 req_logs.time 一致；修改日志时减掉旧值加上新值 (change_stats)，删除日志不会减少统计。
+    所有写 req_logs 的地方都要走 insert_logs / change_stats，否则用 rebuild_stats 重新汇总。
+    """
+    __tablename__ = 'req_stats'
+
+    day = Column(String(10), primary_key=True, comment='日期 YYYY-MM-DD')
+    hour = Column(Integer, primary_key=True, comment='小时 0-23')
+    model = Column(String(50), primary_key=True, comment='用户请求的模型')
+    token = Column(String(100), primary_key=True, comment='用户令牌')
+    service_provider = Column(String(50), primary_key=True, comment='服务提供商')
+    requests = Column(Integer, nullable=False, default=0, comment='请求数')
+    errors = Column(Integer, nullable=False, default=0, comment='api状态码不是200的请求数')
+    prompt = Column(Integer, nullable=False, default=0, comment='提示词token数')
+    completion = Column(Integer, nullable=False, default=0, comment='完成的内容token数')
+    quota = Column(Float, nullable=False, default=0.0, comment='消耗的配额')
+
+
+STAT_KEYS = ("day", "hour", "model", "token", "service_provider")
+STAT_VALUES = ("requests", "errors", "prompt", "completion", "quota")
+
+
+def add_stats(session, stats):
+    """把 [{day, hour, model, token, service_provider, requests, ...}] 累加到 req_stats"""
+    if not stats:
+        return
+    # executemany，不受 SQLite 单条语句变量数的限制
+    stmt = sqlite_insert(ReqStat)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(STAT_KEYS),
+        set_={name: getattr(ReqStat, name) + getattr(stmt.excluded, name) for name in STAT_VALUES},
+    )
+    session.execute(stmt, stats)
+
+
+def stats_of_logs(rows):
+    """按小时汇总一批日志"""
+    stats = {}
+    for row in rows:
+        time = row["time"]
+        if isinstance(time, str):
+            time = datetime.datetime.fromisoformat(time)
+        key = (time.strftime("%Y-%m-%d"), time.hour, row.get("model", ""), row.get("token", ""),
+               row.get("service_provider", ""))
+        item = stats.get(key)
+        if item is None:
+            item = stats[key] = dict(zip(STAT_KEYS, key), requests=0, errors=0, prompt=0, completion=0, quota=0.0)
+        item["requests"] += 1
+        item["errors"] += 0 if row.get("api_status") in (None, "", "200") else 1
+        item["prompt"] += row.get("prompt") or 0
+        item["completion"] += row.get("completion") or 0
+        item["quota"] += row.get("quota") or 0
+    return list(stats.values())
+
+
+STAT_FIELDS = ("time", "model", "token", "service_provider", "api_status", "prompt", "completion", "quota")
+
+
+def negative_stats(stats):
+    """修改日志时先减掉旧的统计"""
+    return [{**item, **{name: -item[name] for name in STAT_VALUES}} for item in stats]
+
+
+def change_stats(session, old, new):
+    """一条日志的统计字段从 old 改成 new，req_stats 里减掉旧值加上新值"""
+    if old == new:
+        return
+    removed = stats_of_logs([old])
+    add_stats(session, negative_stats(removed) + stats_of_logs([new]))
+    # 旧的那一小时没有请求了就删掉，统计里不留全是 0 的模型
+    key = {name: removed[0][name] for name in STAT_KEYS}
+    session.query(ReqStat).filter_by(**key).filter(ReqStat.requests <= 0).delete()
+
+
+def insert_logs(session, rows):
+    """在 session 的事务里写入一批日志，返回 id 列表
+
+    所有写 req_logs 的地方都走这里：请求和响应内容压缩后写入 req_log_payloads (req_logs 里只留空字符串)，
+    同时加入搜索索引、累加 req_stats。一批里每条日志的字段要相同。
+    """
+    payloads = []
+    for row in rows:
+        row.setdefault("time", get_current_time())
+        payloads.append((row["time"], row.get("request_data") or "", row.get("response_data") or ""))
+        row["request_data"] = row["response_data"] = ""
+    ids = session.scalars(insert(ReqLog).returning(ReqLog.id, sort_by_parameter_order=True), rows).all()
+    if not ids:
+        return ids
+    session.execute(insert(ReqLogPayload), [
+        payload_row(log_id, time, request_data, response_data)
+        for log_id, (time, request_data, response_data) in zip(ids, payloads)
+    ])
+    index_logs(session, ids[0], ids[-1])
+    add_stats(session, stats_of_logs(rows))
+    return ids
+
+
+def load_payload(session, log_id):
+    """读取并解压一条日志的内容，没有单独存放时返回 None"""
+    payload = session.get(ReqLogPayload, log_id)
+    if payload is None:
+        return None
+    try:
+        return {
+            "request_data": payloadCodec.decode(payload.codec, payload.request_data),
+            "response_data": payloadCodec.decode(payload.codec, payload.response_data),
+        }
+    except Exception as e:
+        return {"request_data": f"读取失败: {e}", "response_data": ""}
+
+
+SEARCH_COLUMNS = ("req_id", "service_provider", "token", "model", "uri", "status")
+MIN_SEARCH_LENGTH = 3  # trigram 分词按 3 个字符切分，更短的关键词用不上索引
+
+_search_indexed = set()
+
+PAYLOAD_FIELDS = ("request_data", "response_data")
+# 列表不查的字段和只取预览的字段
+LIST_HIDDEN = PAYLOAD_FIELDS
+LIST_PREVIEWS = ("api_error",)
+
+
+def sync_search_index(engine) -> bool:
+    """建立后台关键词搜索用的 FTS5 索引 req_logs_fts，每个进程每个数据库执行一次
+
+    外部内容表，只保存 trigram 索引不重复保存原文。新日志由写日志的事务调用 index_logs 整批加入，
+    比每行一次的 INSERT 触发器快 5 倍左右；修改和删除很少，用触发器同步。
+    第一次创建时用已有日志重建索引。sqlite 没有编译 FTS5 时返回 False，搜索退回 LIKE。
+    """
+    if engine.dialect.name != "sqlite":
+        return False
+    key = id(engine)
+    if key in _search_indexed:
+        return True
+    columns = ", ".join(SEARCH_COLUMNS)
+    new = ", ".join(f"new.{name}" for name in SEARCH_COLUMNS)
+    old = ", ".join(f"old.{name}" for name in SEARCH_COLUMNS)
+    try:
+        with engine.begin() as connection:
+            exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='req_logs_fts'")).first()
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS req_logs_fts USING fts5({columns}, "
+                f"content='req_logs', content_rowid='id', tokenize='trigram')"))
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS req_logs_fts_delete AFTER DELETE ON req_logs BEGIN "
+                f"INSERT INTO req_logs_fts(req_logs_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); END"))
+            # 只有搜索的列变化时才更新索引，写响应内容和搬运 payload 不受影响
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS req_logs_fts_update AFTER UPDATE OF {columns} ON req_logs BEGIN "
+                f"INSERT INTO req_logs_fts(req_logs_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+                f"INSERT INTO req_logs_fts(rowid, {columns}) VALUES (new.id, {new}); END"))
+            if not exists:
+                connection.execute(text("INSERT INTO req_logs_fts(req_logs_fts) VALUES ('rebuild')"))
+                print("创建搜索索引 req_logs_fts")
+    except OperationalError as e:
+        print(f"创建搜索索引失败，关键词搜索使用 LIKE: {e}")
+        return False
+    _search_indexed.add(key)
+    return True
+
+
+def index_logs(session, first_id, last_id):
+    """把同一个事务里刚写入的 [first_id, last_id] 日志加入搜索索引
+
+    sqlite 同一时间只有一个写事务，一个事务里插入的 id 是连续的。
+    """
+    if id(session.get_bind()) not in _search_indexed:
+        return
+    columns = ", ".join(SEARCH_COLUMNS)
+    session.execute(text(
+        f"INSERT INTO req_logs_fts(rowid, {columns}) SELECT id, {columns} FROM req_logs "
+        f"WHERE id BETWEEN :first_id AND :last_id"), {"first_id": first_id, "last_id": last_id})
+
+
+def search_filter(session, keywords, fts=True):
+    """后台日志关键词搜索的条件
+
+    完整的请求ID直接走 req_id 索引；其他关键词在 FTS5 索引里做子串匹配，和原来的 LIKE '%kw%' 结果一致；
+    少于 3 个字符或者没有 FTS5 时退回 LIKE。
+    """
+    keywords = keywords.strip()
+    if session.query(ReqLog.id).filter(ReqLog.req_id == keywords).first() is not None:
+        return ReqLog.req_id == keywords
+    if fts and len(keywords) >= MIN_SEARCH_LENGTH:
+        phrase = '"' + keywords.replace('"', '""') + '"'
+        return ReqLog.id.in_(
+            text("SELECT rowid FROM req_logs_fts WHERE req_logs_fts MATCH :phrase")
+            .bindparams(phrase=phrase).columns(column("rowid", Integer)))
+    return or_(*[getattr(ReqLog, name).like(f"%{keywords}%") for name in SEARCH_COLUMNS])
+
+
 class RequestLogger:
     def __init__(self):
-        self.engine = create_engine(DB_PATH)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = get_engine()
+        self.Session = get_session_factory()
         self.sync_table_structure()
 
     def sync_table_structure(self):
-        inspector = inspect(self.engine)
-
-        with self.engine.connect() as connection:
-            for table_name, table in Base.metadata.tables.items():
-                if not inspector.has_table(table_name):
-                    # 如果表不存在，创建它
-                    table.create(self.engine)
-                    print(f"创建 {table_name}")
-                else:
-                    # 如果表存在，检查并添加缺失的列
-                    existing_columns = inspector.get_columns(table_name)
-                    existing_column_names = {col['name'] for col in existing_columns}
-
-                    for column in table.columns:
-                        if column.name not in existing_column_names:
-                            column_type = column.type.compile(self.engine.dialect)
-                            try:
-                                sql = text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}')
-                                connection.execute(sql)
-                                connection.commit()
-                                print(f"向表 {table_name} 添加列 {column.name}")
-                            except SQLAlchemyError as e:
-                                print(f"向表 {table_name} 添加列 {column.name} 时出错: {str(e)}")
-                                connection.rollback()
+        sync_table_structure(Base.metadata, self.engine)
+        self.fts = sync_search_index(self.engine)
+        self.counts = CountCache()
+        self.cursors = PageCursors()
 
     def to_dict(self, obj):
         """将SQLAlchemy对象转换为字典"""
@@ -80,41 +279,45 @@ class RequestLogger:
         return result
 
     def index(self, keywords, per_page, page, order_by="id", order_dir="desc"):
+        """后台日志列表，按 id 或者 (排序列, id) 游标分页，总数是缓存的近似值
+
+        只查询摘要字段，请求和响应内容不查，api_error 只取预览。
+        """
+        keywords = (keywords or "").strip()
         session = self.Session()
         try:
-            query = session.query(ReqLog)
+            query = session.query(*list_columns(ReqLog, LIST_PREVIEWS, LIST_HIDDEN))
             if keywords:
-                query = query.filter(or_(
-                    ReqLog.req_id.like(f"%{keywords}%"),
-                    ReqLog.service_provider.like(f"%{keywords}%"),
-                    ReqLog.token.like(f"%{keywords}%"),
-                    ReqLog.model.like(f"%{keywords}%"),
-                    ReqLog.uri.like(f"%{keywords}%"),
-                    ReqLog.status.like(f"%{keywords}%")
-                ))
-
-            total = query.count()
-
-            if order_dir.lower() == "desc":
-                query = query.order_by(getattr(ReqLog, order_by).desc())
-            else:
-                query = query.order_by(getattr(ReqLog, order_by))
-
-            logs = query.offset((page - 1) * per_page).limit(per_page).all()
-            return [self.to_dict(log) for log in logs], total
+                query = query.filter(search_filter(session, keywords, self.fts))
+            keys = (ReqLog.id,) if order_by == "id" else (getattr(ReqLog, order_by), ReqLog.id)
+            descending = order_dir.lower() == "desc"
+            cursors = None if order_by in LIST_PREVIEWS + LIST_HIDDEN else self.cursors
+            logs, has_next = keyset_page(query, keys, descending, page, per_page, cursors,
+                                         (keywords, order_by, descending, per_page))
+            total = approximate_total(self.counts, keywords, lambda: self.count(keywords),
+                                      page, per_page, len(logs), has_next)
+            return [row_to_dict(log) for log in logs], total
         except SQLAlchemyError as e:
             print(f"查询日志时出错: {str(e)}")
             return [], 0
         finally:
             session.close()
 
+    def count(self, keywords=""):
+        with self.Session() as session:
+            query = session.query(func.count(ReqLog.id))
+            if keywords:
+                query = query.filter(search_filter(session, keywords, self.fts))
+            return query.scalar()
+
     def insert(self, log_data):
         session = self.Session()
         try:
-            new_log = ReqLog(**log_data)
-            session.add(new_log)
+            log_id = insert_logs(session, [dict(log_data)])[0]
             session.commit()
-            return new_log.id
+            self.counts.clear()
+            self.cursors.clear()
+            return log_id
         except SQLAlchemyError as e:
             session.rollback()
             print(f"插入日志时出错: {str(e)}")
@@ -122,17 +325,59 @@ class RequestLogger:
         finally:
             session.close()
 
-    def find_one(self, log_id):
+    def find_one(self, log_id, limit=None):
+        """一条日志的全部字段
+
+        limit 不为空时请求和响应内容最多返回 limit 个字符，只解压需要的部分；
+        被截断时 request_data_truncated / response_data_truncated 为 True，完整内容用 open_payload 读取。
+        """
         session = self.Session()
         try:
-            log = session.query(ReqLog).filter(ReqLog.id == log_id).first()
-            return self.to_dict(log)
+            if limit is None:
+                log = session.query(ReqLog).filter(ReqLog.id == log_id).first()
+                data = self.to_dict(log)
+                if data is not None:
+                    data.update(load_payload(session, log_id) or {})
+                return data
+            # 旧日志的内容还在 req_logs 里，多取一个字符判断是否截断
+            row = session.query(*list_columns(ReqLog, PAYLOAD_FIELDS, length=limit + 1)).filter(ReqLog.id == log_id).first()
+            if row is None:
+                return None
+            data = row_to_dict(row)
+            payload = session.get(ReqLogPayload, log_id)
+            for field in PAYLOAD_FIELDS:
+                if payload is not None:
+                    try:
+                        data[field], data[f"{field}_truncated"] = payloadCodec.decode_prefix(
+                            payload.codec, getattr(payload, field), limit)
+                    except Exception as e:
+                        data[field], data[f"{field}_truncated"] = f"读取失败: {e}", False
+                else:
+                    value = data[field] or ""
+                    data[field], data[f"{field}_truncated"] = value[:limit], len(value) > limit
+            return data
         except SQLAlchemyError as e:
             print(f"查找日志时出错: {str(e)}")
             return None
         finally:
             session.close()
 
+    def open_payload(self, log_id, field):
+        """返回逐段输出 request_data 或 response_data 完整内容的迭代器，日志不存在时返回 None
+
+        只在这里读出压缩后的内容，解压在迭代时边解压边输出，不占用数据库连接。
+        """
+        if field not in PAYLOAD_FIELDS:
+            return None
+        with self.Session() as session:
+            payload = session.get(ReqLogPayload, log_id)
+            if payload is not None:
+                return payloadCodec.iter_decode(payload.codec, getattr(payload, field))
+            value = session.query(getattr(ReqLog, field)).filter(ReqLog.id == log_id).first()
+            if value is None:
+                return None
+            return payloadCodec.iter_decode(payloadCodec.RAW, (value[0] or "").encode("utf-8"))
+
     def update(self, log_data):
         session = self.Session()
         try:
@@ -140,8 +385,33 @@ class RequestLogger:
             if log_id is None:
                 raise ValueError("更新日志时需要提供id")
 
-            session.query(ReqLog).filter(ReqLog.id == log_id).update(log_data)
+            if isinstance(log_data.get("time"), str):
+                log_data["time"] = datetime.datetime.fromisoformat(log_data["time"])
+            # 详情里被截断的内容不能写回去
+            contents = {}
+            for field in PAYLOAD_FIELDS:
+                truncated = log_data.pop(f"{field}_truncated", False)
+                if field in log_data:
+                    value = log_data.pop(field)
+                    if not truncated:
+                        contents[field] = value
+            log = session.get(ReqLog, log_id)
+            if log is None:
+                return False
+            old = {name: getattr(log, name) for name in STAT_FIELDS}
+            if log_data:
+                session.query(ReqLog).filter(ReqLog.id == log_id).update(log_data)
+            if contents:
+                payload = {"request_data": "", "response_data": "", **(load_payload(session, log_id) or {
+                    field: getattr(log, field) or "" for field in PAYLOAD_FIELDS})}
+                payload.update(contents)
+                session.merge(ReqLogPayload(**payload_row(log_id, log_data.get("time", old["time"]),
+                                                          payload["request_data"], payload["response_data"])))
+                session.query(ReqLog).filter(ReqLog.id == log_id).update({field: "" for field in PAYLOAD_FIELDS})
+            change_stats(session, old, {**old, **{name: log_data[name] for name in STAT_FIELDS if name in log_data}})
             session.commit()
+            self.counts.clear()
+            self.cursors.clear()
             return True
         except SQLAlchemyError as e:
             session.rollback()
@@ -156,7 +426,10 @@ class RequestLogger:
             log = session.query(ReqLog).filter(ReqLog.id == log_id).first()
             if log:
                 session.delete(log)
+                session.query(ReqLogPayload).filter(ReqLogPayload.log_id == log_id).delete(synchronize_session=False)
                 session.commit()
+                self.counts.clear()
+                self.cursors.clear()
                 return True
             return False
         except SQLAlchemyError as e:
@@ -170,7 +443,10 @@ class RequestLogger:
         session = self.Session()
         try:
             session.query(ReqLog).filter(ReqLog.id.in_(log_ids)).delete(synchronize_session=False)
+            session.query(ReqLogPayload).filter(ReqLogPayload.log_id.in_(log_ids)).delete(synchronize_session=False)
             session.commit()
+            self.counts.clear()
+            self.cursors.clear()
             return True
         except SQLAlchemyError as e:
             session.rollback()
@@ -183,10 +459,10 @@ class RequestLogger:
         session = self.Session()
         try:
             result = session.query(
-                ReqLog.model,
-                func.sum(ReqLog.prompt).label('total_prompt'),
-                func.sum(ReqLog.completion).label('total_completion')
-            ).group_by(ReqLog.model).all()
+                ReqStat.model,
+                func.sum(ReqStat.prompt).label('total_prompt'),
+                func.sum(ReqStat.completion).label('total_completion')
+            ).group_by(ReqStat.model).all()
 
             return [
                 {
@@ -211,19 +487,19 @@ class RequestLogger:
 
             print(f"查询时间范围: 从 {start_date} 到 {end_date}")
 
-            # 修改查询，使用between来查询时间范围
+            # 读按小时汇总的 req_stats，day 是主键的第一列，范围查询走索引
             result = session.query(
-                func.date(ReqLog.time).label('date'),
-                ReqLog.model,
-                func.sum(ReqLog.prompt).label('total_prompt'),
-                func.sum(ReqLog.completion).label('total_completion')
+                ReqStat.day.label('date'),
+                ReqStat.model,
+                func.sum(ReqStat.prompt).label('total_prompt'),
+                func.sum(ReqStat.completion).label('total_completion')
             ).filter(
-                func.date(ReqLog.time).between(start_date, end_date)
+                ReqStat.day.between(start_date.isoformat(), end_date.isoformat())
             ).group_by(
-                func.date(ReqLog.time),
-                ReqLog.model
+                ReqStat.day,
+                ReqStat.model
             ).order_by(
-                func.date(ReqLog.time)
+                ReqStat.day
             ).all()
 
             print(f"查询结果: {result}")
@@ -290,6 +566,36 @@ class RequestLogger:
         finally:
             session.close()
 
+    def rebuild_stats(self):
+        """从 req_logs 重新生成 req_stats，升级后第一次使用或者统计不对时执行，返回汇总时最大的日志 id
+
+        清空和重新汇总在同一个 BEGIN IMMEDIATE 事务里，用一条 INSERT ... SELECT 完成：
+        拿到写锁之后 insert_logs / change_stats 要等汇总提交，不会有日志在清空之后、汇总之前写入或者修改而少算、多算。
+        汇总期间写日志会等待 (最多 busy_timeout)，日志很多时在低峰执行。
+        """
+        with self.Session() as session:
+            if session.bind.dialect.name == "sqlite":
+                session.execute(text("BEGIN IMMEDIATE"))
+            max_id = session.query(func.max(ReqLog.id)).scalar() or 0
+            session.query(ReqStat).delete(synchronize_session=False)
+            rows = select(
+                func.substr(ReqLog.time, 1, 10),
+                cast(func.substr(ReqLog.time, 12, 2), Integer),
+                ReqLog.model,
+                ReqLog.token,
+                ReqLog.service_provider,
+                func.count(ReqLog.id),
+                func.sum(case((func.coalesce(ReqLog.api_status, '').in_(('', '200')), 0), else_=1)),
+                func.coalesce(func.sum(ReqLog.prompt), 0),
+                func.coalesce(func.sum(ReqLog.completion), 0),
+                func.coalesce(func.sum(ReqLog.quota), 0.0),
+            ).group_by(
+                func.substr(ReqLog.time, 1, 13), ReqLog.model, ReqLog.token, ReqLog.service_provider
+            )
+            session.execute(insert(ReqStat).from_select(list(STAT_KEYS + STAT_VALUES), rows))
+            session.commit()
+        return max_id
+
     def insert_random_test_data(self, num_entries=50):
         session = self.Session()
         try:
@@ -302,6 +608,7 @@ class RequestLogger:
             statuses = ['success', 'failed', 'pending']
 
             # 生成随机数据
+            rows = []
             for _ in range(num_entries):
                 random_date = start_date + datetime.timedelta(
                     seconds=random.randint(0, int((end_date - start_date).total_seconds()))
@@ -309,7 +616,7 @@ class RequestLogger:
                 random_model = random.choice(models)
                 random_status = random.choice(statuses)
 
-                new_log = ReqLog(
+                rows.append(dict(
                     time=random_date,
                     req_id=str(uuid.uuid4()),
                     service_provider='test_provider',
@@ -325,11 +632,12 @@ class RequestLogger:
                     api_error=None,
                     status=random_status,
                     md5=hashlib.md5(str(random.random()).encode()).hexdigest()
-                )
-
-                session.add(new_log)
+                ))
 
+            insert_logs(session, rows)
             session.commit()
+            self.counts.clear()
+            self.cursors.clear()
             print(f"成功插入 {num_entries} 条随机测试数据")
 
         except SQLAlchemyError as e:
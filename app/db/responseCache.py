@@ -0,0 +1,243 @@
+import asyncio
+import datetime
+import hashlib
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+import ujson as json
+
+from app.log import logger
+from app.sharedState import INDEX, get_shared_state
+
+VERSION_KEY = "response_cache_version"  # 共享状态里后台改动缓存的版本号
+
+# 这些字段不影响上游返回的内容，计算缓存 key 时忽略；stream_options.include_usage 会多一个 usage 数据块，不能忽略
+IGNORED_BODY_FIELDS = ("user", "metadata", "store", "service_tier")
+
+
+def canonical_cache_key(url: str, body, ignored_fields: Iterable[str] = IGNORED_BODY_FIELDS) -> str:
+    """计算与 key 顺序无关的缓存 key
+
+    url 只取 path，gemini 的 key 在 query 里不能参与计算；body 按 key 排序后序列化，
+    所以同一个请求无论字段顺序如何都会落到同一条缓存。
+    """
+    path = url.split("?", 1)[0]
+    if isinstance(body, dict):
+        body = {k: v for k, v in body.items() if k not in ignored_fields}
+    text = json.dumps(body, sort_keys=True, ensure_ascii=False, escape_forward_slashes=False)
+    return hashlib.md5(f"{path}\n{text}".encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("resp", "size", "expires_at")
+
+    def __init__(self, resp: str, size: int, expires_at: Optional[float]):
+        self.resp = resp
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """两级响应缓存：进程内按字节数限制的 LRU + sqlite 的 req_cache 表
+
+    内存命中不会访问数据库，命中次数先在内存里累加，由后台任务批量写回；
+    内存没有命中时在线程里查询 sqlite，查到后放进内存。写入也在线程里完成，
+    后台任务定时删除数据库里过期的缓存。
+    """
+
+    def __init__(self, cache_manager, ttl: float = 86400, memory_bytes: int = 64 * 1024 * 1024,
+                 max_entry_bytes: int = 1024 * 1024, evict_interval: float = 60, shared=None):
+        self.cache_manager = cache_manager
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.evict_interval = evict_interval
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.size = 0
+        self.pending_hits: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._writes = set()
+        # 多进程时其他 worker 在后台改动了缓存，版本号会变，内存里的全部作废
+        self.shared = get_shared_state() if shared is None else shared
+        self.version = self._shared_version()
+        _instances.add(self)
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl > 0 else None
+
+    def _remember(self, key: str, resp: str, expires_at: Optional[float]):
+        size = len(resp) if resp.isascii() else len(resp.encode("utf-8"))  # 按 utf-8 字节数计算占用
+        if size > self.max_entry_bytes or size > self.memory_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        self.entries[key] = _Entry(resp, size, expires_at)
+        self.size += size
+        while self.size > self.memory_bytes:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def _forget(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _hit(self, key: str):
+        self.pending_hits[key] = self.pending_hits.get(key, 0) + 1
+
+    def _shared_version(self) -> float:
+        return self.shared.read(VERSION_KEY)[INDEX["counter"]] if self.shared is not None else 0
+
+    def invalidate(self, key: str):
+        """后台修改或删除了这条缓存，从内存里删除，下次从数据库读取"""
+        self._forget(key)
+        self.pending_hits.pop(key, None)
+
+    def clear_memory(self):
+        self.entries.clear()
+        self.size = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None and self.shared is not None:
+            version = self._shared_version()
+            if version != self.version:
+                self.clear_memory()
+                self.version = version
+                entry = None
+        if entry is not None:
+            if entry.expires_at is not None and entry.expires_at <= time.time():
+                self._forget(key)
+                self.expired += 1
+            else:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                self._hit(key)
+                return entry.resp
+
+        try:
+            cache = await asyncio.to_thread(self.cache_manager.find_cache, key)
+        except Exception as e:
+            logger.error(f"查询缓存失败 {key}: {e}")
+            cache = None
+        if cache is None:
+            self.misses += 1
+            return None
+        expires_at = None
+        if cache.expires_at is not None:
+            expires_at = cache.expires_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self._remember(key, cache.resp, expires_at)
+        self.db_hits += 1
+        self._hit(key)
+        return cache.resp
+
+    def set(self, key: str, req: str, resp: str):
+        """保存完整的响应，数据库写入在后台线程里完成"""
+        expires_at = self._expires_at()
+        self._remember(key, resp, expires_at)
+        self.stores += 1
+        db_expires_at = None
+        if expires_at is not None:
+            db_expires_at = datetime.datetime.utcfromtimestamp(expires_at)
+        task = asyncio.create_task(self._save(key, req, resp, db_expires_at))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _save(self, key: str, req: str, resp: str, expires_at):
+        try:
+            await asyncio.to_thread(self.cache_manager.add_to_cache, key, req, resp, expires_at)
+        except Exception as e:
+            logger.error(f"缓存保存失败 {key}: {e}")
+
+    async def flush_hits(self):
+        if not self.pending_hits:
+            return
+        hits, self.pending_hits = self.pending_hits, {}
+        try:
+            await asyncio.to_thread(self.cache_manager.add_hit_counts, hits)
+        except Exception as e:
+            logger.error(f"缓存命中次数写入失败: {e}")
+
+    async def evict(self):
+        """删除内存和数据库里过期的缓存"""
+        now = time.time()
+        for key in [k for k, e in self.entries.items() if e.expires_at is not None and e.expires_at <= now]:
+            self._forget(key)
+            self.expired += 1
+        try:
+            count = await asyncio.to_thread(self.cache_manager.delete_expired)
+            if count:
+                logger.info(f"删除过期缓存 {count} 条")
+        except Exception as e:
+            logger.error(f"删除过期缓存失败: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            await self.flush_hits()
+            await self.evict()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"响应缓存已启动 内存:{self.memory_bytes // 1024 // 1024}MB 有效期:{self.ttl}s")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        await self.flush_hits()
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "entries": len(self.entries),
+            "memory_bytes": self.size,
+            "memory_limit": self.memory_bytes,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+
+_instances = weakref.WeakSet()
+
+
+def invalidate_keys(keys: Iterable[str]):
+    """后台修改或删除缓存后调用
+
+    本进程里的 ResponseCache 直接删除这几条；多进程时共享的版本号加一，
+    其他 worker 在下一次内存命中时发现版本变了，清空自己内存里的缓存。
+    """
+    keys = [key for key in keys if key]
+    for cache in list(_instances):
+        for key in keys:
+            cache.invalidate(key)
+    shared = get_shared_state()
+    if shared is None:
+        return
+    old = shared.incr(VERSION_KEY)
+    for cache in list(_instances):
+        # 本进程已经删过了；中间有其他 worker 改过时版本号对不上，下次命中时清空
+        if cache.shared is not None and cache.shared.path == shared.path and cache.version == old:
+            cache.version = old + 1
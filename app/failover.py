@@ -0,0 +1,192 @@
+"""还没有给客户端发送任何数据之前的上游尝试：出错换渠道重试、首字超时、对冲请求"""
+import asyncio
+import time
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.logger import logger
+
+from app import metrics
+from app.Balance import hedge_primary
+
+
+def first_chunk_timeout(start_time, deadline=0, attempt_timeout=0):
+    """本次尝试等待首个数据块的秒数，None 表示不限制，0 表示总时间已经用完"""
+    timeouts = []
+    if deadline:
+        timeouts.append(max(0.0, deadline - (time.perf_counter() - start_time)))
+    if attempt_timeout:
+        timeouts.append(attempt_timeout)
+    return min(timeouts) if timeouts else None
+
+
+class UpstreamAttempt:
+    """一次上游尝试：渠道、请求上下文，以及等待首个数据块的任务"""
+
+    def __init__(self, number, upstream, service_provider, send_body, ctx, genData, hedged=False):
+        self.number = number
+        self.upstream = upstream
+        self.service_provider = service_provider
+        self.send_body = send_body
+        self.ctx = ctx
+        self.genData = genData
+        self.hedged = hedged
+        self.error = None
+        self.start_time = time.perf_counter()
+        self.task = asyncio.ensure_future(genData.__anext__())
+
+    def fail(self, error):
+        self.error = error
+        self.upstream.stats.finish(False)
+        metrics.upstream_errors_total.inc(*self.ctx.labels, upstream_error_class(error))
+
+    async def cancel(self, error=None):
+        """取消请求并关闭上游连接，error 为 None 时 (对冲输掉、客户端断开) 不算渠道失败"""
+        self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+        await self.genData.aclose()
+        if error is None:
+            self.upstream.stats.finish(None)
+        else:
+            self.fail(error)
+
+
+def upstream_status_code(error):
+    """上游错误的状态码，不是 HTTPException 时返回 None"""
+    # chat2api_super 会把上游的 HTTPException 再包一层
+    while isinstance(error, HTTPException) and isinstance(error.detail, HTTPException):
+        error = error.detail
+    if not isinstance(error, HTTPException):
+        return None
+    if isinstance(error.detail, dict) and isinstance(error.detail.get("status_code"), int):
+        return error.detail["status_code"]
+    return error.status_code
+
+
+def is_retryable(error) -> bool:
+    """上游 5xx、429、网络错误和超时可以换渠道重试，其他错误 (比如 400) 换渠道也没用"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status_code = upstream_status_code(error)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+def upstream_error_class(error) -> str:
+    """监控指标里的错误分类: timeout / network / http_429 / http_5xx / http_4xx / other"""
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    while isinstance(error, HTTPException) and isinstance(error.detail, HTTPException):
+        error = error.detail
+    if isinstance(error, HTTPException) and isinstance(error.detail, dict) \
+            and error.detail.get("error") == "网络请求错误":
+        return "network"
+    return metrics.error_class(upstream_status_code(error))
+
+
+class Failover:
+    """等待第一个返回首个数据块的上游尝试
+
+    open_attempt(number, upstream, hedged) 发起请求并返回 UpstreamAttempt。
+    有尝试返回首个数据块之后 run() 就返回它，之后的错误已经发给了客户端，不再换渠道。
+    """
+
+    def __init__(self, balance, open_attempt: Callable[..., UpstreamAttempt], model_label: str,
+                 max_attempts: int = 3, deadline: float = 0, attempt_timeout: float = 0,
+                 hedge_delay: Optional[float] = None, hedge_ratio: float = 0.1):
+        self.balance = balance
+        self.open_attempt = open_attempt
+        self.model_label = model_label
+        self.max_attempts = max(1, int(max_attempts))
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        # 开启对冲时首个渠道超过这个时间还没有返回，就同时请求另一个渠道，每个请求最多对冲一次
+        self.hedge_delay = hedge_delay
+        self.hedge_ratio = hedge_ratio
+        self.start_time = time.perf_counter()
+        self.tried = set()
+        self.attempts = []
+        self.pending = []
+        self.error = None
+
+    def start(self, upstream, hedged=False):
+        attempt = self.open_attempt(len(self.attempts) + 1, upstream, hedged)
+        self.tried.add(upstream.key)
+        upstream.stats.start()
+        self.attempts.append(attempt)
+        self.pending.append(attempt)
+
+    def retry(self, failed):
+        time_left = first_chunk_timeout(self.start_time, self.deadline)
+        if not is_retryable(failed.error) or len(self.attempts) >= self.max_attempts or time_left == 0:
+            return
+        next_upstream = self.balance.next(exclude=self.tried)
+        if next_upstream is not None:
+            logger.warning(f"{failed.service_provider} 第{failed.number}次请求失败，切换到 {next_upstream.key}: {failed.error}")
+            metrics.failovers_total.inc(self.model_label)
+            self.start(next_upstream)
+
+    def hedge(self, primary):
+        self.hedge_delay = None
+        next_upstream = self.balance.next(exclude=self.tried) if self.balance.allow_hedge(self.hedge_ratio) else None
+        if next_upstream is not None:
+            self.balance.hedges += 1
+            metrics.hedges_total.inc(self.model_label)
+            logger.info(f"{primary.service_provider} 超过首字耗时分位数还没有返回，对冲请求 {next_upstream.key}")
+            self.start(next_upstream, hedged=True)
+
+    async def run(self, upstream) -> Optional[UpstreamAttempt]:
+        """返回胜出的尝试，全部失败或者超时返回 None，错误在 self.error"""
+        pending = self.pending
+        self.start(upstream)
+        winner = None
+        try:
+            while pending and winner is None:
+                now = time.perf_counter()
+                timeouts = [first_chunk_timeout(self.start_time, self.deadline)]
+                if self.attempt_timeout:
+                    timeouts += [a.start_time + self.attempt_timeout - now for a in pending]
+                primary = hedge_primary(pending) if self.hedge_delay is not None else None
+                if primary is not None:
+                    timeouts.append(primary.start_time + self.hedge_delay - now)
+                timeouts = [max(0.0, t) for t in timeouts if t is not None]
+                await asyncio.wait([a.task for a in pending], timeout=min(timeouts) if timeouts else None,
+                                   return_when=asyncio.FIRST_COMPLETED)
+
+                now = time.perf_counter()
+                for attempt in list(pending):
+                    if attempt.task.done():
+                        pending.remove(attempt)
+                        if attempt.task.exception() is None:
+                            if winner is None:
+                                winner = attempt
+                            else:
+                                await attempt.cancel()
+                            continue
+                        attempt.fail(attempt.task.exception())
+                    elif self.attempt_timeout and now - attempt.start_time >= self.attempt_timeout:
+                        pending.remove(attempt)
+                        await attempt.cancel(asyncio.TimeoutError())
+                    else:
+                        continue
+                    self.error = attempt.error
+                    if winner is None:
+                        self.retry(attempt)
+
+                if winner is None and first_chunk_timeout(self.start_time, self.deadline) == 0:
+                    self.error = asyncio.TimeoutError()
+                    for attempt in pending:
+                        await attempt.cancel(self.error)
+                    pending.clear()
+                    break
+                primary = hedge_primary(pending) if self.hedge_delay is not None else None
+                if winner is None and primary is not None and now - primary.start_time >= self.hedge_delay:
+                    self.hedge(primary)
+        finally:
+            # 输掉的请求直接取消，客户端断开时也不会留下还在进行的上游请求
+            for attempt in pending:
+                await attempt.cancel()
+            pending.clear()
+        return winner
@@ -0,0 +1,271 @@
+"""网关压测驱动
+
+闭环: 固定并发，每个 worker 收到完整响应后马上发下一个请求
+    python app/loadtest/driver.py --url http://127.0.0.1:8000 --mode closed --concurrency 50 --duration 30
+开环: 按泊松过程以固定速率发请求，不等前面的请求返回，能看到排队造成的延迟
+    python app/loadtest/driver.py --url http://127.0.0.1:8000 --mode open --rate 100 --duration 30
+
+--baseline http://127.0.0.1:9200/v1 先用同样的负载直接压 mock 的 OpenAI 接口，
+再用网关的分位数减去直连的分位数，得到网关增加的延迟。
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import ujson as json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.loadtest.genConfig import API_KEY
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+class Result:
+    __slots__ = ("model", "stream", "status", "error", "start", "ttft", "latency", "tokens")
+
+    def __init__(self, model: str, stream: bool):
+        self.model = model
+        self.stream = stream
+        self.status = 0
+        self.error: Optional[str] = None
+        self.start = time.perf_counter()
+        self.ttft: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.tokens = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class Workload:
+    def __init__(self, url: str, api_key: str = API_KEY, models: List[str] = None, stream_ratio: float = 1.0,
+                 prompt: str = "你好", max_tokens: int = 0):
+        self.url = url.rstrip("/") + "/chat/completions"
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.models = models or ["mock-openai"]
+        self.stream_ratio = stream_ratio
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self._next = 0
+
+    def next_request(self):
+        model = self.models[self._next % len(self.models)]
+        self._next += 1
+        stream = random.random() < self.stream_ratio
+        body = {"model": model, "stream": stream, "messages": [{"role": "user", "content": self.prompt}]}
+        if stream:
+            body["stream_options"] = {"include_usage": True}
+        if self.max_tokens:
+            body["max_tokens"] = self.max_tokens
+        return model, stream, body
+
+    async def send(self, client: httpx.AsyncClient) -> Result:
+        model, stream, body = self.next_request()
+        result = Result(model, stream)
+        try:
+            if stream:
+                await self._stream(client, body, result)
+            else:
+                response = await client.post(self.url, headers=self.headers, json=body)
+                result.status = response.status_code
+                result.ttft = time.perf_counter() - result.start
+                if response.status_code != 200:
+                    result.error = f"HTTP {response.status_code}"
+                else:
+                    usage = response.json().get("usage") or {}
+                    result.tokens = usage.get("completion_tokens", 0)
+        except httpx.HTTPError as e:
+            result.error = type(e).__name__
+        result.latency = time.perf_counter() - result.start
+        return result
+
+    async def _stream(self, client: httpx.AsyncClient, body: Dict, result: Result):
+        async with client.stream("POST", self.url, headers=self.headers, json=body) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                result.error = f"HTTP {response.status_code}"
+                return
+            chunks = 0
+            usage = None
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("error"):
+                    result.error = "stream error"
+                    return
+                for choice in chunk.get("choices") or []:
+                    if (choice.get("delta") or {}).get("content"):
+                        if result.ttft is None:
+                            result.ttft = time.perf_counter() - result.start
+                        chunks += 1
+                usage = chunk.get("usage") or usage
+            if result.ttft is None:
+                result.error = "empty stream"
+            result.tokens = (usage or {}).get("completion_tokens") or chunks
+
+
+async def closed_loop(workload: Workload, client: httpx.AsyncClient, concurrency: int,
+                      duration: float = 0, requests: int = 0) -> List[Result]:
+    """固定并发，duration 秒或者发满 requests 个请求后停止"""
+    results = []
+    deadline = time.perf_counter() + duration if duration else None
+    sent = 0
+
+    async def worker():
+        nonlocal sent
+        while (deadline is None or time.perf_counter() < deadline) and (not requests or sent < requests):
+            sent += 1
+            results.append(await workload.send(client))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+
+async def open_loop(workload: Workload, client: httpx.AsyncClient, rate: float, duration: float) -> List[Result]:
+    """按泊松到达以每秒 rate 个请求发送 duration 秒，然后等待所有请求结束"""
+    tasks = []
+    start = time.perf_counter()
+    next_at = start
+    while next_at - start < duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(workload.send(client)))
+        next_at += random.expovariate(rate)
+    return list(await asyncio.gather(*tasks))
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(results: List[Result], elapsed: float) -> Dict:
+    ok = [r for r in results if r.ok]
+    ttft = [r.ttft for r in ok if r.ttft is not None]
+    latency = [r.latency for r in ok]
+    tokens = sum(r.tokens for r in ok)
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_rate": round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+        "error_types": errors,
+        "rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "tokens_per_second": round(tokens / elapsed, 2) if elapsed else 0.0,
+        "ttft": {f"p{int(p * 100)}": percentile(ttft, p) for p in PERCENTILES},
+        "latency": {f"p{int(p * 100)}": percentile(latency, p) for p in PERCENTILES},
+    }
+
+
+def summarize_groups(results: List[Result], elapsed: float) -> Dict:
+    """整体和按 模型/流式 分组的统计"""
+    groups: Dict[str, List[Result]] = {}
+    for r in results:
+        groups.setdefault(f"{r.model}/{'stream' if r.stream else 'json'}", []).append(r)
+    summary = {"all": summarize(results, elapsed)}
+    for name in sorted(groups):
+        summary[name] = summarize(groups[name], elapsed)
+    return summary
+
+
+def added_latency(gateway: Dict, baseline: Dict) -> Dict:
+    """网关分位数减去直连 mock 的分位数"""
+    added = {}
+    for metric in ("ttft", "latency"):
+        added[metric] = {}
+        for key, value in gateway[metric].items():
+            base = baseline[metric].get(key)
+            added[metric][key] = value - base if value is not None and base is not None else None
+    return added
+
+
+async def run_workload(workload: Workload, mode: str, concurrency: int, rate: float, duration: float,
+                       requests: int = 0, timeout: float = 600, transport=None) -> Dict:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(concurrency, 100))
+    async with httpx.AsyncClient(timeout=timeout, limits=limits, transport=transport) as client:
+        start = time.perf_counter()
+        if mode == "open":
+            results = await open_loop(workload, client, rate, duration)
+        else:
+            results = await closed_loop(workload, client, concurrency, duration, requests)
+        elapsed = time.perf_counter() - start
+    return summarize_groups(results, elapsed)
+
+
+def ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def print_summary(title: str, summary: Dict):
+    print(f"\n{title}")
+    print(f"{'分组':<28} {'请求':>7} {'错误率':>7} {'req/s':>8} {'token/s':>9} "
+          f"{'首字 p50':>9} {'p95':>8} {'p99':>8} {'总耗时 p50':>10} {'p95':>8} {'p99':>8}")
+    for name, s in summary.items():
+        print(f"{name:<28} {s['requests']:>7} {s['error_rate']:>7.2%} {s['rps']:>8.1f} {s['tokens_per_second']:>9.0f} "
+              f"{ms(s['ttft']['p50']):>9} {ms(s['ttft']['p95']):>8} {ms(s['ttft']['p99']):>8} "
+              f"{ms(s['latency']['p50']):>10} {ms(s['latency']['p95']):>8} {ms(s['latency']['p99']):>8}")
+        if s["error_types"]:
+            print(f"{'':<28} {s['error_types']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="网关压测")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/v1", help="网关地址，到 /v1 为止")
+    parser.add_argument("--api-key", default=API_KEY)
+    parser.add_argument("--model", action="append", help="请求的模型，可以传多个轮流使用，默认 mock-openai")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=10, help="闭环的并发数")
+    parser.add_argument("--rate", type=float, default=10, help="开环每秒请求数")
+    parser.add_argument("--duration", type=float, default=10, help="秒")
+    parser.add_argument("--requests", type=int, default=0, help="闭环发满这么多请求就停止，0 表示按 duration")
+    parser.add_argument("--stream-ratio", type=float, default=1.0, help="流式请求的比例，0 全部非流式")
+    parser.add_argument("--prompt", default="你好")
+    parser.add_argument("--max-tokens", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--baseline", help="mock 的 OpenAI 地址，例如 http://127.0.0.1:9200/v1，用来计算网关增加的延迟")
+    parser.add_argument("--json", help="把结果写入这个 json 文件，方便和上一次比较")
+    args = parser.parse_args(argv)
+
+    def workload(url, models):
+        return Workload(url, args.api_key, models, args.stream_ratio, args.prompt, args.max_tokens)
+
+    def run(url, models):
+        return asyncio.run(run_workload(workload(url, models), args.mode, args.concurrency, args.rate,
+                                        args.duration, args.requests, args.timeout))
+
+    output = {"args": vars(args)}
+    if args.baseline:
+        output["baseline"] = run(args.baseline, ["mock-openai"])
+        print_summary(f"直连 mock {args.baseline}", output["baseline"])
+    output["gateway"] = run(args.url, args.model)
+    print_summary(f"网关 {args.url}", output["gateway"])
+    if args.baseline:
+        output["added"] = added_latency(output["gateway"]["all"], output["baseline"]["all"])
+        added = output["added"]
+        print(f"\n网关增加的延迟 ms  首字 p50 {ms(added['ttft']['p50'])} p95 {ms(added['ttft']['p95'])} "
+              f"p99 {ms(added['ttft']['p99'])}  总耗时 p50 {ms(added['latency']['p50'])} "
+              f"p95 {ms(added['latency']['p95'])} p99 {ms(added['latency']['p99'])}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(json.dumps(output, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
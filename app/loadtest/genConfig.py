@@ -0,0 +1,63 @@
+"""生成指向 mock 上游的网关配置
+
+python app/loadtest/genConfig.py --mock http://127.0.0.1:9200 --mock http://127.0.0.1:9201 --out ./loadtest.yaml
+
+每个 mock 生成 openai、gemini、vertexai_claude、cloudflare 四个渠道，模型名固定为 MODELS 里的名称，
+传多个 mock 时同一个模型在多个渠道之间负载均衡。
+"""
+import argparse
+import os
+from typing import Dict, List
+
+import yaml
+
+API_KEY = "sk-loadtest"
+MODELS = ["mock-openai", "mock-gemini", "mock-claude", "mock-cloudflare"]
+
+
+def build_config(mock_urls: List[str], api_key: str = API_KEY, admin_server: bool = True,
+                 db_path: str = "sqlite:///./data/loadtest.db", server: Dict = None) -> Dict:
+    providers = []
+    for i, url in enumerate(mock_urls):
+        url = url.rstrip("/")
+        providers += [
+            {"provider": "openai", "name": f"mock{i}_openai", "base_url": f"{url}/v1", "api_key": "mock",
+             "model": ["mock-openai"]},
+            {"provider": "gemini", "name": f"mock{i}_gemini", "base_url": f"{url}/v1beta", "api_key": "mock",
+             "model": ["mock-gemini"]},
+            {"provider": "vertexai_claude", "name": f"mock{i}_claude", "base_url": url, "token_url": f"{url}/token",
+             "PROJECT_ID": "mock", "CLIENT_ID": f"mock{i}", "CLIENT_SECRET": "mock", "REFRESH_TOKEN": "mock",
+             "model": [{"claude-3-5-sonnet@mock": "mock-claude"}]},
+            {"provider": "cloudflare", "name": f"mock{i}_cloudflare", "base_url": f"{url}/client/v4",
+             "api_key": "mock", "account_id": "mock", "model": [{"@cf/mock/model": "mock-cloudflare"}]},
+        ]
+    return {
+        "server": {"admin_server": admin_server, "db_path": db_path, "debug": False, "db_cache": False,
+                   **(server or {})},
+        "tokens": [{"api_key": api_key, "model": ["all"]}],
+        "providers": providers,
+    }
+
+
+def dump_config(config: Dict) -> str:
+    return yaml.safe_dump(config, allow_unicode=True, sort_keys=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成指向 mock 上游的 api.yaml")
+    parser.add_argument("--mock", action="append", help="mock 上游地址，可以传多个")
+    parser.add_argument("--out", default="loadtest.yaml")
+    parser.add_argument("--api-key", default=API_KEY)
+    parser.add_argument("--no-log", action="store_true", help="关闭 admin_server，不写请求日志")
+    parser.add_argument("--force", action="store_true", help="覆盖已经存在的文件")
+    args = parser.parse_args(argv)
+    if os.path.exists(args.out) and not args.force:
+        parser.error(f"{args.out} 已经存在，用 --force 覆盖")
+    config = build_config(args.mock or ["http://127.0.0.1:9200"], args.api_key, not args.no_log)
+    with open(args.out, "w", encoding="utf-8") as f:
+        f.write(dump_config(config))
+    print(f"已写入 {args.out}，模型: {', '.join(MODELS)}")
+
+
+if __name__ == "__main__":
+    main()
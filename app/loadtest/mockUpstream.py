@@ -0,0 +1,227 @@
+"""压测用的本地 mock 上游，同一个端口模拟 OpenAI、Gemini、Vertex Claude 和 Cloudflare 的接口
+
+python app/loadtest/mockUpstream.py --port 9200 --tps 50 --ttft 0.3
+
+首字耗时、输出速度、输出长度和错误率都可以配置，GET /api.yaml 返回指向这个 mock 的网关配置，
+网关用 config_url=http://127.0.0.1:9200/api.yaml 启动即可，不用改本地的 api.yaml。
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import ujson as json
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.loadtest.genConfig import build_config, dump_config
+
+WORDS = ["你好", "，", "这是", "压测", "的", "输出", "。", " mock", " token", "\n"]
+
+
+class MockConfig:
+    def __init__(self, tps: float = 50, ttft: float = 0.3, tokens: int = 100, error_rate: float = 0.0,
+                 jitter: float = 0.0):
+        self.tps = tps  # 每秒输出多少个 token，0 表示不限速
+        self.ttft = ttft  # 首字耗时，秒
+        self.tokens = tokens  # 每个响应输出多少个 token
+        self.error_rate = error_rate  # 直接返回 500 的比例
+        self.jitter = jitter  # 首字耗时随机浮动的比例
+
+
+class MockUpstream:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.requests = 0
+        self.errors = 0
+
+    def failed(self) -> bool:
+        self.requests += 1
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def first_token_delay(self):
+        ttft = self.config.ttft
+        if self.config.jitter:
+            ttft *= 1 + random.uniform(-self.config.jitter, self.config.jitter)
+        if ttft > 0:
+            await asyncio.sleep(ttft)
+
+    async def tokens(self):
+        """按配置的首字耗时和速度逐个产生 token，按截止时间睡眠，不会越睡越慢"""
+        await self.first_token_delay()
+        tps = self.config.tps
+        start = time.monotonic()
+        for i in range(self.config.tokens):
+            if tps:
+                delay = start + i / tps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield WORDS[i % len(WORDS)]
+
+    async def full_text(self) -> str:
+        return "".join([token async for token in self.tokens()])
+
+    def usage(self):
+        return 10, self.config.tokens, 10 + self.config.tokens
+
+    # OpenAI  POST /v1/chat/completions
+    async def openai(self, request: Request):
+        if self.failed():
+            return error_response()
+        body = await request.json()
+        model = body.get("model", "mock")
+        prompt, completion, total = self.usage()
+        usage = {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": total}
+        if not body.get("stream"):
+            return JSONResponse({
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": await self.full_text()},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        def chunk(delta, finish_reason=None, usage=None):
+            data = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            if usage:
+                data["usage"] = usage
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            first = True
+            async for token in self.tokens():
+                if first:
+                    yield chunk({"role": "assistant", "content": ""})
+                    first = False
+                yield chunk({"content": token})
+            yield chunk({}, "stop", usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # Gemini  POST /v1beta/models/{model}:generateContent  :streamGenerateContent?alt=sse
+    async def gemini(self, request: Request):
+        if self.failed():
+            return error_response()
+        prompt, completion, total = self.usage()
+
+        def response(text, finish_reason=None, done=0):
+            candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+            if finish_reason:
+                candidate["finishReason"] = finish_reason
+            return {"candidates": [candidate],
+                    "usageMetadata": {"promptTokenCount": prompt, "candidatesTokenCount": done,
+                                      "totalTokenCount": prompt + done}}
+
+        if not request.path_params["target"].endswith(":streamGenerateContent"):
+            return JSONResponse(response(await self.full_text(), "STOP", completion))
+
+        async def stream():
+            done = 0
+            async for token in self.tokens():
+                done += 1
+                yield f"data: {json.dumps(response(token, None, done), ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps(response('', 'STOP', completion))}\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # Vertex Claude  POST /v1/projects/{project}/locations/{location}/publishers/anthropic/models/{model}:streamRawPredict
+    async def claude(self, request: Request):
+        if self.failed():
+            return error_response()
+        body = await request.json()
+        prompt, completion, total = self.usage()
+        if not body.get("stream"):
+            return JSONResponse({
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": "claude-mock",
+                "content": [{"type": "text", "text": await self.full_text()}],
+                "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": prompt, "output_tokens": completion},
+            })
+
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            first = True
+            async for token in self.tokens():
+                if first:
+                    yield event("message_start", {"type": "message_start", "message": {
+                        "id": "msg_mock", "type": "message", "role": "assistant", "model": "claude-mock",
+                        "content": [], "usage": {"input_tokens": prompt, "output_tokens": 1}}})
+                    yield event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                        "content_block": {"type": "text", "text": ""}})
+                    first = False
+                yield event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": token}})
+            yield event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                                          "usage": {"output_tokens": completion}})
+            yield event("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # Vertex 的 access_token  POST /token
+    async def token(self, request: Request):
+        return JSONResponse({"access_token": "mock-token", "expires_in": 3600, "token_type": "Bearer"})
+
+    # Cloudflare  POST /client/v4/accounts/{account}/ai/run/{model}，只有非流式
+    async def cloudflare(self, request: Request):
+        if self.failed():
+            return error_response()
+        return JSONResponse({"result": {"response": await self.full_text()}, "success": True, "errors": []})
+
+    async def stats(self, request: Request):
+        return JSONResponse({"requests": self.requests, "errors": self.errors})
+
+    async def api_yaml(self, request: Request):
+        base = f"{request.url.scheme}://{request.url.netloc}"
+        return Response(dump_config(build_config([base])), media_type="text/yaml")
+
+
+def error_response():
+    return JSONResponse({"error": {"message": "mock upstream error", "type": "server_error"}}, status_code=500)
+
+
+def create_app(config: MockConfig) -> Starlette:
+    mock = MockUpstream(config)
+    app = Starlette(routes=[
+        Route("/v1/chat/completions", mock.openai, methods=["POST"]),
+        Route("/v1beta/models/{target}", mock.gemini, methods=["POST"]),
+        Route("/v1/projects/{project}/locations/{location}/publishers/anthropic/models/{target}", mock.claude,
+              methods=["POST"]),
+        Route("/token", mock.token, methods=["POST"]),
+        Route("/client/v4/accounts/{account}/ai/run/{model:path}", mock.cloudflare, methods=["POST"]),
+        Route("/stats", mock.stats),
+        Route("/api.yaml", mock.api_yaml),
+    ])
+    app.state.mock = mock
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="压测用的 mock 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--tps", type=float, default=50, help="每秒输出 token 数，0 不限速")
+    parser.add_argument("--ttft", type=float, default=0.3, help="首字耗时，秒")
+    parser.add_argument("--tokens", type=int, default=100, help="每个响应的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--jitter", type=float, default=0.0, help="首字耗时随机浮动的比例")
+    args = parser.parse_args(argv)
+    config = MockConfig(args.tps, args.ttft, args.tokens, args.error_rate, args.jitter)
+    print(f"mock 上游 http://{args.host}:{args.port}  网关配置 http://{args.host}:{args.port}/api.yaml")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
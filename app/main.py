@@ -12,9 +12,8 @@ from fastapi.routing import APIRoute
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, Request, Body
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from app.error_info import generate_error_response
@@ -24,14 +23,21 @@ from app.log import logger
 
 from app.api_data import db, get_db, reload_db, 监视配置
 from app.provider.load_providers import load_providers
-from app.Balance import Balance
-
-G_balance = {}
+from app.provider import httpxHelp
+from app.provider.httpxHelp import upstream_clients
+from app.Balance import BalanceManager
+from app.failover import Failover, UpstreamAttempt
+from app.streamResponse import UpstreamStream
+from app.sharedState import get_shared_state
+from app import metrics
+
+G_balance = BalanceManager(shared=get_shared_state())
 ai_manager = {}
 def reload_config():
     global ai_manager, db, G_balance
-    G_balance = {}
     db = reload_db()
+    G_balance = BalanceManager(db.config_server.get("balance", {}), get_shared_state())
+    upstream_clients.configure(db.config_server.get("http", {}))
     ai_manager = load_providers(db)
 
 config_url = os.environ.get('config_url', False)
@@ -52,7 +58,22 @@ async def lifespan(app: FastAPI):
 
     logger.info("服务器启动")
     print_routes()
+    upstream_clients.configure(db.config_server.get("http", {}))
+    if db.config_server.get("admin_server", False):
+        request_log_sink.start()
+        httpxHelp.response_cache.start()
+        payload_job.start()
+    if metrics.exporter is not None:
+        metrics.exporter.start()
     yield
+    if metrics.exporter is not None:
+        await metrics.exporter.stop()
+    if db.config_server.get("admin_server", False):
+        await payload_job.stop()
+        await httpxHelp.response_cache.stop()
+        await request_log_sink.stop()
+    await upstream_clients.aclose()
+    logger.info("已关闭上游连接池")
 
 
 app = FastAPI(lifespan=lifespan)
@@ -118,18 +139,31 @@ class ChatCompletionRequest(BaseModel):
 
 
 def get_provider(api_key, model):
-    balance_key = f"{api_key}_{model}"
-    if balance_key in G_balance:
-        balance = G_balance[balance_key]
-    else:
-        providers, error = db.get_user_provider(api_key, model)
-        if not providers:
-            raise HTTPException(status_code=500, detail=error)
-        balance = Balance(api_key, providers)
-        G_balance[balance_key] = balance
-    provider = balance.next().data
-    print(f"provider: {provider}")
-    return provider
+    """返回模型共享的 Balance 和选中的渠道，权限每次都检查 (路由索引有缓存)"""
+    providers, error = db.get_user_provider(api_key, model)
+    if not providers:
+        raise HTTPException(status_code=500, detail=error)
+    balance = G_balance.get(model, providers)
+    upstream = balance.next()
+    if upstream is None:
+        raise HTTPException(status_code=500, detail=f"模型:{model}没有可用渠道")
+    return balance, upstream
+
+
+def save_req_log(log_data, stats_data=None, api_status="200", api_error=""):
+    """把一次请求的完整日志放入写入队列，没有开启后台时 log_data 为 None"""
+    if log_data is None:
+        return
+    stats_data = stats_data or {}
+    log_data.update({
+        "prompt": stats_data.get("prompt_tokens", 0),
+        "completion": stats_data.get("completion_tokens", 0),
+        "quota": 0,  # 假设每1000个token花费0.002美元
+        "response_data": json.dumps(stats_data) if stats_data else "",
+        "api_status": api_status,
+        "api_error": api_error,
+    })
+    request_log_sink.put(log_data)
 
 
 if db.config_server.get("debug", False):
@@ -150,71 +184,118 @@ async def chat_completions(
     except:
         raise HTTPException(status_code=500, detail="body解析失败")
 
-    provider = get_provider(api_key, request.model)
+    balance, upstream = get_provider(api_key, request.model)
 
     headers = dict(req.headers)
     id = str(uuid.uuid4().hex)[:16]
     request.id = headers.get("id", id)
     logger.name = f"main.{request.id}"
-
-    logger.info(
-        f"服务提供者:{provider['provider']}_{provider['name']}, 请求模型:{request.model}, 当前模型:{provider.get('mapped_model')}, 名称:{provider.get('name')}")
-
-    # return provider['name']
-
-    ai_chat = getProvider(provider)
-    debug = db.config_server.get("debug", False)
-    if debug:
-        ai_chat.setDebugSave(f"{provider.get('mapped_model')}_{provider.get('provider')}_{request.id}")
-        ai_chat._cache = True
-        ai_chat._debug = True
-        body2json = json.dumps(body, indent=4, ensure_ascii=False)
-        pyefun.文件_保存(f"./provider/sendbody/{provider.get('provider')}_{request.id}_{request.model}.txt", body2json)
-    else:
-        ai_chat._cache = False
-        ai_chat._debug = False
-    ai_chat._db_cache = db.config_server.get("db_cache", False)
-
     request_model_name = request.model
-    body["model"] = provider.get("mapped_model")
-
-    # 先插入日志记录
-    service_provider = f"{provider.get('provider', '')}_{provider.get('name', '')}"
+    # 监控指标的标签用配置里的模型名 (没有渠道时是兜底模型)，请求里的模型名是任意的，不能当标签
+    model_label = balance.route
+    debug = db.config_server.get("debug", False)
 
+    # 请求结束后只写一次日志
+    log_data = None
     if db.config_server.get("admin_server", False):
-        request_logger.insert_req_log(
-            req_id=id,
-            service_provider=service_provider,
-            token=api_key,
-            model=request.model,
-            prompt=0,
-            completion=0,
-            quota=0,
-            uri=req.url.path,
-            request_data=json.dumps(body),
-            response_data=""
-        )
+        log_data = {
+            "time": get_current_time(),
+            "req_id": id,
+            "token": api_key,
+            "model": request.model,
+            "uri": req.url.path,
+        }
 
-    genData = ai_chat.chat2api(body, request_model_name, id)
-    first_chunk = await genData.__anext__()
+    # 还没有给客户端发送任何数据之前，上游出错就换下一个渠道重试
+    failover = db.config_server.get("failover", {})
+    # 对冲请求：token 开启后，首个渠道超过这个模型的 p90 首字耗时还没有返回，就同时请求另一个渠道
+    hedge = db.config_server.get("hedge", {})
+    hedge_delay = None
+    if db.get_token_config(api_key).get("hedge", False):
+        hedge_delay = balance.ttft_percentile(hedge.get("percentile", 0.9), hedge.get("min_samples", 20))
+    balance.requests += 1
+
+    stream_label = "true" if request.stream else "false"
+
+    def open_attempt(number, upstream, hedged):
+        provider = upstream.data
+        service_provider = f"{provider.get('provider', '')}_{provider.get('name', '')}"
+        logger.info(
+            f"服务提供者:{service_provider}, 请求模型:{request.model}, 当前模型:{provider.get('mapped_model')}, 名称:{provider.get('name')}, 第{number}次尝试")
+
+        ai_chat = getProvider(provider)
+        ctx = ai_chat.new_context(id, request_model_name)
+        if debug:
+            ctx.setDebugSave(f"{provider.get('mapped_model')}_{provider.get('provider')}_{request.id}")
+            ctx.cache = True
+            ctx.debug = True
+            body2json = json.dumps(body, indent=4, ensure_ascii=False)
+            pyefun.文件_保存(f"./provider/sendbody/{provider.get('provider')}_{request.id}_{request.model}.txt", body2json)
+        else:
+            ctx.cache = False
+            ctx.debug = False
+        ctx.db_cache = db.config_server.get("db_cache", False)
+        # 不写日志的流式请求用不到完整的内容，不累加
+        ctx.accumulate = not request.stream or log_data is not None or debug
+        ctx.labels = (service_provider, provider.get("original_model") or model_label)
+
+        send_body = dict(body)
+        send_body["model"] = provider.get("mapped_model")
+        return UpstreamAttempt(number, upstream, service_provider, send_body, ctx,
+                               ai_chat.chat2api(send_body, request_model_name, id, ctx), hedged)
+
+    race = Failover(balance, open_attempt, model_label,
+                    max_attempts=failover.get("max_attempts", 3),
+                    deadline=failover.get("deadline", 0),
+                    attempt_timeout=failover.get("attempt_timeout", 0),
+                    hedge_delay=hedge_delay,
+                    hedge_ratio=hedge.get("max_ratio", 0.1))
+    winner = await race.run(upstream)
+    attempts, error = race.attempts, race.error
+
+    if winner is None:
+        if isinstance(error, asyncio.TimeoutError):
+            error = HTTPException(status_code=504, detail=f"等待上游响应超时，已尝试 {len(attempts)} 次")
+        if log_data is not None:
+            last = attempts[-1]
+            log_data.update({
+                "service_provider": last.service_provider,
+                "request_data": json.dumps(last.send_body),
+                "attempt": last.number,
+            })
+        status_code = error.status_code if isinstance(error, HTTPException) else 500
+        metrics.requests_total.inc(model_label, stream_label, str(status_code))
+        if isinstance(error, HTTPException):
+            save_req_log(log_data, None, str(error.status_code), str(error.detail))
+        raise error
+
+    upstream, ctx, genData = winner.upstream, winner.ctx, winner.genData
+    first_chunk = winner.task.result()
+    first_chunk_time = time.perf_counter()
+    upstream.stats.first_chunk(first_chunk_time - winner.start_time)
+    metrics.upstream_ttft_seconds.observe(first_chunk_time - winner.start_time, *ctx.labels)
+    balance.record_ttft(first_chunk_time - winner.start_time)
+    if winner.hedged:
+        balance.hedge_wins += 1
+    G_balance.record_attempt(winner.number)
+    if log_data is not None:
+        log_data.update({
+            "service_provider": winner.service_provider,
+            "request_data": json.dumps(winner.send_body),
+            "attempt": winner.number,
+        })
 
     if not request.stream:
-        stats_data = ai_chat.DataHeadler.get_stats()
+        stats_data = ctx.DataHeadler.get_stats()
+        upstream.stats.finish(True)
+        metrics.upstream_duration_seconds.observe(first_chunk_time - winner.start_time, *ctx.labels)
+        metrics.requests_total.inc(model_label, stream_label, "200")
 
         if debug:
             logger.info(f"发送到客户端\r\n{first_chunk}")
             logger.info(f"SSE数据迭代完成，统计信息：{json.dumps(stats_data, indent=4)}")
 
-        if db.config_server.get("admin_server", False):
-            request_logger.update_req_log(
-                req_id=id,
-                prompt=stats_data["prompt_tokens"],
-                completion=stats_data["completion_tokens"],
-                quota=0,  # 假设每1000个token花费0.002美元
-                response_data=json.dumps(stats_data),
-                api_status="200",
-                api_error=""
-            )
+        save_req_log(log_data, stats_data)
         return JSONResponse(
             content=first_chunk, 
             headers={
@@ -224,34 +305,35 @@ async def chat_completions(
         )
 
     if first_chunk:
-        async def generate_stream():
-            async for chunk in genData:
-                yield chunk + "\n\n"
-                if debug:
-                    await asyncio.sleep(0.1)
-                    logger.info(f"发送到客户端\r\n{chunk}")
-            stats_data = ai_chat.DataHeadler.get_stats()
-            if db.config_server.get("admin_server", False):
-                request_logger.update_req_log(
-                    req_id=id,
-                    prompt=stats_data["prompt_tokens"],
-                    completion=stats_data["completion_tokens"],
-                    quota=0,  # 假设每1000个token花费0.002美元
-                    response_data=json.dumps(stats_data),
-                    api_status="200",
-                    api_error=""
-                )
+        def finish_stream(api_status, api_error):
+            metrics.inflight_streams.dec(model_label)
+            stats_data = ctx.DataHeadler.get_stats()
+            end_time = time.perf_counter()
+            completion_tokens = (stats_data or {}).get("completion_tokens", 0)
+            upstream.stats.finish(
+                {"200": True, "500": False}.get(api_status),
+                completion_tokens,
+                end_time - first_chunk_time,
+            )
+            metrics.requests_total.inc(model_label, stream_label, api_status)
+            metrics.upstream_duration_seconds.observe(end_time - winner.start_time, *ctx.labels)
+            if completion_tokens and end_time > first_chunk_time:
+                metrics.upstream_tokens_per_second.observe(
+                    completion_tokens / (end_time - first_chunk_time), *ctx.labels)
+            save_req_log(log_data, stats_data, api_status, api_error)
             if debug:
                 logger.info(f"数据迭代完成，统计信息：{json.dumps(stats_data, indent=4, ensure_ascii=False)}")
 
-        return StreamingResponse(
-            generate_stream(), 
+        metrics.inflight_streams.inc(model_label)
+        # 客户端在开始读取之前断开时 finish_stream 由 background 执行
+        return UpstreamStream(genData, finish_stream, debug).response(
             media_type="text/event-stream", 
             headers={
                 "Cache-Control": "no-cache",
                 "X-Accel-Buffering": "no"
             }
         )
+    upstream.stats.finish(None)
 
 
 @app.get("/v1/models")
@@ -273,6 +355,26 @@ app.add_middleware(
 )
 
 
+@app.get("/upstream_stats")
+async def upstream_stats(api_key: str = Depends(verify_api_key)):
+    data = {
+        "data": upstream_clients.stats(),
+        "balance": G_balance.stats(),
+    }
+    if db.config_server.get("admin_server", False):
+        data["cache"] = httpxHelp.response_cache.stats()
+    return data
+
+
+@app.get("/metrics")
+async def prometheus_metrics(req: Request):
+    """Prometheus 抓取接口，配置了 server.metrics_token 时需要 Authorization: Bearer <metrics_token>"""
+    token = db.config_server.get("metrics_token")
+    if token and req.headers.get("authorization") != f"Bearer {token}":
+        raise HTTPException(status_code=401, detail="metrics_token 不正确")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/reload_config")
 def reloadconfig():
     reload_config()
@@ -292,8 +394,26 @@ class GzipStaticFiles(StaticFiles):
 
 if db.config_server.get("admin_server", False):
     from app.db.logDB import RequestLogger
+    from app.db.logSink import RequestLogSink
+    from app.db.comm import get_current_time
 
     request_logger = RequestLogger()
+    request_log_sink = RequestLogSink(
+        request_logger,
+        max_size=db.config_server.get("log_queue_size", 10000),
+        batch_size=db.config_server.get("log_batch_size", 200),
+        flush_interval=db.config_server.get("log_flush_interval", 1.0),
+    )
+    from app.db.payloadJob import PayloadJob
+
+    payload_job = PayloadJob(
+        retention_days=db.config_server.get("payload_retention_days", 0),
+        archive_dir=db.config_server.get("payload_archive_dir", ""),
+        interval=db.config_server.get("payload_job_interval", 3600),
+        shared=get_shared_state(),
+    )
+    metrics.REGISTRY.gauge_func("proapi_log_queue_size", "请求日志写入队列里等待写入的条数", (),
+                                lambda: [((), request_log_sink.stats()["queue_size"])])
     from app.routers.router import api_router
 
     app.include_router(api_router, prefix="")
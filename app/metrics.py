@@ -0,0 +1,320 @@
+"""Prometheus 文本格式的监控指标，/metrics 输出
+
+不依赖 prometheus_client。热路径上只有一次字典查找和几次加法，不加锁 (都在事件循环线程里)，
+不访问数据库；连接池、日志队列这类状态在抓取时通过回调读取，平时没有开销。
+"""
+import asyncio
+import glob
+import os
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import ujson as json
+
+try:
+    import fcntl
+except ImportError:  # windows 只能单进程运行，不会用到 MultiProcessExporter
+    fcntl = None
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# tokens/秒
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self, values: Optional[Dict] = None) -> Iterable[str]:
+        for labels, value in (self.values if values is None else values).items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class GaugeFunc(Gauge):
+    """抓取时才调用 fn 取值，fn 返回 [(标签值元组, 数值), ...]"""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...], fn: Callable[[], Iterable[Tuple]]):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    @property
+    def values(self):
+        return dict(self.fn())
+
+    @values.setter
+    def values(self, value):
+        pass
+
+
+class Histogram:
+    """每个桶只记录落在这个桶里的次数，输出时再累加成 Prometheus 的 le 累计值"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple, List] = {}  # 标签: [每个桶的次数..., +Inf 桶, sum]
+
+    def observe(self, value: float, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        data[bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def samples(self, values: Optional[Dict] = None) -> Iterable[str]:
+        for labels, data in (self.values if values is None else values).items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), data):
+                total += count
+                le = 'le="' + _number(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(data[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {total}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        """同名指标只保留第一个"""
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge_func(self, name, help, labelnames, fn) -> GaugeFunc:
+        """回调按名字替换，重新加载配置后读取的是新的连接池或者日志队列"""
+        metric = GaugeFunc(name, help, labelnames, fn)
+        self.metrics[name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, List]:
+        """可以 json 序列化的当前值 {指标名: [[标签值列表, 值], ...]}"""
+        return {name: [[list(labels), value] for labels, value in metric.values.items()]
+                for name, metric in self.metrics.items()}
+
+    def merge(self, snapshots: List[Dict[str, List]], alive: List[bool]) -> Dict[str, Dict]:
+        """合并多个进程的快照：计数器和直方图累加；gauge 只累加还在运行的进程"""
+        merged: Dict[str, Dict] = {}
+        for name, metric in self.metrics.items():
+            values: Dict[Tuple, object] = {}
+            for snapshot, is_alive in zip(snapshots, alive):
+                if metric.kind == "gauge" and not is_alive:
+                    continue
+                for labels, value in snapshot.get(name, ()):
+                    labels = tuple(labels)
+                    old = values.get(labels)
+                    if old is None:
+                        values[labels] = list(value) if metric.kind == "histogram" else value
+                    elif metric.kind == "histogram" and len(old) == len(value):
+                        values[labels] = [a + b for a, b in zip(old, value)]
+                    elif metric.kind != "histogram":
+                        values[labels] = old + value
+            merged[name] = values
+        return merged
+
+    def render(self, merged: Optional[Dict[str, Dict]] = None) -> str:
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(None if merged is None else merged.get(name, {})))
+        lines.append("")
+        return "\n".join(lines)
+
+
+ENV_DIR = "PROAPI_METRICS_DIR"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MultiProcessExporter:
+    """多进程模式下每个 worker 定时把自己的指标写到 PROAPI_METRICS_DIR/<pid>.json
+
+    Prometheus 每次只会抓到其中一个 worker，这个 worker 把自己的实时值和其他 worker 的文件合并后输出。
+    抓取时发现已经退出的 worker，把它的计数器和直方图累加到 aggregate.json 后删除它的文件，计数器不会倒退，
+    gauge 直接丢掉；目录里的文件数不会随着 worker 回收一直增长。合并和输出都在目录的文件锁里进行。
+    """
+
+    AGGREGATE = "aggregate.json"
+
+    def __init__(self, registry: Registry, directory: str, interval: float = 5):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.pid = os.getpid()
+        self._task: Optional[asyncio.Task] = None
+
+    def write(self, alive: bool = True):
+        path = os.path.join(self.directory, f"{self.pid}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"pid": self.pid, "alive": alive, "metrics": self.registry.snapshot()}))
+        os.replace(path + ".tmp", path)
+
+    def start(self):
+        if self._task is None:
+            self.pid = os.getpid()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self.write()
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.write(alive=False)
+
+    @staticmethod
+    def _read(path: str) -> Optional[Dict]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_aggregate(self, snapshots: List[Dict[str, List]]):
+        merged = self.registry.merge(snapshots, [False] * len(snapshots))
+        metrics = {name: [[list(labels), value] for labels, value in values.items()] for name, values in merged.items()}
+        path = os.path.join(self.directory, self.AGGREGATE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"pid": 0, "alive": False, "metrics": metrics}))
+        os.replace(path + ".tmp", path)
+
+    def _collect(self) -> Tuple[List[Dict[str, List]], List[bool]]:
+        """在锁里调用：合并已经退出的 worker，返回其他文件的快照和是否还在运行"""
+        aggregate = self._read(os.path.join(self.directory, self.AGGREGATE))
+        snapshots, alive, dead = [], [], []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if os.path.basename(path) == self.AGGREGATE:
+                continue
+            data = self._read(path)
+            if data is None or data.get("pid") == self.pid:
+                continue
+            if data.get("alive") and _pid_alive(data.get("pid", 0)):
+                snapshots.append(data.get("metrics", {}))
+                alive.append(True)
+            else:
+                dead.append((path, data.get("metrics", {})))
+        total = [aggregate.get("metrics", {})] if aggregate else []
+        if dead:
+            total += [metrics for _, metrics in dead]
+            self._write_aggregate(total)
+            for path, _ in dead:
+                os.remove(path)
+        return snapshots + total, alive + [False] * len(total)
+
+    def render(self) -> str:
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshots, alive = self._collect()
+        return self.registry.render(self.registry.merge([self.registry.snapshot()] + snapshots, [True] + alive))
+
+
+REGISTRY = Registry()
+exporter = MultiProcessExporter(REGISTRY, os.environ[ENV_DIR]) if os.environ.get(ENV_DIR) else None
+
+
+def render() -> str:
+    return exporter.render() if exporter is not None else REGISTRY.render()
+
+
+PROVIDER_MODEL = ("provider", "model")
+
+upstream_connect_seconds = REGISTRY.histogram(
+    "proapi_upstream_connect_seconds", "新建上游连接的 TCP+TLS 耗时", PROVIDER_MODEL)
+upstream_ttft_seconds = REGISTRY.histogram(
+    "proapi_upstream_ttft_seconds", "从请求上游到收到首个数据块的耗时", PROVIDER_MODEL)
+upstream_duration_seconds = REGISTRY.histogram(
+    "proapi_upstream_duration_seconds", "从请求上游到响应结束的总耗时", PROVIDER_MODEL)
+upstream_tokens_per_second = REGISTRY.histogram(
+    "proapi_upstream_tokens_per_second", "首个数据块之后的输出速度", PROVIDER_MODEL, RATE_BUCKETS)
+
+requests_total = REGISTRY.counter(
+    "proapi_requests_total", "网关处理的请求数，status 是返回给客户端的状态", ("model", "stream", "status"))
+upstream_errors_total = REGISTRY.counter(
+    "proapi_upstream_errors_total", "上游请求失败次数，按错误类型分类", PROVIDER_MODEL + ("class",))
+failovers_total = REGISTRY.counter(
+    "proapi_failovers_total", "上游失败后切换到下一个渠道的次数", ("model",))
+hedges_total = REGISTRY.counter(
+    "proapi_hedges_total", "首字超时发起的对冲请求数", ("model",))
+cache_requests_total = REGISTRY.counter(
+    "proapi_cache_requests_total", "db_cache 响应缓存的命中和未命中", ("result",))
+stream_chunks_total = REGISTRY.counter(
+    "proapi_stream_chunks_total", "转发给客户端的流式数据块数", PROVIDER_MODEL)
+
+inflight_streams = REGISTRY.gauge(
+    "proapi_inflight_streams", "正在输出的流式响应数", ("model",))
+
+
+def error_class(status_code: Optional[int]) -> str:
+    if status_code is None:
+        return "other"
+    if status_code == 429:
+        return "http_429"
+    if status_code >= 500:
+        return "http_5xx"
+    if status_code >= 400:
+        return "http_4xx"
+    return "other"
@@ -4,8 +4,46 @@ from typing import AsyncGenerator
 import pyefun
 from fastapi import HTTPException
 
+from app import metrics
 from app.log import logger
-from app.provider.httpxHelp import get_api_data, get_api_data_cache
+from app.provider.httpxHelp import get_api_data, get_api_data_cache, get_api_raw
+from app.provider.sseEncoder import SSE_DONE
+
+
+def debug_save_paths(name="openai"):
+    name = name.replace("/", "-")
+    # 获取当前脚本所在的目录
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    # 构造文件的绝对路径
+    return (os.path.join(current_dir + f"/debugdata/{name}_sse.txt"),
+            os.path.join(current_dir + f"/debugdata/{name}_data.txt"))
+
+
+class RequestContext:
+    """一次请求的状态：数据处理器、调试开关和请求 id
+
+    provider 实例只保存配置，所有请求共享同一个实例，请求相关的数据都放在这里，
+    不再需要每次请求 deepcopy 整个 provider。
+    """
+    __slots__ = ("id", "request_model_name", "DataHeadler", "debug", "cache", "db_cache",
+                 "debugfile_sse", "debugfile_data", "debug_file", "accumulate", "labels")
+
+    def __init__(self, id: str = "", request_model_name: str = "", debug=False, cache=False, db_cache=False,
+                 debugfile_sse="", debugfile_data=""):
+        self.id = id
+        self.request_model_name = request_model_name
+        self.DataHeadler = None
+        self.debug = debug
+        self.cache = cache
+        self.db_cache = db_cache
+        self.debugfile_sse = debugfile_sse
+        self.debugfile_data = debugfile_data
+        self.debug_file = ""
+        self.accumulate = True  # 是否需要完整的内容 (写日志、非流式输出)
+        self.labels = ("", request_model_name)  # 监控指标的 (渠道, 模型) 标签
+
+    def setDebugSave(self, name="openai"):
+        self.debugfile_sse, self.debugfile_data = debug_save_paths(name)
 
 
 class baseProvider:
@@ -13,26 +51,30 @@ class baseProvider:
         self._debug = False
         self._cache = False
         self._db_cache = False
+        self.http_config = {}
         self.setDebugSave("openai")
-        self.DataHeadler = None
+
+    def setHttpConfig(self, http_config=None):
+        """设置 api.yaml 中 provider 的 http 连接池参数"""
+        self.http_config = http_config or {}
 
     def setDebugSave(self, name="openai"):
-        name = name.replace("/", "-")
-        # 获取当前脚本所在的目录
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        # 构造文件的绝对路径
-        self._debugfile_sse = os.path.join(current_dir + f"/debugdata/{name}_sse.txt")
-        self._debugfile_data = os.path.join(current_dir + f"/debugdata/{name}_data.txt")
-        self.debug_file = ""
+        """设置默认的调试文件，单个请求可以用 RequestContext.setDebugSave 覆盖"""
+        self._debugfile_sse, self._debugfile_data = debug_save_paths(name)
 
-    async def debugRtCache(self, request):
-        self.debug_file = self._debugfile_sse if request.get("stream", False) else self._debugfile_data
-        if self._debug:
+    def new_context(self, id: str = "", request_model_name: str = "") -> RequestContext:
+        """创建一次请求的上下文，开关默认取 provider 上的设置"""
+        return RequestContext(id, request_model_name, self._debug, self._cache, self._db_cache,
+                              self._debugfile_sse, self._debugfile_data)
+
+    async def debugRtCache(self, request, ctx: RequestContext):
+        ctx.debug_file = ctx.debugfile_sse if request.get("stream", False) else ctx.debugfile_data
+        if ctx.debug:
             error = False
-            if self._cache:
-                logger.info(f"使用缓存{self.debug_file}")
+            if ctx.cache:
+                logger.info(f"使用缓存{ctx.debug_file}")
                 try:
-                    data = pyefun.读入文本(self.debug_file)
+                    data = pyefun.读入文本(ctx.debug_file)
                     if not request.get("stream", False):
                         if data != "":
                             yield data
@@ -46,73 +88,107 @@ class baseProvider:
 
                 except FileNotFoundError:
                     error = False
-                    logger.info(f"缓存不存在{self.debug_file}")
+                    logger.info(f"缓存不存在{ctx.debug_file}")
 
             if error:
                 yield "停止"
                 return
-            if pyefun.文件是否存在(self.debug_file):
-                pyefun.删除文件(self.debug_file)
+            if pyefun.文件是否存在(ctx.debug_file):
+                pyefun.删除文件(ctx.debug_file)
 
-    async def sendChatCompletions(self, pushdata) -> AsyncGenerator[str, None]:
+    async def sendChatCompletions(self, pushdata, ctx: RequestContext) -> AsyncGenerator[str, None]:
         # logger.info(f"\r\nsend {url} \r\nbody:\r\n{json.dumps(body, indent=4, ensure_ascii=False)}")
         # 调试部分 不要看
-        async for i in self.debugRtCache(pushdata):
+        async for i in self.debugRtCache(pushdata, ctx):
             if i == "停止":
                 return
             else:
                 yield i
 
         # 看这里 ==========
-        if self._db_cache:
-            datas = get_api_data_cache(pushdata)
+        if ctx.db_cache:
+            datas = get_api_data_cache(pushdata, self.http_config, ctx.labels)
         else:
-            datas = get_api_data(pushdata)
+            datas = get_api_data(pushdata, self.http_config, ctx.labels)
 
         async for line in datas:
-            if self._cache:
+            if ctx.cache:
                 if pushdata.get("stream", False):
-                    pyefun.文件_追加文本(self.debug_file, line)
-                    logger.info(f"{self.debug_file}追加数据\r\n{line}")
+                    pyefun.文件_追加文本(ctx.debug_file, line)
+                    logger.info(f"{ctx.debug_file}追加数据\r\n{line}")
                 else:
-                    pyefun.文件_写出(self.debug_file, line)
-                    logger.info(f"{self.debug_file}写入数据\r\n{line}")
+                    pyefun.文件_写出(ctx.debug_file, line)
+                    logger.info(f"{ctx.debug_file}写入数据\r\n{line}")
 
-            if self._debug:
+            if ctx.debug:
                 logger.info(f"收到数据\r\n{line}")
             yield line
 
-    async def chat2api_super(self, request, request_model_name: str = "", id: str = "", pushdata="") -> AsyncGenerator[
-        str, None]:
+    async def chat2api_super(self, request, request_model_name: str = "", id: str = "", pushdata="",
+                             ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         pass
 
 
         try:
-            genData = self.sendChatCompletions(pushdata)
+            genData = self.sendChatCompletions(pushdata, ctx)
             first_chunk = await genData.__anext__()
         except Exception as e:
             logger.error("报错了chat2api %s", e)
             raise HTTPException(status_code=404, detail=e)
 
         if not request.get("stream", False):
-            content = self.DataHeadler.handle_data_line(first_chunk)
+            content = ctx.DataHeadler.handle_data_line(first_chunk)
             yield content
             return
 
         # 流处理的代码
+        # 流式输出的都是完整的 SSE 字节块 (data: ...\n\n)，main 直接发给客户端
         yield True
-        yield "data: " + self.DataHeadler.generate_sse_response(None)
-        content = self.DataHeadler.handle_SSE_data_line(first_chunk)
+        yield ctx.DataHeadler.generate_sse_response(None)
+        content = ctx.DataHeadler.handle_SSE_data_line(first_chunk)
         if content:
-            yield "data: " + content
-
-        DONE = False
-        async for chunk in genData:
-            content = self.DataHeadler.handle_SSE_data_line(chunk)
-            if content:
-                yield "data: " + content
-            if content == "[DONE]":
-                DONE = True
-                continue
-        if not DONE:
-            yield "data: [DONE]"
+            yield content
+
+        DONE = content is SSE_DONE
+        chunks = 1
+        try:
+            async for chunk in genData:
+                content = ctx.DataHeadler.handle_SSE_data_line(chunk)
+                if content:
+                    yield content
+                if content is SSE_DONE:
+                    DONE = True
+                chunks += 1
+            if not DONE:
+                yield SSE_DONE
+        finally:
+            # 流结束时记一次，不在每个数据块上更新指标
+            metrics.stream_chunks_total.inc(*ctx.labels, amount=chunks)
+
+    async def chat2api_passthrough(self, request, pushdata, ctx: RequestContext) -> AsyncGenerator[bytes, None]:
+        """上游和客户端格式相同时直接转发上游的 SSE 字节，DataHeadler 需要实现 handle_SSE_raw"""
+        try:
+            genData = get_api_raw(pushdata, self.http_config, ctx.labels)
+            first_chunk = await genData.__anext__()
+        except Exception as e:
+            logger.error("报错了chat2api %s", e)
+            raise HTTPException(status_code=404, detail=e)
+
+        yield True
+        block = ctx.DataHeadler.handle_SSE_raw(first_chunk)
+        if block:
+            yield block
+        done = block.rstrip().endswith(b"[DONE]")
+        chunks = 1
+        try:
+            async for chunk in genData:
+                block = ctx.DataHeadler.handle_SSE_raw(chunk)
+                # 只带 usage 的块去掉后是空的，不发给客户端
+                if block:
+                    yield block
+                    done = block.rstrip().endswith(b"[DONE]")
+                chunks += 1
+            if not done:
+                yield SSE_DONE
+        finally:
+            metrics.stream_chunks_total.inc(*ctx.labels, amount=chunks)
@@ -1,5 +1,4 @@
 from app.provider.chatInterface import chatInterface
-import copy
 
 class chatManager:
     def __init__(self, default_chat: str =""):
@@ -13,12 +12,13 @@ class chatManager:
     def chat(self, chat_name: str) -> chatInterface:
         if chat_name not in self.chats:
             return None
-        return copy.deepcopy(self.chats[chat_name])
+        # provider 不保存请求状态，直接共享同一个实例，请求状态放在 RequestContext 里
+        return self.chats[chat_name]
 
     def get_chat(self) -> chatInterface:
         if self.current_chat not in self.chats:
             raise ValueError("chat not set")
-        return copy.deepcopy(self.chats[self.current_chat])
+        return self.chats[self.current_chat]
 
 
     
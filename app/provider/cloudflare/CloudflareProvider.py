@@ -3,12 +3,20 @@ import json
 import os
 import time
 from typing import AsyncGenerator
+
 import httpx
+from fastapi import HTTPException
 
 from app.help import load_env
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
+from app.provider.httpxHelp import upstream_clients, raise_for_status
+from app.provider.sseEncoder import get_encoder, SSE_DONE
+from app.provider.streamAccumulator import StreamAccumulator
+from app.provider.tokenCounter import UsageCounter
 from app.log import logger
 
+CLOUDFLARE_API = "https://api.cloudflare.com/client/v4"
+
 
 class CloudflareSendBodyHandler:
     def __init__(self, openai_body):
@@ -22,15 +30,25 @@ class CloudflareSendBodyHandler:
 
 
 class CloudflareSSEHandler:
-    def __init__(self, custom_id=None, model=""):
+    def __init__(self, custom_id=None, model="", accumulate=True):
         self.custom_id = custom_id
         self.model = model
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self.full_message_content = ""
+        self.acc = StreamAccumulator(accumulate)
+        self.usage = UsageCounter(model)  # 上游没有返回 usage 时本地计算
+        self._encoder = None
+
+    def set_usage(self, usage):
+        """部分模型的结果里带 usage"""
+        if usage:
+            self.prompt_tokens = usage.get('prompt_tokens', 0)
+            self.completion_tokens = usage.get('completion_tokens', 0)
+            self.total_tokens = usage.get('total_tokens', 0)
 
     def generate_response(self):
+        self.usage.fill(self)
         return {
             "id": f"chatcmpl-{self.custom_id}",
             "object": "chat.completion",
@@ -41,7 +59,7 @@ class CloudflareSSEHandler:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": self.full_message_content
+                        "content": self.acc.text
                     },
                     "finish_reason": "stop"
                 }
@@ -54,63 +72,75 @@ class CloudflareSSEHandler:
         }
 
     def generate_sse_response(self, content=None):
-        chunk = {
-            "id": f"chatcmpl-{self.custom_id}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": self.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": None
-                }
-            ]
-        }
-
+        encoder = get_encoder(self)
         if content is None:
-            chunk["choices"][0]["delta"] = {"role": "assistant"}
-        elif content == "[DONE]":
-            chunk["choices"][0]["finish_reason"] = "stop"
-        else:
-            chunk["choices"][0]["delta"] = {"content": content}
-
-        return json.dumps(chunk)
+            return encoder.role()
+        if content == "[DONE]":
+            self.usage.fill(self)
+            return encoder.stop(self.prompt_tokens, self.completion_tokens, self.total_tokens)
+        return encoder.content(content)
 
     def handle_sse_data_line(self, line: str):
         return self.generate_sse_response(line)
 
+    def get_stats(self):
+        self.usage.fill(self)
+        return {
+            "full_message_content": self.acc.text,
+            "custom_id": self.custom_id,
+            "model": self.model,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "tool_calls": []
+        }
+
 
 class CloudflareProvider(baseProvider):
-    def __init__(self, api_key: str, account_id: str):
+    def __init__(self, api_key: str, account_id: str, base_url: str = ""):
         super().__init__()
         self.api_key = api_key
         self.account_id = account_id
+        self.base_url = base_url or CLOUDFLARE_API
         self.setDebugSave("cloudflare")
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[str, None]:
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get('model', "")
         logger.name = f"cloudflareProvider.{id}.model.{model}"
 
-        data_handler = CloudflareSSEHandler(id, request_model_name)
+        ctx = ctx or self.new_context(id, request_model_name)
+        data_handler = ctx.DataHeadler = CloudflareSSEHandler(id, request_model_name, ctx.accumulate)
+        data_handler.usage.set_request(request)
 
-        url = f"https://api.cloudflare.com/client/v4/accounts/{self.account_id}/ai/run/{model}"
+        url = f"{self.base_url}/accounts/{self.account_id}/ai/run/{model}"
         send_body = CloudflareSendBodyHandler(request)
         messages = send_body.get_chat_history()
         inputs = {"messages": messages}
         headers = {"Authorization": f"Bearer {self.api_key}"}
 
-        async with httpx.AsyncClient(timeout=120) as client:
-            response = await client.post(url, headers=headers, json=inputs)
-            result = response.json()
-            data_handler.full_message_content = result['result']['response']
+        try:
+            async with upstream_clients.use(url, self.http_config) as client:
+                response = await client.post(url, headers=headers, json=inputs)
+        except httpx.RequestError as e:
+            logger.error(f"网络请求错误: {e} {url}")
+            raise HTTPException(status_code=503, detail={"error": "网络请求错误", "detail": str(e)})
+        # 上游出错时按其他渠道一样抛出带状态码的 HTTPException，可以换渠道重试
+        await raise_for_status({"url": url}, response)
+        result = response.json()
+        # 上游一次返回完整内容，流式输出也要用到，不受 accumulate 影响
+        data_handler.acc.set_text(result['result']['response'])
+        data_handler.set_usage(result['result'].get('usage'))
 
         if not request.get('stream'):
             yield data_handler.generate_response()
         else:
-            for line in data_handler.full_message_content.splitlines():
-                yield "data: " + data_handler.handle_sse_data_line(line)
-            yield "data: " + data_handler.generate_sse_response("[DONE]")
+            yield True
+            yield data_handler.generate_sse_response(None)
+            for line in data_handler.acc.text.splitlines():
+                yield data_handler.handle_sse_data_line(line)
+            yield data_handler.generate_sse_response("[DONE]")
+            yield SSE_DONE
 
 
 if __name__ == "__main__":
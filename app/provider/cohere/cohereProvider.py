@@ -8,8 +8,11 @@ import cohere
 import httpx
 
 from app.help import load_env
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
 from app.log import logger
+from app.provider.sseEncoder import get_encoder, SSE_DONE
+from app.provider.streamAccumulator import StreamAccumulator
+from app.provider.tokenCounter import UsageCounter
 
 
 class cohereSendBodyHeandler:
@@ -40,16 +43,18 @@ class cohereSendBodyHeandler:
 
 
 class cohereSSEHandler:
-    def __init__(self, custom_id=None, model=""):
+    def __init__(self, custom_id=None, model="", accumulate=True):
         self.custom_id = custom_id
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self.full_message_content = ""
         self.model = model
-        self.tool_calls = []  # 新增: 用于存储完整的工具调用信息
+        self.acc = StreamAccumulator(accumulate)  # 完整的内容和工具调用
+        self.usage = UsageCounter(model)  # 流在 stream-end 之前断开时没有 usage，本地计算
+        self._encoder = None
 
     def generate_response(self):
+        tool_calls = self.acc.tool_calls
         chunk = {
             "id": "chatcmpl-" + self.custom_id,
             "object": "chat.completion",
@@ -60,8 +65,8 @@ class cohereSSEHandler:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": self.full_message_content,
-                        "tool_calls": self.tool_calls if self.tool_calls else None
+                        "content": self.acc.text,
+                        "tool_calls": tool_calls if tool_calls else None
                     },
                     "finish_reason": "stop"
                 }
@@ -77,61 +82,27 @@ class cohereSSEHandler:
         return chunk
 
     def generate_sse_response(self, content=None):
-        current_timestamp = int(time.time())
-        chunk = {
-            "id": f"chatcmpl-{self.custom_id}",
-            "object": "chat.completion.chunk",
-            "created": current_timestamp,
-            "model": self.model,
-            "system_fingerprint": None,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "logprobs": None,
-                    "finish_reason": None
-                }
-            ]
-        }
-
-        if content is None:
-            chunk["choices"][0]["delta"] = {"role": "assistant", "content": ""}
-        elif content['type'] == 'content':
-            chunk["choices"][0]["delta"] = {"content": content['content']}
-        elif content['type'] == 'tool_calls':
-            chunk["choices"][0]["delta"] = {"tool_calls": content['function']}
-        elif content['type'] == 'stop':
-            chunk["choices"][0]["delta"] = {}
-            chunk["choices"][0]["finish_reason"] = "stop"
-            chunk["usage"] = {
-                "prompt_tokens": self.prompt_tokens,
-                "completion_tokens": self.completion_tokens,
-                "total_tokens": self.total_tokens,
-            }
-        elif content['type'] == 'end':
-            return "[DONE]"
-        else:
-            return None
-
-        json_data = json.dumps(chunk)
-        return f"{json_data}"
+        return get_encoder(self).encode(content, self.prompt_tokens, self.completion_tokens, self.total_tokens)
 
     def handle_SSE_data_line(self, line: str):
+        self.acc.add_text(line)
+        self.usage.feed(line)
         return self.generate_sse_response({'type': 'content', 'content': line})
 
     def get_stats(self):
+        self.usage.fill(self)
         return {
-            "full_message_content": self.full_message_content,
+            "full_message_content": self.acc.text,
             "custom_id": self.custom_id,
             "model": self.model,
             "prompt_tokens": self.prompt_tokens,
             "completion_tokens": self.completion_tokens,
             "total_tokens": self.total_tokens,
-            "tool_calls": self.tool_calls
+            "tool_calls": self.acc.tool_calls
         }
 
     def handle_data_line(self, line: str):
-        self.full_message_content = line
+        self.acc.set_text(line)
         response = self.generate_response()
         return response
 
@@ -142,10 +113,9 @@ class cohereProvider(baseProvider):
         self.api_key = api_key
         self.base_url = base_url
         self.setDebugSave("cohere")
-        self.DataHeadler = cohereSSEHandler
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[
-        str, None]:
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get('model', "command-r-plus-08-2024")
         logger.name = f"cohereProvider.{id}.model.{model}"
         co = cohere.AsyncClient(
@@ -161,7 +131,9 @@ class cohereProvider(baseProvider):
         sendbody = cohereSendBodyHeandler(request)
         message = sendbody.get_message()
         chat_history = sendbody.get_chat_history()
-        self.DataHeadler = cohereSSEHandler(id, request_model_name)
+        ctx = ctx or self.new_context(id, request_model_name)
+        ctx.DataHeadler = cohereSSEHandler(id, request_model_name, ctx.accumulate)
+        ctx.DataHeadler.usage.set_request(request)
         if not request['stream']:
             chunk = co.chat(
                 message=message,
@@ -172,12 +144,11 @@ class cohereProvider(baseProvider):
                 citation_quality="accurate",
                 # connectors=[{"id": "web-search"}]
             )
-            self.DataHeadler.full_message_content = chunk.text
-            self.DataHeadler.prompt_tokens = chunk.meta.tokens.input_tokens
-            self.DataHeadler.completion_tokens = chunk.meta.tokens.output_tokens
-            self.DataHeadler.total_tokens = chunk.meta.tokens.input_tokens + chunk.meta.tokens.output_tokens
-            self.DataHeadler.tool_calls = None
-            yield self.DataHeadler.generate_response()
+            ctx.DataHeadler.acc.set_text(chunk.text)
+            ctx.DataHeadler.prompt_tokens = chunk.meta.tokens.input_tokens
+            ctx.DataHeadler.completion_tokens = chunk.meta.tokens.output_tokens
+            ctx.DataHeadler.total_tokens = chunk.meta.tokens.input_tokens + chunk.meta.tokens.output_tokens
+            yield ctx.DataHeadler.generate_response()
             return
 
         response = co.chat_stream(
@@ -190,16 +161,19 @@ class cohereProvider(baseProvider):
 #             connectors=[{"id": "web-search"}]
         )
 
+        yield True
+        yield ctx.DataHeadler.generate_sse_response(None)
         async for chunk in response:
             if chunk.event_type == "text-generation":
-                yield "data: " + self.DataHeadler.handle_SSE_data_line(chunk.text)
+                yield ctx.DataHeadler.handle_SSE_data_line(chunk.text)
             elif chunk.event_type == "stream-end":
-                self.DataHeadler.full_message_content = chunk.response.text
-                self.DataHeadler.prompt_tokens = chunk.response.meta.tokens.input_tokens
-                self.DataHeadler.completion_tokens = chunk.response.meta.tokens.output_tokens
-                self.DataHeadler.total_tokens = chunk.response.meta.tokens.input_tokens + chunk.response.meta.tokens.output_tokens
-                self.DataHeadler.tool_calls = None
-                yield "data: [DONE]"
+                if ctx.DataHeadler.acc.enabled:
+                    ctx.DataHeadler.acc.set_text(chunk.response.text)
+                ctx.DataHeadler.prompt_tokens = chunk.response.meta.tokens.input_tokens
+                ctx.DataHeadler.completion_tokens = chunk.response.meta.tokens.output_tokens
+                ctx.DataHeadler.total_tokens = chunk.response.meta.tokens.input_tokens + chunk.response.meta.tokens.output_tokens
+                yield ctx.DataHeadler.generate_sse_response({'type': 'stop'})
+                yield SSE_DONE
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import asyncio
 from typing import AsyncGenerator
 from fastapi import HTTPException
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
 from app.log import logger
 from app.provider.gemini.geminiSSEHandler import geminiSSEHandler as SSEHandler
 from app.provider.openaiSendBodyHeandler import openaiSendBodyHeandler
@@ -13,17 +13,17 @@ class geminiProvider(baseProvider):
         self.api_key = api_key
         self.base_url = base_url
         self.setDebugSave("openai")
-        self.DataHeadler = SSEHandler
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[
-        str, None]:
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get('model', "")
         logger.name = f"openaiProvider.{id}.model.{model}"
         sendReady = openaiSendBodyHeandler(self.api_key, self.base_url, model)
         sendReady.header_openai(request)
         pushdata = sendReady.get_Gemini()  # 改这里
-        self.DataHeadler = SSEHandler(id, request_model_name)
-        async for chunk in self.chat2api_super(request, model, id, pushdata):
+        ctx = ctx or self.new_context(id, request_model_name)
+        ctx.DataHeadler = SSEHandler(id, request_model_name, ctx.accumulate)
+        async for chunk in self.chat2api_super(request, model, id, pushdata, ctx):
             yield chunk
 
 
@@ -1,19 +1,22 @@
 import time
 import ujson as json
 import os
+from app.provider.sseEncoder import get_encoder, SSE_DONE
+from app.provider.streamAccumulator import StreamAccumulator
 
 
 class geminiSSEHandler:
-    def __init__(self, custom_id=None, model=""):
+    def __init__(self, custom_id=None, model="", accumulate=True):
         self.custom_id = custom_id
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self.full_message_content = ""
         self.model = model
-        self.tool_calls = []  # 新增: 用于存储完整的工具调用信息
+        self.acc = StreamAccumulator(accumulate)  # 完整的内容和工具调用
+        self._encoder = None
 
     def generate_response(self):
+        tool_calls = self.acc.tool_calls
         chunk = {
             "id": "chatcmpl-"+self.custom_id,
             "object": "chat.completion",
@@ -24,8 +27,8 @@ class geminiSSEHandler:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": self.full_message_content,
-                        "tool_calls": self.tool_calls if self.tool_calls else None
+                        "content": self.acc.text,
+                        "tool_calls": tool_calls if tool_calls else None
                     },
                     "finish_reason": "stop"
                 }
@@ -41,51 +44,14 @@ class geminiSSEHandler:
         return chunk
 
     def generate_sse_response(self, content=None):
-        current_timestamp = int(time.time())
-        chunk = {
-            "id": f"chatcmpl-{self.custom_id}",
-            "object": "chat.completion.chunk",
-            "created": current_timestamp,
-            "model": self.model,
-            "system_fingerprint": None,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "logprobs": None,
-                    "finish_reason": None
-                }
-            ]
-        }
-
-        if content is None:
-            chunk["choices"][0]["delta"] = {"role": "assistant", "content": ""}
-        elif content['type'] == 'content':
-            chunk["choices"][0]["delta"] = {"content": content['content']}
-        elif content['type'] == 'tool_calls':
-            chunk["choices"][0]["delta"] = {"tool_calls": content['function']}
-        elif content['type'] == 'stop':
-            chunk["choices"][0]["delta"] = {}
-            chunk["choices"][0]["finish_reason"] = "stop"
-            chunk["usage"] = {
-                "prompt_tokens": self.prompt_tokens,
-                "completion_tokens": self.completion_tokens,
-                "total_tokens": self.total_tokens,
-            }
-        elif content['type'] == 'end':
-            return "[DONE]"
-        else:
-            return None
-
-        json_data = json.dumps(chunk)
-        return f"{json_data}"
+        return get_encoder(self).encode(content, self.prompt_tokens, self.completion_tokens, self.total_tokens)
 
     def handle_SSE_data_line(self, line: str):
         if line.startswith("data:"):
             line = line[5:].strip()
         line = line.strip()
         if line == "[DONE]":
-            return "[DONE]"
+            return SSE_DONE
         if line == "":
             return None
 
@@ -106,19 +72,20 @@ class geminiSSEHandler:
                     if 'text' in part:
                         response_data['type'] = 'content'
                         response_data['content'] = part['text']
-                        self.full_message_content += response_data['content']
+                        self.acc.add_text(response_data['content'])
                     elif 'functionCall' in part:
                         response_data['type'] = 'tool_calls'
                         function_call = part['functionCall']
                         tool_call = {
-                            "id": f"call_{len(self.tool_calls)}",
+                            "index": self.acc.next_tool_index,
+                            "id": f"call_{self.acc.next_tool_index}",
                             "type": "function",
                             "function": {
                                 "name": function_call.get('name'),
                                 "arguments": json.dumps(function_call.get('args', {}))
                             }
                         }
-                        self.tool_calls.append(tool_call)
+                        self.acc.add_tool_call(tool_call)
                         response_data['function'] = [tool_call]
                 elif finish_reason == 'STOP':
                     response_data['type'] = 'stop'
@@ -140,45 +107,15 @@ class geminiSSEHandler:
             print(f"gemini handle_SSE_data_line \r\n处理失败: {e}\r\n失败内容:{line}\r\n")
             return None
 
-    def _update_tool_calls(self, new_tool_calls):
-        for new_call in new_tool_calls:
-            call_id = new_call.get('id')
-            if call_id:
-                existing_call = next((call for call in self.tool_calls if call.get('id') == call_id), None)
-                if existing_call:
-                    self._merge_tool_call(existing_call, new_call)
-                else:
-                    self.tool_calls.append(new_call)
-            else:
-                # 如果新的 tool call 没有 id，我们更新最后一个 tool call
-                if self.tool_calls:
-                    self._merge_tool_call(self.tool_calls[-1], new_call)
-                else:
-                    self.tool_calls.append(new_call)
-
-    def _merge_tool_call(self, existing_call, new_call):
-        for key, value in new_call.items():
-            if key == 'function':
-                if 'function' not in existing_call:
-                    existing_call['function'] = {}
-                for func_key, func_value in value.items():
-                    if func_key == 'arguments':
-                        existing_call['function']['arguments'] = existing_call['function'].get('arguments',
-                                                                                               '') + func_value
-                    else:
-                        existing_call['function'][func_key] = func_value
-            else:
-                existing_call[key] = value
-
     def get_stats(self):
         return {
-            "full_message_content": self.full_message_content,
+            "full_message_content": self.acc.text,
             "custom_id": self.custom_id,
             "model": self.model,
             "prompt_tokens": self.prompt_tokens,
             "completion_tokens": self.completion_tokens,
             "total_tokens": self.total_tokens,
-            "tool_calls": self.tool_calls
+            "tool_calls": self.acc.tool_calls
         }
 
     def handle_data_line(self, line: str):
@@ -203,9 +140,9 @@ class geminiSSEHandler:
                                 "arguments": json.dumps(function_call.get('args', {}))
                             }
                         }
-                        self.tool_calls.append(tool_call)
+                        self.acc.add_tool_call(tool_call, force=True)
                     elif 'text' in part:
-                        self.full_message_content += part['text']
+                        self.acc.add_text(part['text'])
 
                 # 设置role
                 role = content.get('role', 'assistant')
@@ -1,15 +1,187 @@
 import hashlib
+import importlib.util
 import json
 import re
-from typing import AsyncGenerator
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Dict, Optional
 from fastapi import HTTPException
 import httpx
+from app import metrics
 from app.log import logger
 from app.api_data import db
+from app.provider.sseFramer import aiter_sse, aiter_sse_blocks
 
 if db.config_server.get("admin_server", False):
     from app.db.logDB import CacheManager
-    cacheManager = CacheManager()
+    from app.db.responseCache import ResponseCache, canonical_cache_key
+    response_cache = ResponseCache(
+        CacheManager(),
+        ttl=db.config_server.get("db_cache_ttl", 86400),
+        memory_bytes=int(db.config_server.get("db_cache_memory_mb", 64) * 1024 * 1024),
+    )
+
+DEFAULT_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "*/*",
+    "User-Agent": "curl/7.68.0",
+}
+
+# 连接池默认参数 可以在 api.yaml 的 server.http 或者 provider 的 http 里覆盖
+DEFAULT_HTTP_CONFIG = {
+    "http2": False,
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "timeout": {"connect": 120.0, "read": 600.0, "write": 120.0, "pool": 120.0},
+    "verify": False,
+}
+
+HAS_H2 = importlib.util.find_spec("h2") is not None
+
+
+class _PoolEntry:
+    def __init__(self, origin: str, options: Dict, client: httpx.AsyncClient):
+        self.origin = origin
+        self.options = options
+        self.client = client
+        self.requests = 0
+        self.in_flight = 0
+
+
+class UpstreamClientPool:
+    """按上游 origin 复用 httpx.AsyncClient，避免每个请求都重新 DNS 解析和 TCP+TLS 握手"""
+
+    def __init__(self, defaults: Optional[Dict] = None):
+        self.defaults = {}
+        self.entries: Dict[tuple, _PoolEntry] = {}
+        self.configure(defaults)
+
+    def configure(self, defaults: Optional[Dict] = None):
+        """设置全局默认参数 (server.http)，已创建的连接池不受影响"""
+        self.defaults = dict(defaults or {})
+
+    def _options(self, http_config: Optional[Dict] = None) -> Dict:
+        options = {**DEFAULT_HTTP_CONFIG, **self.defaults, **(http_config or {})}
+        timeout = options.get("timeout")
+        if isinstance(timeout, dict):
+            options["timeout"] = {**DEFAULT_HTTP_CONFIG["timeout"], **timeout}
+        if options["http2"] and not HAS_H2:
+            logger.warning("配置了 http2 但没有安装 h2 (pip install httpx[http2])，使用 http/1.1")
+            options["http2"] = False
+        return options
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        u = httpx.URL(url)
+        port = f":{u.port}" if u.port else ""
+        return f"{u.scheme}://{u.host}{port}"
+
+    def _entry(self, url: str, http_config: Optional[Dict] = None) -> _PoolEntry:
+        options = self._options(http_config)
+        origin = self._origin(url)
+        key = (origin, json.dumps(options, sort_keys=True))
+        entry = self.entries.get(key)
+        if entry is None or entry.client.is_closed:
+            timeout = options["timeout"]
+            if isinstance(timeout, dict):
+                timeout = httpx.Timeout(**timeout)
+            client = httpx.AsyncClient(
+                headers=DEFAULT_HEADERS,
+                timeout=timeout,
+                verify=options["verify"],
+                http2=options["http2"],
+                limits=httpx.Limits(
+                    max_connections=options["max_connections"],
+                    max_keepalive_connections=options["max_keepalive_connections"],
+                    keepalive_expiry=options["keepalive_expiry"],
+                ),
+            )
+            entry = _PoolEntry(origin, options, client)
+            self.entries[key] = entry
+            logger.info(f"创建上游连接池 {origin} http2:{options['http2']} max_connections:{options['max_connections']}")
+        return entry
+
+    def get_client(self, url: str, http_config: Optional[Dict] = None) -> httpx.AsyncClient:
+        return self._entry(url, http_config).client
+
+    @asynccontextmanager
+    async def use(self, url: str, http_config: Optional[Dict] = None):
+        """取出 url 对应的长连接客户端，并记录请求数和正在进行的请求数"""
+        entry = self._entry(url, http_config)
+        entry.requests += 1
+        entry.in_flight += 1
+        try:
+            yield entry.client
+        finally:
+            entry.in_flight -= 1
+
+    def stats(self):
+        data = []
+        for entry in self.entries.values():
+            pool = getattr(getattr(entry.client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []) or [])
+            idle = sum(1 for conn in connections if conn.is_idle())
+            data.append({
+                "origin": entry.origin,
+                "http2": entry.options["http2"],
+                "max_connections": entry.options["max_connections"],
+                "max_keepalive_connections": entry.options["max_keepalive_connections"],
+                "connections": len(connections),
+                "idle_connections": idle,
+                "active_connections": len(connections) - idle,
+                "requests": entry.requests,
+                "in_flight": entry.in_flight,
+            })
+        return data
+
+    async def aclose(self):
+        entries, self.entries = self.entries, {}
+        for entry in entries.values():
+            await entry.client.aclose()
+
+
+upstream_clients = UpstreamClientPool(db.config_server.get("http", {}))
+
+
+def _pool_usage():
+    for item in upstream_clients.stats():
+        yield (item["origin"], "active"), item["active_connections"]
+        yield (item["origin"], "idle"), item["idle_connections"]
+        yield (item["origin"], "max"), item["max_connections"]
+        yield (item["origin"], "in_flight"), item["in_flight"]
+
+
+metrics.REGISTRY.gauge_func("proapi_upstream_pool_connections", "上游连接池的连接数和正在进行的请求数",
+                            ("origin", "state"), _pool_usage)
+
+
+class ConnectTimer:
+    """httpcore 的 trace 回调，只记录新建连接的 TCP+TLS 耗时，复用连接时 seconds 为 None"""
+    __slots__ = ("start", "seconds")
+
+    def __init__(self):
+        self.start = 0.0
+        self.seconds = None
+
+    async def __call__(self, name, info):
+        if name == "connection.connect_tcp.started":
+            self.start = time.perf_counter()
+        elif name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.seconds = time.perf_counter() - self.start
+
+
+def trace_extensions(labels):
+    """labels 为 None 时不挂 trace 回调，调用方没有渠道信息 (比如 merlin 的辅助请求)"""
+    if labels is None:
+        return None, None
+    timer = ConnectTimer()
+    return timer, {"trace": timer}
+
+
+def observe_connect(timer, labels):
+    if timer is not None and timer.seconds is not None:
+        metrics.upstream_connect_seconds.observe(timer.seconds, *labels)
 
 async def raise_for_status(sendReady, response: httpx.Response):
     if response.status_code == 200:
@@ -30,34 +202,46 @@ async def raise_for_status(sendReady, response: httpx.Response):
     }
     raise HTTPException(status_code=500, detail=error_data)
 
-async def get_api_data(sendReady) -> AsyncGenerator[str, None]:
-    async with httpx.AsyncClient(
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "*/*",
-            "User-Agent": "curl/7.68.0",
-        },
-        timeout=httpx.Timeout(connect=120.0, read=600, write=120.0, pool=120.0),
-        verify=False,
-    ) as client:
+async def get_api_data(sendReady, http_config=None, labels=None) -> AsyncGenerator[str, None]:
+    timer, extensions = trace_extensions(labels)
+    async with upstream_clients.use(sendReady["url"], http_config) as client:
         try:
             if sendReady["stream"]:
                 async with client.stream("POST", sendReady["url"], headers=sendReady["headers"],
-                                         json=sendReady["body"]) as response:
+                                         json=sendReady["body"], extensions=extensions) as response:
+                    observe_connect(timer, labels)
                     await raise_for_status(sendReady, response)
-                    buffer = ""
-                    async for chunk in response.aiter_text():
-                        buffer += chunk
-                        while '\n' in buffer:
-                            line, buffer = buffer.split('\n', 1)
-                            line = line.strip()
-                            if line.startswith('data:'):
-                                yield line
+                    async for event in aiter_sse(response.aiter_bytes()):
+                        yield "data: " + event.data
             else:
-                response = await client.post(sendReady["url"], headers=sendReady["headers"], json=sendReady["body"])
+                response = await client.post(sendReady["url"], headers=sendReady["headers"], json=sendReady["body"],
+                                             extensions=extensions)
+                observe_connect(timer, labels)
                 await raise_for_status(sendReady, response)
                 response_text = response.content.decode("utf-8")
                 yield response_text
+        except HTTPException:
+            raise
+        except httpx.RequestError as e:
+            logger.error(f"网络请求错误: {e} {sendReady}")
+            raise HTTPException(status_code=503, detail={"error": "网络请求错误", "detail": str(e)})
+        except Exception as e:
+            logger.error(f"未知错误: {e} {sendReady}")
+            raise HTTPException(status_code=500, detail={"error": "上游服务器出现未知错误", "detail": str(e)})
+
+async def get_api_raw(sendReady, http_config=None, labels=None) -> AsyncGenerator[bytes, None]:
+    """流式请求，按完整事件块原样返回上游的 SSE 字节，用于格式相同的上游直接转发"""
+    timer, extensions = trace_extensions(labels)
+    async with upstream_clients.use(sendReady["url"], http_config) as client:
+        try:
+            async with client.stream("POST", sendReady["url"], headers=sendReady["headers"],
+                                     json=sendReady["body"], extensions=extensions) as response:
+                observe_connect(timer, labels)
+                await raise_for_status(sendReady, response)
+                async for block in aiter_sse_blocks(response.aiter_bytes()):
+                    yield block
+        except HTTPException:
+            raise
         except httpx.RequestError as e:
             logger.error(f"网络请求错误: {e} {sendReady}")
             raise HTTPException(status_code=503, detail={"error": "网络请求错误", "detail": str(e)})
@@ -65,71 +249,61 @@ async def get_api_data(sendReady) -> AsyncGenerator[str, None]:
             logger.error(f"未知错误: {e} {sendReady}")
             raise HTTPException(status_code=500, detail={"error": "上游服务器出现未知错误", "detail": str(e)})
 
-async def get_api_data_cache(sendReady) -> AsyncGenerator[str, None]:
-    cache_md5 = hashlib.md5(json.dumps(sendReady['body']).encode('utf-8')).hexdigest()
-    cache = cacheManager.get_from_cache(cache_md5)
-    if cache:
-        logger.info(f"命中缓存 {cache_md5} 次数: {cache.hit_count}")
+async def get_api_data_cache(sendReady, http_config=None, labels=None) -> AsyncGenerator[str, None]:
+    cache_md5 = canonical_cache_key(sendReady["url"], sendReady["body"])
+    cache = await response_cache.get(cache_md5)
+    if cache is not None:
+        metrics.cache_requests_total.inc("hit")
+        logger.info(f"命中缓存 {cache_md5}")
         if sendReady["stream"]:
-            data = cache.resp
-            arr = data.split("\r\n")
-            for line in arr:
+            for line in cache.split("\r\n"):
                 line = line.strip()
                 if line != "":
                     yield line
         else:
-            yield cache.resp
+            yield cache
         return
 
+    metrics.cache_requests_total.inc("miss")
     logger.info(f"没有命中缓存 {cache_md5}")
-    cacheData = ""
+    parts = []
+    timer, extensions = trace_extensions(labels)
     try:
         if sendReady["stream"]:
-            async with httpx.AsyncClient(
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "*/*",
-                    "User-Agent": "curl/7.68.0",
-                },
-                timeout=httpx.Timeout(connect=120.0, read=600, write=120.0, pool=120.0),
-                verify=False,
-            ) as client:
+            async with upstream_clients.use(sendReady["url"], http_config) as client:
                 async with client.stream("POST", sendReady["url"], headers=sendReady["headers"],
-                                         json=sendReady["body"]) as response:
+                                         json=sendReady["body"], extensions=extensions) as response:
+                    observe_connect(timer, labels)
                     await raise_for_status(sendReady, response)
-                    buffer = ""
-                    async for chunk in response.aiter_text():
-                        buffer += chunk
-                        while '\n' in buffer:
-                            line, buffer = buffer.split('\n', 1)
-                            line = line.strip()
-                            if line.startswith('data:'):
-                                cacheData += line + "\r\n"
-                                yield line
+                    async for event in aiter_sse(response.aiter_bytes()):
+                        # 和调试缓存一样保留 data: 前缀
+                        line = "data: " + event.data
+                        parts.append(line)
+                        yield line
         else:
-            response = await httpx.AsyncClient(
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "*/*",
-                    "User-Agent": "curl/7.68.0",
-                },
-                timeout=httpx.Timeout(connect=120.0, read=600, write=120.0, pool=120.0),
-                verify=False,
-            ).post(sendReady["url"], headers=sendReady["headers"], json=sendReady["body"])
+            async with upstream_clients.use(sendReady["url"], http_config) as client:
+                response = await client.post(sendReady["url"], headers=sendReady["headers"], json=sendReady["body"],
+                                             extensions=extensions)
+            observe_connect(timer, labels)
             await raise_for_status(sendReady, response)
             response_text = response.content.decode("utf-8")
-            cacheData = response_text
+            # 非流式的调用方只取一次结果不会把生成器走完，拿到完整响应就保存
+            logger.info(f"缓存保存 {cache_md5}")
+            response_cache.set(cache_md5, json.dumps(sendReady["body"], ensure_ascii=False), response_text)
             yield response_text
+    except HTTPException:
+        raise
     except httpx.RequestError as e:
         logger.error(f"网络请求错误: {e} {sendReady}")
         raise HTTPException(status_code=503, detail={"error": "网络请求错误", "detail": str(e)})
     except Exception as e:
         logger.error(f"未知错误: {e} {sendReady}")
         raise HTTPException(status_code=500, detail={"error": "上游服务器出现未知错误", "detail": str(e)})
-    finally:
-        if cacheData:
-            logger.info(f"缓存保存 {cache_md5}")
-            cacheManager.add_to_cache(cache_md5, json.dumps(sendReady["body"]), cacheData)
+
+    # 只缓存完整成功的流式响应，出错或者客户端中途断开都不会走到这里
+    if parts:
+        logger.info(f"缓存保存 {cache_md5}")
+        response_cache.set(cache_md5, json.dumps(sendReady["body"], ensure_ascii=False), "\r\n".join(parts))
 
 
 def get_api_data2(sendReady):
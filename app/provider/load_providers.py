@@ -25,6 +25,8 @@ def load_providers(db):
 
         if provider == "openai":
             chat = openaiProvider(providerConfig.get("api_key", ""), providerConfig.get("base_url", ""))
+            chat.setPassthrough(providerConfig.get("passthrough", db.config_server.get("passthrough", True)))
+            chat.setIncludeUsage(providerConfig.get("include_usage", db.config_server.get("include_usage", False)))
         elif provider == "gemini":
             chat = geminiProvider(providerConfig.get("api_key", ""), providerConfig.get("base_url", ""))
         elif provider == "vertexai_gemini":
@@ -39,23 +41,26 @@ def load_providers(db):
                 providerConfig.get("PROJECT_ID", ""),
                 providerConfig.get("CLIENT_ID", ""),
                 providerConfig.get("CLIENT_SECRET", ""),
-                providerConfig.get("REFRESH_TOKEN", "")
+                providerConfig.get("REFRESH_TOKEN", ""),
+                providerConfig.get("base_url") or "",
+                providerConfig.get("token_url", "")
             )
         elif provider == "cohere":
             from app.provider.cohere.cohereProvider import cohereProvider
             chat = cohereProvider(providerConfig.get("api_key", ""), providerConfig.get("base_url", ""))
         elif provider == "cloudflare":
             from app.provider.cloudflare.CloudflareProvider import CloudflareProvider
-            chat = CloudflareProvider(providerConfig.get("api_key", ""), providerConfig.get("account_id", ""))
+            chat = CloudflareProvider(providerConfig.get("api_key", ""), providerConfig.get("account_id", ""),
+                                      providerConfig.get("base_url") or "")
         elif provider == "merlin":
             from app.provider.merlin.merlinProvider import merlinProvider
             api_key = providerConfig.get("api_key", "")
             chat = merlinProvider(api_key)
 
-
         if not chat:
             logger.info(f"未知的提供商类型: {provider}")
             continue
+        chat.setHttpConfig(providerConfig.get("http", {}))
         # 生成唯一的名称
         logger.info(f"添加提供商: {name}")
         # 将聊天实例添加到 ai_manager
@@ -4,7 +4,7 @@ import pyefun
 
 from app.provider.httpxHelp import get_api_data
 
-async def send_merlin_request(api_key, content, model):
+async def send_merlin_request(api_key, content, model, http_config=None):
     url = 'https://arcane.getmerlin.in/v1/thread/unified'
     headers = {
         'authority': 'arcane.getmerlin.in',
@@ -39,7 +39,7 @@ async def send_merlin_request(api_key, content, model):
         "body": body,
         "stream": True
     }
-    async for chunk in get_api_data(senddata):
+    async for chunk in get_api_data(senddata, http_config):
         yield chunk
 
 
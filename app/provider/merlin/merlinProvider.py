@@ -3,9 +3,12 @@ import json
 import time
 from typing import AsyncGenerator
 
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
 from app.log import logger
 from app.provider.merlin.merlin import send_merlin_request
+from app.provider.sseEncoder import get_encoder, SSE_DONE
+from app.provider.streamAccumulator import StreamAccumulator
+from app.provider.tokenCounter import UsageCounter
 
 class merlinSendBodyHeandler:
     def __init__(self, openai_body):
@@ -39,16 +42,19 @@ class merlinSendBodyHeandler:
 
 
 class merlinSSEHandler:
-    def __init__(self, custom_id=None, model=""):
+    def __init__(self, custom_id=None, model="", accumulate=True):
         self.custom_id = custom_id
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self.full_message_content = ""
         self.model = model
-        self.tool_calls = []  # 新增: 用于存储完整的工具调用信息
+        self.acc = StreamAccumulator(accumulate)  # 完整的内容和工具调用
+        self.usage = UsageCounter(model)  # 上游不返回 usage，本地计算
+        self._encoder = None
 
     def generate_response(self):
+        self.usage.fill(self)
+        tool_calls = self.acc.tool_calls
         chunk = {
             "id": "chatcmpl-" + self.custom_id,
             "object": "chat.completion",
@@ -59,8 +65,8 @@ class merlinSSEHandler:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": self.full_message_content,
-                        "tool_calls": self.tool_calls if self.tool_calls else None
+                        "content": self.acc.text,
+                        "tool_calls": tool_calls if tool_calls else None
                     },
                     "finish_reason": "stop"
                 }
@@ -76,44 +82,7 @@ class merlinSSEHandler:
         return chunk
 
     def generate_sse_response(self, content=None):
-        current_timestamp = int(time.time())
-        chunk = {
-            "id": f"chatcmpl-{self.custom_id}",
-            "object": "chat.completion.chunk",
-            "created": current_timestamp,
-            "model": self.model,
-            "system_fingerprint": None,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "logprobs": None,
-                    "finish_reason": None
-                }
-            ]
-        }
-
-        if content is None:
-            chunk["choices"][0]["delta"] = {"role": "assistant", "content": ""}
-        elif content['type'] == 'content':
-            chunk["choices"][0]["delta"] = {"content": content['content']}
-        elif content['type'] == 'tool_calls':
-            chunk["choices"][0]["delta"] = {"tool_calls": content['function']}
-        elif content['type'] == 'stop':
-            chunk["choices"][0]["delta"] = {}
-            chunk["choices"][0]["finish_reason"] = "stop"
-            chunk["usage"] = {
-                "prompt_tokens": self.prompt_tokens,
-                "completion_tokens": self.completion_tokens,
-                "total_tokens": self.total_tokens,
-            }
-        elif content['type'] == 'end':
-            return "[DONE]"
-        else:
-            return None
-
-        json_data = json.dumps(chunk)
-        return f"{json_data}"
+        return get_encoder(self).encode(content, self.prompt_tokens, self.completion_tokens, self.total_tokens)
 
     def handle_SSE_data_line(self, line: str):
         # {"status":"success","data":{"content":"好的"}}
@@ -122,7 +91,7 @@ class merlinSSEHandler:
             line = line[5:].strip()
         line = line.strip()
         if line == "[DONE]":
-            return "[DONE]"
+            return SSE_DONE
         if line == "":
             return None
 
@@ -131,9 +100,11 @@ class merlinSSEHandler:
             content = data.get('data', {}).get('content', '')
             eventType = data.get('data', {}).get('eventType', '')
             if content != "":
-                self.full_message_content += content
+                self.acc.add_text(content)
+                self.usage.feed(content)
                 return self.generate_sse_response({"type": "content", "content": content})
             if eventType == "DONE":
+                self.usage.fill(self)
                 return self.generate_sse_response({"type": "stop"})
 
             return None
@@ -145,18 +116,19 @@ class merlinSSEHandler:
             return None
 
     def get_stats(self):
+        self.usage.fill(self)
         return {
-            "full_message_content": self.full_message_content,
+            "full_message_content": self.acc.text,
             "custom_id": self.custom_id,
             "model": self.model,
             "prompt_tokens": self.prompt_tokens,
             "completion_tokens": self.completion_tokens,
             "total_tokens": self.total_tokens,
-            "tool_calls": self.tool_calls
+            "tool_calls": self.acc.tool_calls
         }
 
     def handle_data_line(self, line: str):
-        self.full_message_content = line
+        self.acc.set_text(line)
         response = self.generate_response()
         return response
 
@@ -166,33 +138,39 @@ class merlinProvider(baseProvider):
         super().__init__()
         self.api_key = api_key
         self.setDebugSave("merlin")
-        self.DataHeadler = merlinSSEHandler
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[
-        str, None]:
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get("model","")
         stream = request.get('stream', False)
         logger.name = f"merlinProvider.{id}.model.{model}"
 
         sendbody = merlinSendBodyHeandler(request)
         message = sendbody.get_message()
-        self.DataHeadler = merlinSSEHandler(id, request_model_name)
+        ctx = ctx or self.new_context(id, request_model_name)
+        ctx.DataHeadler = merlinSSEHandler(id, request_model_name, ctx.accumulate)
+        ctx.DataHeadler.usage.set_request(request)
         logger.info(f"model:{ model}",)
 
 
-        response = send_merlin_request(self.api_key, message, model)
+        response = send_merlin_request(self.api_key, message, model, self.http_config)
 
         if not stream:
             async for chunk in response:
-                self.DataHeadler.handle_SSE_data_line(chunk)
-            yield self.DataHeadler.generate_response()
+                ctx.DataHeadler.handle_SSE_data_line(chunk)
+            yield ctx.DataHeadler.generate_response()
             return
 
         yield True
+        yield ctx.DataHeadler.generate_sse_response(None)
+        done = False
         async for chunk in response:
-            out = self.DataHeadler.handle_SSE_data_line(chunk)
+            out = ctx.DataHeadler.handle_SSE_data_line(chunk)
             if out:
-                yield "data: " + out
+                yield out
+                done = done or out is SSE_DONE
+        if not done:
+            yield SSE_DONE
 
 
 if __name__ == "__main__":
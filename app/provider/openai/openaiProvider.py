@@ -1,6 +1,6 @@
 import asyncio
 from typing import AsyncGenerator
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
 from app.log import logger
 from app.provider.openaiSSEHandler import openaiSSEHandler as SSEHandler  # 改这里
 from app.provider.openaiSendBodyHeandler import openaiSendBodyHeandler
@@ -12,18 +12,39 @@ class openaiProvider(baseProvider):
         self.base_url = base_url
         # 检查base_url 最后是/就删除
         self.base_url = self.base_url.rstrip("/")
+        self.passthrough = True
+        self.include_usage = False
         self.setDebugSave("openai")
-        self.DataHeadler = SSEHandler
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[
-        str, None]:
+    def setPassthrough(self, passthrough=True):
+        """流式请求直接转发上游的 SSE 字节，只替换 model 字段"""
+        self.passthrough = passthrough
+
+    def setIncludeUsage(self, include_usage=True):
+        """客户端没有要求时也给上游加上 stream_options.include_usage，只对确认支持这个参数的上游开启"""
+        self.include_usage = include_usage
+
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get('model', "")
         logger.name = f"openaiProvider.{id}.model.{model}"
         sendReady = openaiSendBodyHeandler(self.api_key, self.base_url, model)
         sendReady.header_openai(request)
         pushdata = sendReady.get_oepnai()  # 改这里
-        self.DataHeadler = SSEHandler(id, request_model_name)
-        async for chunk in self.chat2api_super(request, request_model_name, id, pushdata):
+        ctx = ctx or self.new_context(id, request_model_name)
+        ctx.DataHeadler = SSEHandler(id, request_model_name, ctx.accumulate)
+        ctx.DataHeadler.usage.set_request(request)
+        replay = ctx.debug or ctx.cache or ctx.db_cache
+        # 请求体是缓存的键，调试回放和数据库缓存时不改
+        if self.include_usage and request.get("stream", False) and not request.get("stream_options") and not replay:
+            pushdata["body"] = {**pushdata["body"], "stream_options": {"include_usage": True}}
+            ctx.DataHeadler.hide_usage = True
+        # 调试回放和数据库缓存保存的是解析后的行，走原来的流程
+        if self.passthrough and request.get("stream", False) and not replay:
+            async for chunk in self.chat2api_passthrough(request, pushdata, ctx):
+                yield chunk
+            return
+        async for chunk in self.chat2api_super(request, request_model_name, id, pushdata, ctx):
             yield chunk
 
 
@@ -1,22 +1,40 @@
+import re
 import time
 
 import pyefun
 import ujson as json
 import os
+from app.provider.sseEncoder import get_encoder, SSE_DONE
+from app.provider.streamAccumulator import StreamAccumulator
+from app.provider.tokenCounter import UsageCounter
+
+MODEL_FIELD = re.compile(rb'"model"\s*:\s*"(?:[^"\\]|\\.)*"')
+CONTENT_FIELD = re.compile(rb'"content"\s*:\s*"((?:[^"\\]|\\.)*)"')
+# stream_options.include_usage 在最后单独发一个 choices 为空、只带 usage 的块
+USAGE_EVENT = re.compile(rb'data:[^\r\n]*"choices"\s*:\s*\[\s*\][^\r\n]*(?:\r?\n){1,2}')
+USAGE_OBJECT = re.compile(rb'"usage"\s*:\s*\{')
 
 
 class openaiSSEHandler:
-    def __init__(self, custom_id=None, model=""):
+    def __init__(self, custom_id=None, model="", accumulate=True):
         self.custom_id = custom_id
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self.full_message_content = ""
         self.model = model
-        self.tool_calls = []  # 新增: 用于存储完整的工具调用信息
+        self.acc = StreamAccumulator(accumulate)  # 完整的内容和工具调用
+        self.usage = UsageCounter(model)  # 上游没有返回 usage 时本地计算
+        self.hide_usage = False  # include_usage 是代理加上的，只带 usage 的块不转发给客户端
+        self._encoder = None
+        # 直接转发模式: 转发的字节块先存起来，统计时再一次性扫描
+        self._raw_model = None
+        self._upstream_model = None
+        self._raw_blocks = []
 
 
     def generate_response(self):
+        content = self.acc.text
+        tool_calls = self.acc.tool_calls
         chunk = {
             "id": "chatcmpl-"+self.custom_id,
             "object": "chat.completion",
@@ -27,8 +45,8 @@ class openaiSSEHandler:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": self.full_message_content,
-                        "tool_calls": self.tool_calls if self.tool_calls else None
+                        "content": content,
+                        "tool_calls": tool_calls if tool_calls else None
                     },
                     "finish_reason": "stop"
                 }
@@ -44,48 +62,11 @@ class openaiSSEHandler:
         return chunk
     
     def generate_sse_response(self, content=None):
-        current_timestamp = int(time.time())
-        chunk = {
-            "id": f"chatcmpl-{self.custom_id}",
-            "object": "chat.completion.chunk",
-            "created": current_timestamp,
-            "model": self.model,
-            "system_fingerprint": None,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "logprobs": None,
-                    "finish_reason": None
-                }
-            ]
-        }
-
-        if content is None:
-            chunk["choices"][0]["delta"] = {"role": "assistant", "content": ""}
-        elif content['type'] == 'content':
-            chunk["choices"][0]["delta"] = {"content": content['content']}
-        elif content['type'] == 'tool_calls':
-            chunk["choices"][0]["delta"] = {"tool_calls": content['function']}
-        elif content['type'] == 'stop':
-            chunk["choices"][0]["delta"] = {}
-            chunk["choices"][0]["finish_reason"] = "stop"
-            chunk["usage"] = {
-                "prompt_tokens": self.prompt_tokens,
-                "completion_tokens": self.completion_tokens,
-                "total_tokens": self.total_tokens,
-            }
-        elif content['type'] == 'end':
-            return "[DONE]"
-        else:
-            return None
-
-        json_data = json.dumps(chunk)
-        return f"{json_data}"
+        return get_encoder(self).encode(content, self.prompt_tokens, self.completion_tokens, self.total_tokens)
 
     def handle_SSE_data_line(self, line: str):
         if line.strip() == "data: [DONE]":
-            return "[DONE]"
+            return SSE_DONE
 
         if not line or line.isspace():
             return ""
@@ -95,7 +76,7 @@ class openaiSSEHandler:
             line = line[5:].strip()
 
         if line == "[DONE]":
-            return "[DONE]"
+            return SSE_DONE
 
         try:
             json_data = json.loads(line)
@@ -103,6 +84,10 @@ class openaiSSEHandler:
             # id = json_data.get('id', '')
             # self.model = json_data.get('model', '')
             choices = json_data.get('choices', [{}])
+            if self.hide_usage and not choices and json_data.get('usage'):
+                # 代理加上的 include_usage，只记录 usage，不发给客户端
+                self._set_usage(json_data['usage'])
+                return None
 
             if choices:
                 delta = choices[0].get('delta', {})
@@ -112,17 +97,19 @@ class openaiSSEHandler:
                 finish_reason = None
 
             response_data = {}
-            if 'content' in delta:
-                response_data['type'] = 'content'
-                response_data['content'] = delta['content']
-                self.full_message_content += delta['content']
-            elif 'tool_calls' in delta:
+            if delta.get('tool_calls'):
                 response_data['type'] = 'tool_calls'
                 response_data['function'] = delta['tool_calls']
-                self._update_tool_calls(delta['tool_calls'])
+                for tool_call in delta['tool_calls']:
+                    self.acc.add_tool_call_delta(tool_call)
+            elif 'content' in delta:
+                response_data['type'] = 'content'
+                response_data['content'] = delta['content']
+                self.acc.add_text(delta['content'])
             elif finish_reason == 'tool_calls':
-                response_data['type'] = 'tool_calls'
-                response_data['function'] = self.tool_calls
+                # 工具调用的增量已经发过了，这里只发结束原因
+                response_data['type'] = 'stop'
+                response_data['finish_reason'] = 'tool_calls'
             elif finish_reason == 'stop':
                 response_data['type'] = 'stop'
             else:
@@ -132,9 +119,7 @@ class openaiSSEHandler:
             # 检查有没有 usage 如果有就读取 然后更新到 self.prompt_tokens 和 self.completion_tokens 和 self.total_tokens
             usage = json_data.get('usage', {})
             if usage:
-                self.prompt_tokens = usage.get('prompt_tokens', 0)
-                self.completion_tokens = usage.get('completion_tokens', 0)
-                self.total_tokens = usage.get('total_tokens', 0)
+                self._set_usage(usage)
 
 
             return self.generate_sse_response( response_data)
@@ -146,45 +131,83 @@ class openaiSSEHandler:
             print(f"处理失败: {e}\r\n{line}\r\n")
             return None
 
-    def _update_tool_calls(self, new_tool_calls):
-        for new_call in new_tool_calls:
-            call_id = new_call.get('id')
-            if call_id:
-                existing_call = next((call for call in self.tool_calls if call.get('id') == call_id), None)
-                if existing_call:
-                    self._merge_tool_call(existing_call, new_call)
-                else:
-                    self.tool_calls.append(new_call)
-            else:
-                # 如果新的 tool call 没有 id，我们更新最后一个 tool call
-                if self.tool_calls:
-                    self._merge_tool_call(self.tool_calls[-1], new_call)
-                else:
-                    self.tool_calls.append(new_call)
+    def _set_usage(self, usage):
+        self.prompt_tokens = usage.get('prompt_tokens', 0)
+        self.completion_tokens = usage.get('completion_tokens', 0)
+        self.total_tokens = usage.get('total_tokens', 0)
 
-    def _merge_tool_call(self, existing_call, new_call):
-        for key, value in new_call.items():
-            if key == 'function':
-                if 'function' not in existing_call:
-                    existing_call['function'] = {}
-                for func_key, func_value in value.items():
-                    if func_key == 'arguments':
-                        existing_call['function']['arguments'] = existing_call['function'].get('arguments',
-                                                                                               '') + func_value
-                    else:
-                        existing_call['function'][func_key] = func_value
-            else:
-                existing_call[key] = value
+    def handle_SSE_raw(self, block: bytes) -> bytes:
+        """直接转发上游的事件块，只把 model 字段替换成请求的模型名
+
+        不做 json 解析。上游一个流里的 model 字段是一样的，第一次用正则找到后，
+        后面每块只做一次 bytes.replace；内容、usage 和工具调用在 get_stats 时
+        对整个流扫描一次，不占用转发每个 token 的时间。关闭累加时只保留带 usage 的块。
+        """
+        if self._raw_model is None:
+            self._raw_model = b'"model":' + json.dumps(self.model).encode()
+        upstream_model = self._upstream_model
+        if upstream_model is None or upstream_model not in block:
+            match = MODEL_FIELD.search(block)
+            upstream_model = self._upstream_model = match.group(0) if match else upstream_model
+        if upstream_model is not None and upstream_model != self._raw_model:
+            block = block.replace(upstream_model, self._raw_model)
+        if self.acc.enabled:
+            self._raw_blocks.append(block)
+        elif b'"usage"' in block:
+            self._raw_blocks = [block]
+        if self.hide_usage and b"[]" in block:
+            block = USAGE_EVENT.sub(self._hidden_usage, block)
+        return block
+
+    @staticmethod
+    def _hidden_usage(match):
+        event = match.group(0)
+        return b"" if USAGE_OBJECT.search(event) else event
+
+    def _finish_raw(self):
+        """扫描转发过的整个流，取出内容、最后一个 usage 和工具调用"""
+        data = b"".join(self._raw_blocks)
+        self._raw_blocks = [data]
+        content = CONTENT_FIELD.findall(data) if self.acc.enabled else None
+        if content:
+            self.acc.set_text(json.loads(b'"' + b"".join(content) + b'"'))
+        index = data.rfind(b'"usage"')
+        if index >= 0:
+            start = data.rfind(b"\n", 0, index) + 1
+            end = data.find(b"\n", index)
+            try:
+                usage = json.loads(data[start:end if end >= 0 else len(data)].strip()[5:]).get('usage') or {}
+            except Exception:
+                usage = {}
+            if usage:
+                self.prompt_tokens = usage.get('prompt_tokens', 0)
+                self.completion_tokens = usage.get('completion_tokens', 0)
+                self.total_tokens = usage.get('total_tokens', 0)
+        if self.acc.enabled and b'"tool_calls"' in data:
+            self.acc.set_tool_calls(None)
+            for line in data.splitlines():
+                if b'"tool_calls"' not in line:
+                    continue
+                try:
+                    choices = json.loads(line.strip()[5:]).get('choices') or [{}]
+                    tool_calls = choices[0].get('delta', {}).get('tool_calls')
+                    for tool_call in tool_calls or []:
+                        self.acc.add_tool_call_delta(tool_call)
+                except Exception as e:
+                    print(f"处理失败: {e}\r\n{line}\r\n")
 
     def get_stats(self):
+        if self._raw_blocks:
+            self._finish_raw()
+        self.usage.fill(self)
         return {
-            "full_message_content": self.full_message_content,
+            "full_message_content": self.acc.text,
             "custom_id": self.custom_id,
             "model": self.model,
             "prompt_tokens": self.prompt_tokens,
             "completion_tokens": self.completion_tokens,
             "total_tokens": self.total_tokens,
-            "tool_calls": self.tool_calls
+            "tool_calls": self.acc.tool_calls
         }
     
     def handle_data_line(self, line: str):
@@ -197,8 +220,8 @@ class openaiSSEHandler:
             choices = json_data.get('choices', [{}])
             if choices:
                 message = choices[0].get('message', {})
-                self.full_message_content = message.get('content', '')
-                self.tool_calls = message.get('tool_calls', [])
+                self.acc.set_text(message.get('content') or '')
+                self.acc.set_tool_calls(message.get('tool_calls'))
             
             usage = json_data.get('usage', {})
             self.prompt_tokens = usage.get('prompt_tokens', 0)
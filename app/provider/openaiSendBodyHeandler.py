@@ -1,11 +1,10 @@
+import asyncio
 import base64
 import os
-import time
-import httpx
 import ujson as json
-from fastapi import HTTPException
 
 from app.provider.httpxHelp import get_api_data2
+from app.provider.vertexai.accessToken import access_token_manager
 import pyefun
 import app.help as help
 
@@ -42,47 +41,6 @@ gemini_location = CircularList(["us-central1", "us-east4", "us-west1", "us-west4
 
 
 
-token_cache = {}
-
-def get_access_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN):
-    TOKEN_URL = 'https://www.googleapis.com/oauth2/v4/token'
-    now = time.time()
-
-    if CLIENT_ID not in token_cache:
-        token_cache[CLIENT_ID] = {"access_token": "", "expiry": 0}
-
-    if token_cache[CLIENT_ID]["access_token"] and now < token_cache[CLIENT_ID]["expiry"] - 120:
-        return token_cache[CLIENT_ID]["access_token"]
-    try:
-        with httpx.Client() as client:
-            response = client.post(TOKEN_URL, json={
-                "client_id": CLIENT_ID,
-                "client_secret": CLIENT_SECRET,
-                "refresh_token": REFRESH_TOKEN,
-                "grant_type": "refresh_token"
-            })
-        data = response.json()
-        token_cache[CLIENT_ID]["access_token"] = data["access_token"]
-        token_cache[CLIENT_ID]["expiry"] = now + data["expires_in"]
-        access_token = token_cache[CLIENT_ID]["access_token"]
-    except httpx.RequestError as e:
-        error_data = {
-            "error": "网络请求错误",
-            "detail": str(e),
-            "response_body": TOKEN_URL,
-        }
-        raise HTTPException(status_code=503, detail=error_data)
-    except Exception as e:
-        error_data = {
-            "error": "vertexai access_token 获取失败",
-            "detail": str(e),
-            "response_body": TOKEN_URL,
-        }
-        raise HTTPException(status_code=429, detail=error_data)
-
-    return access_token
-
-
 class openaiSendBodyHeandler:
     def __init__(self, api_key="", base_url="", model=""):
         self.req = None
@@ -225,7 +183,7 @@ class openaiSendBodyHeandler:
             "body": payload
         }
 
-    def get_vertexai_gemini(self, PROJECT_ID,
+    async def get_vertexai_gemini(self, PROJECT_ID,
                             CLIENT_ID,
                             CLIENT_SECRET,
                             REFRESH_TOKEN,
@@ -234,7 +192,7 @@ class openaiSendBodyHeandler:
 
         ready = self.get_Gemini()
 
-        access_token = get_access_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
+        access_token = await access_token_manager.get_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
         location = gemini_location.next()
 
         API_ENDPOINT = f"{location}-aiplatform.googleapis.com"
@@ -254,12 +212,14 @@ class openaiSendBodyHeandler:
             "body": ready['body']
         }
 
-    def get_vertexai_claude(self,
+    async def get_vertexai_claude(self,
                             PROJECT_ID,
                             CLIENT_ID,
                             CLIENT_SECRET,
                             REFRESH_TOKEN,
-                            MODEL
+                            MODEL,
+                            BASE_URL="",
+                            TOKEN_URL=""
                             ):
 
         stream = self.req.get("stream", False)
@@ -357,8 +317,9 @@ class openaiSendBodyHeandler:
 
         location = location.next()
         
-        url = f"https://{location}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/{location}/publishers/anthropic/models/{MODEL}:streamRawPredict"
-        access_token = get_access_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
+        base_url = BASE_URL or f"https://{location}-aiplatform.googleapis.com"
+        url = f"{base_url}/v1/projects/{PROJECT_ID}/locations/{location}/publishers/anthropic/models/{MODEL}:streamRawPredict"
+        access_token = await access_token_manager.get_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, TOKEN_URL)
         return {
             "url": url,
             "stream": stream,
@@ -412,20 +373,20 @@ if __name__ == "__main__":
                                      base_url=os.getenv('base_url'),
                                      model=os.getenv('model', 'gemini-1.5-flash'))
         obj.header_openai(body)
-        pushdata = obj.get_vertexai_gemini(
+        pushdata = asyncio.run(obj.get_vertexai_gemini(
             PROJECT_ID=os.getenv('PROJECT_ID'),
             CLIENT_ID=os.getenv('CLIENT_ID'),
             CLIENT_SECRET=os.getenv('CLIENT_SECRET'),
             REFRESH_TOKEN=os.getenv('REFRESH_TOKEN'),
             MODEL=model,
-        )
+        ))
 
         # model = "claude-3-5-sonnet@20240620"
         # obj = openaiSendBodyHeandler(api_key=os.getenv('api_key'),
         #                              base_url=os.getenv('base_url'),
         #                              model=os.getenv('model', 'claude-3-5-sonnet@20240620'))
         # obj.header_openai(body)
-        # pushdata = obj.get_vertexai_claude(
+        # pushdata = asyncio.run(obj.get_vertexai_claude(
         #     PROJECT_ID=os.getenv('PROJECT_ID'),
         #     CLIENT_ID=os.getenv('CLIENT_ID'),
         #     CLIENT_SECRET=os.getenv('CLIENT_SECRET'),
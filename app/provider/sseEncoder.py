@@ -0,0 +1,72 @@
+import time
+from typing import Optional
+
+import ujson as json
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+
+class SSEChunkEncoder:
+    """按流预编译的 chat.completion.chunk 编码器
+
+    一个流里 id、object、created、model 都不会变，前缀和后缀在创建时拼好一次，
+    每个 token 只对 delta 做一次 json 转义，直接输出带 "data: " 和空行的完整 SSE 字节，
+    一路作为 bytes 交给 StreamingResponse，不再每块拼字典、调 time.time() 和拼字符串。
+    输出和原来的 json.dumps(chunk) 字段顺序、转义方式一致。
+    """
+
+    __slots__ = ("key", "_prefix", "_close", "_stop", "_role")
+
+    def __init__(self, custom_id=None, model="", created: Optional[int] = None):
+        self.key = (custom_id, model)
+        created = int(time.time()) if created is None else created
+        self._prefix = (
+            b'data: {"id":' + json.dumps(f"chatcmpl-{custom_id}").encode()
+            + b',"object":"chat.completion.chunk","created":' + str(created).encode()
+            + b',"model":' + json.dumps(model).encode()
+            + b',"system_fingerprint":null,"choices":[{"index":0,"delta":'
+        )
+        self._close = b',"logprobs":null,"finish_reason":null}]}\n\n'
+        self._stop = self._prefix + b'{},"logprobs":null,"finish_reason":'
+        self._role = self._prefix + b'{"role":"assistant","content":""}' + self._close
+
+    def role(self) -> bytes:
+        return self._role
+
+    def content(self, text: str) -> bytes:
+        return self._prefix + b'{"content":' + json.dumps(text).encode() + b'}' + self._close
+
+    def tool_calls(self, tool_calls) -> bytes:
+        return self._prefix + b'{"tool_calls":' + json.dumps(tool_calls).encode() + b'}' + self._close
+
+    def stop(self, prompt_tokens=None, completion_tokens=0, total_tokens=0, finish_reason="stop") -> bytes:
+        """结束块，prompt_tokens 为 None 时不带 usage"""
+        if prompt_tokens is None:
+            return self._stop + json.dumps(finish_reason).encode() + b'}]}\n\n'
+        return (self._stop + json.dumps(finish_reason).encode()
+                + b'}],"usage":{"prompt_tokens":' + str(prompt_tokens).encode()
+                + b',"completion_tokens":' + str(completion_tokens).encode()
+                + b',"total_tokens":' + str(total_tokens).encode() + b'}}\n\n')
+
+    def encode(self, content=None, prompt_tokens=0, completion_tokens=0, total_tokens=0) -> Optional[bytes]:
+        """兼容原来 generate_sse_response 的 content 参数"""
+        if content is None:
+            return self._role
+        kind = content['type']
+        if kind == 'content':
+            return self.content(content['content'])
+        if kind == 'tool_calls':
+            return self.tool_calls(content['function'])
+        if kind == 'stop':
+            return self.stop(prompt_tokens, completion_tokens, total_tokens, content.get('finish_reason', 'stop'))
+        if kind == 'end':
+            return SSE_DONE
+        return None
+
+
+def get_encoder(handler) -> SSEChunkEncoder:
+    """取 handler 当前 id 和 model 对应的编码器，上游中途改了 id 或 model 时重新编译"""
+    encoder = handler._encoder
+    if encoder is None or encoder.key != (handler.custom_id, handler.model):
+        encoder = handler._encoder = SSEChunkEncoder(handler.custom_id, handler.model)
+    return encoder
@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+
+@dataclass(slots=True)
+class SSEEvent:
+    data: str
+    event: Optional[str] = None
+    id: Optional[str] = None
+
+
+class SSEFramer:
+    """按字节增量切分 SSE 事件
+
+    直接在 aiter_bytes() 的字节流上找换行，已处理的部分每次 feed 只删除一次，
+    不会像 buffer.split('\\n', 1) 那样每行都复制剩余的 buffer。
+    支持 \\n 和 \\r\\n 换行，只对 data 的内容做 utf-8 解码。
+
+    默认和原来的逐行读取一样，每个 data: 行就是一个事件，上游只用单个换行分隔时也不会合并；
+    multiline=True 时按规范把空行之前的多行 data: 用 \\n 拼接成一个事件。
+    """
+
+    def __init__(self, multiline: bool = False):
+        self.multiline = multiline
+        self._buf = bytearray()
+        self._scan = 0  # 下次从这里开始找换行，避免超长的行被反复扫描
+        self._data: List[str] = []
+        self._event = None
+        self._id = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        buf = self._buf
+        buf += chunk
+        last = buf.rfind(b"\n", self._scan)
+        if last < 0:
+            self._scan = len(buf)
+            return []
+        # 只切一次已经完整的部分，剩下不完整的行留在 buffer 里
+        block = bytes(buf[:last + 1])
+        del buf[:last + 1]
+        self._scan = len(buf)
+        lines = block.split(b"\n")
+        lines.pop()  # block 以 \n 结尾，最后一个是空串
+        crlf = b"\r" in block
+        events = []
+        data = self._data
+        for line in lines:
+            if crlf and line[-1:] == b"\r":
+                line = line[:-1]
+            if not line:
+                if data:
+                    events.append(SSEEvent(data[0] if len(data) == 1 else "\n".join(data), self._event, self._id))
+                    data.clear()
+                self._event = None
+            elif line.startswith(b"data:"):
+                value = line[6:].decode("utf-8") if line[5:6] == b" " else line[5:].decode("utf-8")
+                if self.multiline:
+                    data.append(value)
+                else:
+                    events.append(SSEEvent(value, self._event, self._id))
+            else:
+                self._field(line)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """流结束时调用，把没有以空行结尾的最后一个事件也吐出来"""
+        events = self.feed(b"\n\n") if self._buf or self._data else []
+        self._buf.clear()
+        self._scan = 0
+        return events
+
+    def _field(self, line: bytes):
+        if line.startswith(b"event:"):
+            self._event = line[6:].decode("utf-8").strip()
+        elif line.startswith(b"id:"):
+            self._id = line[3:].decode("utf-8").strip()
+        # ":" 开头的注释和 retry 等字段直接忽略
+
+
+async def aiter_sse(byte_iterator: AsyncIterator[bytes]) -> AsyncIterator[SSEEvent]:
+    """把 response.aiter_bytes() 转换为 SSE 事件"""
+    framer = SSEFramer()
+    async for chunk in byte_iterator:
+        for event in framer.feed(chunk):
+            yield event
+    for event in framer.flush():
+        yield event
+
+
+
+class SSEBlockFramer:
+    """只按空行切出完整的 SSE 事件块，不解析也不解码，用于原样转发上游的字节
+
+    一次 feed 可能包含多个事件，合并成一个块返回，半个事件留到下次。
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._scan = 0
+
+    def feed(self, chunk: bytes) -> bytes:
+        buf = self._buf
+        if not buf and chunk.endswith((b"\n\n", b"\n\r\n")):
+            # 最常见的情况: 上游一个包正好是完整的事件，不用复制
+            return chunk
+        buf += chunk
+        lf = buf.rfind(b"\n\n", self._scan)
+        crlf = buf.rfind(b"\n\r\n", self._scan)
+        end = max(lf + 2 if lf >= 0 else -1, crlf + 3 if crlf >= 0 else -1)
+        if end < 0:
+            # 分隔符可能被切在两次 feed 之间，往回留 2 个字节
+            self._scan = max(0, len(buf) - 2)
+            return b""
+        block = bytes(buf[:end])
+        del buf[:end]
+        self._scan = 0
+        return block
+
+    def flush(self) -> bytes:
+        """流结束时没有以空行结尾的内容补上空行返回"""
+        if not self._buf.strip():
+            return b""
+        block = bytes(self._buf).rstrip(b"\r\n") + b"\n\n"
+        self._buf.clear()
+        self._scan = 0
+        return block
+
+
+async def aiter_sse_blocks(byte_iterator: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """把 response.aiter_bytes() 转换为完整事件组成的字节块"""
+    framer = SSEBlockFramer()
+    async for chunk in byte_iterator:
+        block = framer.feed(chunk)
+        if block:
+            yield block
+    block = framer.flush()
+    if block:
+        yield block
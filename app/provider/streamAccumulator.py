@@ -0,0 +1,139 @@
+from typing import Dict, List, Optional
+
+
+class _ToolCall:
+    __slots__ = ("index", "id", "type", "name", "arguments")
+
+    def __init__(self, index, id=None, type="function", name=None):
+        self.index = index
+        self.id = id
+        self.type = type
+        self.name = name
+        self.arguments: List[str] = []
+
+    def to_dict(self):
+        if len(self.arguments) > 1:
+            self.arguments[:] = ["".join(self.arguments)]
+        return {
+            "id": self.id,
+            "type": self.type,
+            "function": {
+                "name": self.name,
+                "arguments": self.arguments[0] if self.arguments else "",
+            },
+        }
+
+
+class StreamAccumulator:
+    """流式响应的内容和工具调用累加器，所有 SSEHandler 共用
+
+    内容只往列表里追加，读取 text 时才拼接一次，避免 str += 在长输出上变成平方复杂度；
+    工具调用按 index 和 id 建索引，参数片段同样只追加。
+    enabled 为 False 时不保存内容和工具调用 (不写日志的流式请求用不到)，usage 照常统计。
+    """
+
+    __slots__ = ("enabled", "_parts", "_calls", "_by_id", "_last", "_count")
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._parts: List[str] = []
+        self._calls: Dict[int, _ToolCall] = {}
+        self._by_id: Dict[str, _ToolCall] = {}
+        self._last: Optional[_ToolCall] = None
+        self._count = 0  # 出现过的工具调用数量，关闭累加时也计数，用来分配 index
+
+    def add_text(self, text: str):
+        if self.enabled and text:
+            self._parts.append(text)
+
+    def set_text(self, text: str):
+        """非流式或者上游最后给出完整内容时直接替换，不受 enabled 影响"""
+        self._parts = [text] if text else []
+
+    @property
+    def text(self) -> str:
+        parts = self._parts
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    def _call(self, index=None, id=None) -> _ToolCall:
+        call = None
+        if index is not None:
+            call = self._calls.get(index)
+        elif id:
+            call = self._by_id.get(id)
+        elif self._last is not None:
+            # 没有 index 也没有 id 的片段属于上一个工具调用
+            call = self._last
+        if call is None:
+            if index is None:
+                index = self._count
+                while index in self._calls:
+                    index += 1
+            call = self._calls[index] = _ToolCall(index)
+            self._count = max(self._count, index + 1)
+        if id and call.id is None:
+            call.id = id
+            self._by_id[id] = call
+        self._last = call
+        return call
+
+    def start_tool_call(self, index=None, id=None, name=None, type="function"):
+        """新的工具调用开始，返回它的 index"""
+        if not self.enabled:
+            index = self._count if index is None else index
+            self._count = max(self._count, index + 1)
+            return index
+        call = self._call(index, id)
+        call.type = type or call.type
+        if name:
+            call.name = name
+        return call.index
+
+    def add_arguments(self, fragment: str, index=None, id=None):
+        if self.enabled and fragment:
+            self._call(index, id).arguments.append(fragment)
+
+    def add_tool_call_delta(self, delta: Dict):
+        """合并一个 OpenAI 格式的 tool_calls 增量 {"index", "id", "type", "function": {"name", "arguments"}}"""
+        if not self.enabled:
+            return
+        call = self._call(delta.get("index"), delta.get("id"))
+        if delta.get("type"):
+            call.type = delta["type"]
+        function = delta.get("function") or {}
+        if function.get("name"):
+            call.name = function["name"]
+        arguments = function.get("arguments")
+        if arguments:
+            call.arguments.append(arguments)
+
+    @property
+    def next_tool_index(self) -> int:
+        return self._count
+
+    def add_tool_call(self, tool_call: Dict, force: bool = False) -> int:
+        """添加一个完整的工具调用，返回它的 index；没有 index 和已知 id 时作为新的工具调用"""
+        index = tool_call.get("index")
+        if index is None and tool_call.get("id") not in self._by_id:
+            index = self._count
+        if not (self.enabled or force):
+            self._count = max(self._count, index + 1) if index is not None else self._count
+            return index
+        call = self._call(index, tool_call.get("id"))
+        function = tool_call.get("function") or {}
+        call.type = tool_call.get("type") or call.type
+        call.name = function.get("name")
+        call.arguments = [function.get("arguments") or ""]
+        return call.index
+
+    def set_tool_calls(self, tool_calls: Optional[List[Dict]]):
+        """非流式响应直接替换全部工具调用，不受 enabled 影响"""
+        self._calls, self._by_id, self._last, self._count = {}, {}, None, 0
+        for tool_call in tool_calls or []:
+            self.add_tool_call(tool_call, force=True)
+
+    @property
+    def tool_calls(self) -> List[Dict]:
+        return [self._calls[index].to_dict() for index in sorted(self._calls)]
@@ -0,0 +1,293 @@
+"""本地计算 token 数，上游没有返回 usage 时 (cloudflare、merlin、cohere 流中断、没有 usage 的 openai 兼容渠道) 补全统计
+
+按模型名选择分词器 (TOKENIZERS)：安装了 tiktoken 时 OpenAI 系列模型用 tiktoken 精确计数，
+编码文件第一次用到时在后台线程加载 (可能需要下载)，加载完成前和离线加载失败时按字节估算：
+ASCII 每 chars_per_token 个字符一个 token，中日韩等多字节字符每个字符 tokens_per_cjk 个 token。
+
+- 每段文本的 token 数按 (分词器, 长度, hash) 缓存，同一个 system prompt、工具定义和多轮对话里前面的消息只算一次
+- 流式输出每收到一段就累加，结束时不用再扫描整个输出
+- 只补上游没有给的数，上游给了的以上游为准
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import ujson as json
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖
+    tiktoken = None
+
+CACHE_SIZE = 4096  # 缓存多少段文本的 token 数
+MIN_CACHE_LENGTH = 64  # 比这短的文本直接算
+MAX_PENDING = 256  # 流式计数时没有空白也最多攒这么多字符就算一次
+MESSAGE_TOKENS = 3  # 每条消息的格式开销 (<|start|>role<|message|>...<|end|>)
+REPLY_TOKENS = 3  # 回复开头 <|start|>assistant<|message|>
+IMAGE_TOKENS = 765  # 一张图片按 1024x1024 高清估算
+LOW_IMAGE_TOKENS = 85
+
+
+class Tokenizer:
+    """一种分词器：encoding 是 tiktoken 的编码名，没有或者不可用时按字节估算"""
+
+    __slots__ = ("name", "encoding", "chars_per_token", "tokens_per_cjk")
+
+    def __init__(self, name: str, encoding: Optional[str] = None, chars_per_token: float = 4.0,
+                 tokens_per_cjk: float = 1.0):
+        self.name = name
+        self.encoding = encoding
+        self.chars_per_token = chars_per_token
+        self.tokens_per_cjk = tokens_per_cjk
+
+    def encoder(self):
+        return get_encoding(self.encoding)
+
+    @property
+    def key(self) -> str:
+        """缓存用的名字，tiktoken 加载前后的结果不一样"""
+        return self.encoding if self.encoder() is not None else self.name
+
+    def estimate(self, text: str) -> float:
+        """按字节估算，分段估算的和等于整段估算"""
+        length = len(text)
+        if text.isascii():
+            return length / self.chars_per_token
+        # 多字节字符在 utf-8 里多出来的字节数，中日韩字符每个多 2 个字节
+        extra = len(text.encode("utf-8", "surrogatepass")) - length
+        return (length - extra / 2) / self.chars_per_token + extra / 2 * self.tokens_per_cjk
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        encoder = self.encoder()
+        if encoder is not None:
+            return len(encoder.encode_ordinary(text))
+        return max(1, int(self.estimate(text) + 0.5))
+
+
+# 按模型名 (去掉 @cf/meta/ 这类前缀后) 的开头匹配，前面的优先
+TOKENIZERS = [
+    (("gpt-4o", "chatgpt-4o", "gpt-4.1", "gpt-4.5", "gpt-5", "o1", "o3", "o4"),
+     Tokenizer("o200k", "o200k_base", 4.0, 0.7)),
+    (("gpt-4", "gpt-3.5", "text-embedding"), Tokenizer("cl100k", "cl100k_base", 4.0, 1.0)),
+    (("claude",), Tokenizer("claude", None, 3.5, 1.2)),
+    (("gemini", "gemma"), Tokenizer("gemini", None, 4.0, 0.7)),
+    (("command", "c4ai"), Tokenizer("cohere", None, 4.0, 0.8)),
+    (("llama-3", "llama3", "meta-llama-3"), Tokenizer("llama3", None, 4.0, 0.9)),
+    (("llama-2", "llama2", "mistral", "mixtral", "openchat", "zephyr"), Tokenizer("sentencepiece", None, 3.5, 1.5)),
+    (("qwen", "deepseek", "glm", "yi-", "baichuan"), Tokenizer("cjk", None, 3.8, 0.7)),
+]
+DEFAULT_TOKENIZER = Tokenizer("default", "cl100k_base", 4.0, 1.0)
+
+_encodings: Dict[str, object] = {}  # 编码名 -> tiktoken 编码，加载失败时是 None
+_loading = set()
+_lock = threading.Lock()
+
+
+def _load_encoding(name: str):
+    try:
+        encoding = tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"加载 tiktoken 编码 {name} 失败，改用估算: {e}")
+        encoding = None
+    _encodings[name] = encoding
+
+
+def get_encoding(name: Optional[str]):
+    """tiktoken 编码，第一次用到时在后台线程加载，不阻塞请求；加载完成前返回 None"""
+    if tiktoken is None or not name:
+        return None
+    encoding = _encodings.get(name)
+    if encoding is not None or name in _encodings:
+        return encoding
+    with _lock:
+        if name not in _loading:
+            _loading.add(name)
+            threading.Thread(target=_load_encoding, args=(name,), daemon=True).start()
+    return None
+
+
+@lru_cache(maxsize=1024)
+def get_tokenizer(model: str) -> Tokenizer:
+    name = (model or "").lower().rsplit("/", 1)[-1]
+    for prefixes, tokenizer in TOKENIZERS:
+        if name.startswith(prefixes):
+            return tokenizer
+    return DEFAULT_TOKENIZER
+
+
+class TokenCache:
+    """文本 -> token 数的 LRU 缓存
+
+    键用文本的长度和 hash，不保存文本本身，也不用对长文本再算一遍摘要。
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self.values: "OrderedDict[tuple, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def count(self, tokenizer: Tokenizer, text: str) -> int:
+        if len(text) < MIN_CACHE_LENGTH:
+            return tokenizer.count(text)
+        key = (tokenizer.key, len(text), hash(text))
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return value
+        value = tokenizer.count(text)
+        with self.lock:
+            self.misses += 1
+            self.values[key] = value
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.hits = self.misses = 0
+
+
+token_cache = TokenCache()
+
+
+def count_text(text: str, model: str = "") -> int:
+    return token_cache.count(get_tokenizer(model), text or "")
+
+
+def _count_content(tokenizer: Tokenizer, content) -> int:
+    if isinstance(content, str):
+        return token_cache.count(tokenizer, content)
+    total = 0
+    for part in content if isinstance(content, list) else []:
+        if not isinstance(part, dict):
+            continue
+        if part.get("type") == "text":
+            total += token_cache.count(tokenizer, part.get("text") or "")
+        elif part.get("type") in ("image_url", "image"):
+            image = part.get("image_url")
+            low = isinstance(image, dict) and image.get("detail") == "low"
+            total += LOW_IMAGE_TOKENS if low else IMAGE_TOKENS
+    return total
+
+
+def count_messages(messages: List[dict], model: str = "", tools: Optional[list] = None) -> int:
+    """按 OpenAI 的消息格式计算 prompt 的 token 数"""
+    tokenizer = get_tokenizer(model)
+    total = REPLY_TOKENS
+    for message in messages or []:
+        if not isinstance(message, dict):
+            continue
+        total += MESSAGE_TOKENS + _count_content(tokenizer, message.get("content"))
+        if message.get("name"):
+            total += 1 + token_cache.count(tokenizer, message["name"])
+        if message.get("tool_calls"):
+            total += token_cache.count(tokenizer, json.dumps(message["tool_calls"], ensure_ascii=False))
+    if tools:
+        total += token_cache.count(tokenizer, json.dumps(tools, ensure_ascii=False))
+    return total
+
+
+class StreamCounter:
+    """流式输出边收边算
+
+    估算时每段直接累加；用 tiktoken 时攒到空白处再编码，一个词不会被切在两段里算两次。
+    """
+
+    __slots__ = ("tokenizer", "tokens", "fed", "_encoder", "_estimate", "_pending")
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = 0
+        self.fed = False
+        # 流开始时定下用哪种方式，中途 tiktoken 加载完成也不切换
+        self._encoder = tokenizer.encoder()
+        self._estimate = 0.0
+        self._pending = ""
+
+    def feed(self, text: str):
+        if not text:
+            return
+        self.fed = True
+        if self._encoder is None:
+            self._estimate += self.tokenizer.estimate(text)
+            return
+        pending = self._pending + text
+        cut = max(pending.rfind(" "), pending.rfind("\n"))
+        if cut <= 0 and len(pending) > MAX_PENDING:
+            cut = len(pending)
+        if cut > 0:
+            self.tokens += len(self._encoder.encode_ordinary(pending[:cut]))
+            pending = pending[cut:]
+        self._pending = pending
+
+    @property
+    def total(self) -> int:
+        if self._encoder is None:
+            return int(self._estimate + 0.5) if self.fed else 0
+        if self._pending:
+            return self.tokens + len(self._encoder.encode_ordinary(self._pending))
+        return self.tokens
+
+
+class UsageCounter:
+    """一个请求的本地 token 统计，挂在 SSEHandler 上，上游没有返回 usage 时用来补全"""
+
+    __slots__ = ("model", "messages", "tools", "stream", "_prompt")
+
+    def __init__(self, model: str = ""):
+        self.model = model
+        self.messages = None
+        self.tools = None
+        self.stream = StreamCounter(get_tokenizer(model))
+        self._prompt = None
+
+    def set_request(self, request: dict):
+        """provider 拿到请求后调用，用上游的模型名选分词器"""
+        self.messages = request.get("messages")
+        self.tools = request.get("tools")
+        model = request.get("model") or self.model
+        if model != self.model and not self.stream.fed:
+            self.model = model
+            self.stream = StreamCounter(get_tokenizer(model))
+        self._prompt = None
+
+    def feed(self, text: str):
+        self.stream.feed(text)
+
+    def prompt_tokens(self) -> int:
+        if self.messages is None:
+            return 0
+        if self._prompt is None:
+            self._prompt = count_messages(self.messages, self.model, self.tools)
+        return self._prompt
+
+    def completion_tokens(self, text: str = "") -> int:
+        """流式时用累加的结果，没有喂过 (非流式或者直接转发) 时计算完整内容"""
+        if self.stream.fed:
+            return self.stream.total
+        return count_text(text, self.model)
+
+    def fill(self, handler, text: Optional[str] = None) -> bool:
+        """把 handler 上为 0 的 token 数换成本地计算的结果，返回是否有改动"""
+        changed = False
+        if not handler.prompt_tokens:
+            prompt = self.prompt_tokens()
+            if prompt:
+                handler.prompt_tokens = prompt
+                changed = True
+        if not handler.completion_tokens:
+            completion = self.completion_tokens(handler.acc.text if text is None else text)
+            if completion:
+                handler.completion_tokens = completion
+                changed = True
+        if changed:
+            handler.total_tokens = handler.prompt_tokens + handler.completion_tokens
+        return changed
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from app.log import logger
+from app.provider.httpxHelp import upstream_clients
+
+TOKEN_URL = 'https://www.googleapis.com/oauth2/v4/token'
+
+
+class _TokenState:
+    def __init__(self):
+        self.access_token = ""
+        self.expiry = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+
+class AccessTokenManager:
+    """按 CLIENT_ID 缓存 vertexai 的 access_token
+
+    过期前 refresh_margin 秒内的请求继续使用旧 token，同时在后台刷新；
+    同一个 CLIENT_ID 同一时间只会有一个刷新请求，其他请求等待同一个结果。
+    """
+
+    def __init__(self, refresh_margin: float = 300, min_valid: float = 60):
+        self.refresh_margin = refresh_margin
+        self.min_valid = min_valid
+        self.tokens: Dict[str, _TokenState] = {}
+
+    async def get_token(self, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, token_url: str = "") -> str:
+        state = self.tokens.get(CLIENT_ID)
+        if state is None:
+            state = self.tokens[CLIENT_ID] = _TokenState()
+
+        now = time.time()
+        if state.access_token and now < state.expiry - self.min_valid:
+            if now >= state.expiry - self.refresh_margin:
+                self._start_refresh(state, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, token_url)
+            return state.access_token
+
+        task = self._start_refresh(state, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, token_url)
+        # shield 避免某个请求被取消时把共享的刷新任务也取消掉
+        return await asyncio.shield(task)
+
+    def _start_refresh(self, state: _TokenState, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN,
+                       token_url: str = "") -> asyncio.Task:
+        if state.task is None or state.task.done():
+            state.task = asyncio.create_task(
+                self._fetch(state, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, token_url or TOKEN_URL))
+            state.task.add_done_callback(self._log_failure)
+        return state.task
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"vertexai access_token 刷新失败: {task.exception()}")
+
+    async def _fetch(self, state: _TokenState, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, token_url) -> str:
+        now = time.time()
+        try:
+            async with upstream_clients.use(token_url) as client:
+                response = await client.post(token_url, json={
+                    "client_id": CLIENT_ID,
+                    "client_secret": CLIENT_SECRET,
+                    "refresh_token": REFRESH_TOKEN,
+                    "grant_type": "refresh_token"
+                })
+            data = response.json()
+            state.access_token = data["access_token"]
+            state.expiry = now + data["expires_in"]
+        except httpx.RequestError as e:
+            error_data = {
+                "error": "网络请求错误",
+                "detail": str(e),
+                "response_body": token_url,
+            }
+            raise HTTPException(status_code=503, detail=error_data)
+        except Exception as e:
+            error_data = {
+                "error": "vertexai access_token 获取失败",
+                "detail": str(e),
+                "response_body": token_url,
+            }
+            raise HTTPException(status_code=429, detail=error_data)
+        logger.info(f"vertexai access_token 已刷新 {CLIENT_ID[:8]} 有效期 {data['expires_in']} 秒")
+        return state.access_token
+
+
+access_token_manager = AccessTokenManager()
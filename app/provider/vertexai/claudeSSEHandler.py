@@ -1,19 +1,31 @@
 import time
 import ujson as json
 import os
+from app.provider.sseEncoder import get_encoder, SSE_DONE
+from app.provider.streamAccumulator import StreamAccumulator
+
+# claude 的 stop_reason 对应的 openai finish_reason
+STOP_REASONS = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "max_tokens": "length",
+    "tool_use": "tool_calls",
+}
 
 
 class claudeSSEHandler:
-    def __init__(self, custom_id=None, model=""):
+    def __init__(self, custom_id=None, model="", accumulate=True):
         self.custom_id = custom_id
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self.full_message_content = ""
         self.model = model
-        self.tool_calls = []  # 新增: 用于存储完整的工具调用信息
+        self.acc = StreamAccumulator(accumulate)  # 完整的内容和工具调用
+        self.tool_index = {}  # claude 的 content block index: openai 的 tool_calls index
+        self._encoder = None
 
     def generate_response(self):
+        tool_calls = self.acc.tool_calls
         chunk = {
             "id": "chatcmpl-" + self.custom_id,
             "object": "chat.completion",
@@ -24,8 +36,8 @@ class claudeSSEHandler:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": self.full_message_content,
-                        "tool_calls": self.tool_calls if self.tool_calls else None
+                        "content": self.acc.text,
+                        "tool_calls": tool_calls if tool_calls else None
                     },
                     "finish_reason": "stop"
                 }
@@ -41,44 +53,7 @@ class claudeSSEHandler:
         return chunk
 
     def generate_sse_response(self, content=None):
-        current_timestamp = int(time.time())
-        chunk = {
-            "id": f"chatcmpl-{self.custom_id}",
-            "object": "chat.completion.chunk",
-            "created": current_timestamp,
-            "model": self.model,
-            "system_fingerprint": None,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "logprobs": None,
-                    "finish_reason": None
-                }
-            ]
-        }
-
-        if content is None:
-            chunk["choices"][0]["delta"] = {"role": "assistant", "content": ""}
-        elif content['type'] == 'content':
-            chunk["choices"][0]["delta"] = {"content": content['content']}
-        elif content['type'] == 'tool_calls':
-            chunk["choices"][0]["delta"] = {"tool_calls": content['function']}
-        elif content['type'] == 'stop':
-            chunk["choices"][0]["delta"] = {}
-            chunk["choices"][0]["finish_reason"] = "stop"
-            chunk["usage"] = {
-                "prompt_tokens": self.prompt_tokens,
-                "completion_tokens": self.completion_tokens,
-                "total_tokens": self.total_tokens,
-            }
-        elif content['type'] == 'end':
-            return "[DONE]"
-        else:
-            return None
-
-        json_data = json.dumps(chunk)
-        return f"{json_data}"
+        return get_encoder(self).encode(content, self.prompt_tokens, self.completion_tokens, self.total_tokens)
 
     def handle_SSE_data_line(self, line: str):
         if line.startswith("event:"):
@@ -87,7 +62,7 @@ class claudeSSEHandler:
             line = line[5:].strip()
         line = line.strip()
         if line == "[DONE]":
-            return "[DONE]"
+            return SSE_DONE
         if line == "":
             return None
 
@@ -102,33 +77,46 @@ class claudeSSEHandler:
                 self.prompt_tokens = message.get('usage', {}).get('input_tokens', 0)
                 return self.generate_sse_response()
 
+            elif event_type == 'content_block_start':
+                block = json_data.get('content_block', {})
+                if block.get('type') == 'tool_use':
+                    # 工具调用开始，只在第一个增量里发送 id 和名称
+                    tool_call = self._start_tool_call(json_data.get('index'), block.get('id'), block.get('name'))
+                    return self.generate_sse_response({'type': 'tool_calls', 'function': [tool_call]})
+
             elif event_type == 'content_block_delta':
                 delta = json_data.get('delta', {})
                 if delta.get('type') == 'text_delta':
                     content = delta.get('text', '')
-                    self.full_message_content += content
+                    self.acc.add_text(content)
                     return self.generate_sse_response({'type': 'content', 'content': content})
                 elif delta.get('type') == 'input_json_delta':
                     partial_json = delta.get('partial_json', '')
-                    if self.tool_calls:
-                        self.tool_calls[-1]['function']['arguments'] += partial_json
-                    else:
-                        self.tool_calls.append({
-                            "id": f"call_{len(self.tool_calls)}",
-                            "type": "function",
-                            "function": {
-                                "name": "search",  # 假设工具名称为 search
-                                "arguments": partial_json
-                            }
-                        })
-                    return self.generate_sse_response({'type': 'tool_calls', 'function': self.tool_calls})
+                    index = self.tool_index.get(json_data.get('index'))
+                    if index is None:
+                        # 没有收到 content_block_start，第一个片段带上 id
+                        tool_call = self._start_tool_call(json_data.get('index'), None, None)
+                        tool_call['function']['arguments'] = partial_json
+                        self.acc.add_arguments(partial_json, tool_call['index'])
+                        return self.generate_sse_response({'type': 'tool_calls', 'function': [tool_call]})
+                    if not partial_json:
+                        return None
+                    self.acc.add_arguments(partial_json, index)
+                    return self.generate_sse_response({
+                        'type': 'tool_calls',
+                        'function': [{"index": index, "function": {"arguments": partial_json}}]
+                    })
 
             elif event_type == 'message_delta':
                 delta = json_data.get('delta', {})
                 self.completion_tokens = json_data.get('usage', {}).get('output_tokens', 0)
                 self.total_tokens = self.prompt_tokens + self.completion_tokens
-                if delta.get('stop_reason'):
-                    return self.generate_sse_response({'type': 'stop'})
+                stop_reason = delta.get('stop_reason')
+                if stop_reason:
+                    return self.generate_sse_response({
+                        'type': 'stop',
+                        'finish_reason': STOP_REASONS.get(stop_reason, 'stop')
+                    })
 
             elif event_type == 'message_stop':
                 return self.generate_sse_response({'type': 'end'})
@@ -140,45 +128,28 @@ class claudeSSEHandler:
 
         return None
 
-    def _update_tool_calls(self, new_tool_calls):
-        for new_call in new_tool_calls:
-            call_id = new_call.get('id')
-            if call_id:
-                existing_call = next((call for call in self.tool_calls if call.get('id') == call_id), None)
-                if existing_call:
-                    self._merge_tool_call(existing_call, new_call)
-                else:
-                    self.tool_calls.append(new_call)
-            else:
-                # 如果新的 tool call 没有 id，我们更新最后一个 tool call
-                if self.tool_calls:
-                    self._merge_tool_call(self.tool_calls[-1], new_call)
-                else:
-                    self.tool_calls.append(new_call)
-
-    def _merge_tool_call(self, existing_call, new_call):
-        for key, value in new_call.items():
-            if key == 'function':
-                if 'function' not in existing_call:
-                    existing_call['function'] = {}
-                for func_key, func_value in value.items():
-                    if func_key == 'arguments':
-                        existing_call['function']['arguments'] = existing_call['function'].get('arguments',
-                                                                                               '') + func_value
-                    else:
-                        existing_call['function'][func_key] = func_value
-            else:
-                existing_call[key] = value
+    def _start_tool_call(self, block_index, id, name):
+        """登记一个新的工具调用，返回 openai 格式的第一个增量"""
+        index = self.acc.next_tool_index
+        id = id or f"call_{index}"
+        self.acc.start_tool_call(index, id, name)
+        self.tool_index[block_index] = index
+        return {
+            "index": index,
+            "id": id,
+            "type": "function",
+            "function": {"name": name, "arguments": ""}
+        }
 
     def get_stats(self):
         return {
-            "full_message_content": self.full_message_content,
+            "full_message_content": self.acc.text,
             "custom_id": self.custom_id,
             "model": self.model,
             "prompt_tokens": self.prompt_tokens,
             "completion_tokens": self.completion_tokens,
             "total_tokens": self.total_tokens,
-            "tool_calls": self.tool_calls
+            "tool_calls": self.acc.tool_calls
         }
 
     def handle_data_line(self, line: str):
@@ -189,7 +160,7 @@ class claudeSSEHandler:
             content = json_data.get('content', [])
             for part in content:
                 if part.get('type') == 'text':
-                    self.full_message_content += part.get('text', '')
+                    self.acc.add_text(part.get('text', ''))
                 elif part.get('type') == 'tool_use':
                     tool_call = {
                         "id": part.get('id'),
@@ -199,7 +170,7 @@ class claudeSSEHandler:
                             "arguments": json.dumps(part.get('input', {}))
                         }
                     }
-                    self.tool_calls.append(tool_call)
+                    self.acc.add_tool_call(tool_call, force=True)
 
             # 处理usage
             usage = json_data.get('usage', {})
@@ -1,7 +1,7 @@
 import asyncio
 from http.client import HTTPException
 from typing import AsyncGenerator
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
 from app.log import logger
 from app.provider.vertexai.claudeSSEHandler import claudeSSEHandler as SSEHandler
 from app.provider.openaiSendBodyHeandler import openaiSendBodyHeandler
@@ -13,6 +13,8 @@ class vertexaiClaudeProvider(baseProvider):
                  CLIENT_ID,
                  CLIENT_SECRET,
                  REFRESH_TOKEN,
+                 base_url="",
+                 token_url="",
                  ):
         super().__init__()
 
@@ -20,27 +22,31 @@ class vertexaiClaudeProvider(baseProvider):
         self.CLIENT_ID = CLIENT_ID
         self.CLIENT_SECRET = CLIENT_SECRET
         self.REFRESH_TOKEN = REFRESH_TOKEN
+        self.base_url = base_url  # 留空使用官方地址，压测时指向 mock 上游
+        self.token_url = token_url
 
         self._debug = True
         self._cache = True
         self.setDebugSave("vertexaiClaude")
-        self.DataHeadler = SSEHandler
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[
-        str, None]:
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get('model', "")
         logger.name = f"vertexaiClaudeProvider.{id}.model.{model}"
         sendReady = openaiSendBodyHeandler()
         sendReady.header_openai(request)
-        pushdata = sendReady.get_vertexai_claude(
+        pushdata = await sendReady.get_vertexai_claude(
             PROJECT_ID=self.PROJECT_ID,
             CLIENT_ID=self.CLIENT_ID,
             CLIENT_SECRET=self.CLIENT_SECRET,
             REFRESH_TOKEN=self.REFRESH_TOKEN,
-            MODEL=model
+            MODEL=model,
+            BASE_URL=self.base_url,
+            TOKEN_URL=self.token_url
         )  # 改这里
-        self.DataHeadler = SSEHandler(id, request_model_name)
-        async for chunk in self.chat2api_super(request, request_model_name, id, pushdata):
+        ctx = ctx or self.new_context(id, request_model_name)
+        ctx.DataHeadler = SSEHandler(id, request_model_name, ctx.accumulate)
+        async for chunk in self.chat2api_super(request, request_model_name, id, pushdata, ctx):
             yield chunk
 
 
@@ -9,7 +9,7 @@ import pyefun
 from app.log import logger, error_handling
 from app.provider.gemini.geminiSSEHandler import geminiSSEHandler as SSEHandler
 from app.provider.openaiSendBodyHeandler import openaiSendBodyHeandler
-from app.provider.baseProvider import baseProvider
+from app.provider.baseProvider import baseProvider, RequestContext
 
 
 class vertexaiGeminiProvider(baseProvider):
@@ -29,23 +29,23 @@ class vertexaiGeminiProvider(baseProvider):
         self._debug = True
         self._cache = True
         self.setDebugSave("vertexaiClaude")
-        self.DataHeadler = SSEHandler
 
-    async def chat2api(self, request, request_model_name: str = "", id: str = "") -> AsyncGenerator[
-        str, None]:
+    async def chat2api(self, request, request_model_name: str = "", id: str = "",
+                       ctx: RequestContext = None) -> AsyncGenerator[str, None]:
         model = request.get('model', "")
         logger.name = f"vertexaiGeminiProvider.{id}.model.{model}"
         sendReady = openaiSendBodyHeandler()
         sendReady.header_openai(request)
-        pushdata = sendReady.get_vertexai_gemini(
+        pushdata = await sendReady.get_vertexai_gemini(
             PROJECT_ID=self.PROJECT_ID,
             CLIENT_ID=self.CLIENT_ID,
             CLIENT_SECRET=self.CLIENT_SECRET,
             REFRESH_TOKEN=self.REFRESH_TOKEN,
             MODEL=model
         )  # 改这里
-        self.DataHeadler = SSEHandler(id, request_model_name)
-        async for chunk in self.chat2api_super(request, request_model_name, id, pushdata):
+        ctx = ctx or self.new_context(id, request_model_name)
+        ctx.DataHeadler = SSEHandler(id, request_model_name, ctx.accumulate)
+        async for chunk in self.chat2api_super(request, request_model_name, id, pushdata, ctx):
             yield chunk
 
 
@@ -59,10 +59,11 @@ if __name__ == "__main__":
         interface = vertexaiGeminiProvider(provider['PROJECT_ID'], provider['CLIENT_ID'], provider['CLIENT_SECRET'], provider['REFRESH_TOKEN'],
 
                                    )
-        interface.setDebugSave("vertexai_gemini_" + provider['mapped_model'])
-        interface._debug = True
-        interface._cache = True
-        interface._db_cache = True
+        ctx = interface.new_context()
+        ctx.setDebugSave("vertexai_gemini_" + provider['mapped_model'])
+        ctx.debug = True
+        ctx.cache = True
+        ctx.db_cache = True
         model_name = provider['mapped_model']
         # djson = pyefun.读入文本("/Users/ll/Desktop/2024/ll-openai/app/provider/sendbody/vertexai_gemini_c2cc1845-277e-4ba2-86f7-1411491aa5fe_gemini-1.5-pro.txt")
         # djson = json.loads(djson)
@@ -74,10 +75,10 @@ if __name__ == "__main__":
             "model": model_name,
             "messages": [{"role": "user", "content": "请用三句话描述春天。"}],
             "stream": True,
-        }):
+        }, ctx=ctx):
             print(response)
 
-        print(interface.DataHeadler.get_stats())
+        print(ctx.DataHeadler.get_stats())
 
 
     asyncio.run(main())
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, HTTPException, Query, Path
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from typing import List
 from app.db.reqCache import RequestCacheManager
 from pydantic import BaseModel
@@ -8,6 +9,8 @@ import datetime
 router = APIRouter()
 cache_manager = RequestCacheManager()
 
+DETAIL_LIMIT = 100000  # 详情里请求和响应内容最多返回的字符数，更长的通过 /payload 接口流式读取
+
 class CacheData(BaseModel):
     md5: str
     req: str
@@ -41,7 +44,7 @@ async def store(cache_data: CacheData):
 
 @router.get("/req_cache/{cache_id}")
 async def show(cache_id: int):
-    cache = cache_manager.find_one(cache_id)
+    cache = cache_manager.find_one(cache_id, DETAIL_LIMIT)
     if cache is None:
         raise HTTPException(status_code=404, detail="缓存不存在")
     return JSONResponse({
@@ -50,6 +53,16 @@ async def show(cache_id: int):
         "data": cache
     })
 
+@router.get("/req_cache/{cache_id}/payload/{field}")
+async def payload(cache_id: int, field: str = Path(..., pattern="^(req|resp)$")):
+    chunks = cache_manager.open_payload(cache_id, field)
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="缓存不存在")
+    # 客户端中途断开时也要关闭 blob、归还数据库连接
+    close = getattr(chunks, "close", None)
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8",
+                             background=BackgroundTask(close) if close else None)
+
 @router.put("/req_cache/{cache_id}")
 async def update(cache_id: int, cache_data: CacheData):
     update_data = cache_data.dict()
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, HTTPException, Query, Body, Path
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import List
 from app.db.reqLogs import RequestLogger
 from pydantic import BaseModel
@@ -8,6 +8,8 @@ import datetime
 router = APIRouter()
 request_logger = RequestLogger()
 
+DETAIL_LIMIT = 100000  # 详情里请求和响应内容最多返回的字符数，更长的通过 /payload 接口流式读取
+
 class LogData(BaseModel):
     req_id: str
 
@@ -40,7 +42,7 @@ async def store(log_data: LogData):
 
 @router.get("/req_logs/{log_id}")
 async def show(log_id: int):
-    log = request_logger.find_one(log_id)
+    log = request_logger.find_one(log_id, DETAIL_LIMIT)
     if log is None:
         raise HTTPException(status_code=404, detail="日志不存在")
     return JSONResponse({
@@ -49,6 +51,13 @@ async def show(log_id: int):
         "data": log
     })
 
+@router.get("/req_logs/{log_id}/payload/{field}")
+async def payload(log_id: int, field: str = Path(..., pattern="^(request_data|response_data)$")):
+    chunks = request_logger.open_payload(log_id, field)
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="日志不存在")
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8")
+
 @router.put("/req_logs/{log_id}")
 async def update(log_id: int, log_data: LogData):
     update_data = log_data.dict()
@@ -0,0 +1,266 @@
+"""生产环境启动入口：多个 worker 进程同时监听一个端口
+
+    python server.py --workers 4 --port 8000
+
+每个 worker 用 SO_REUSEPORT 各自绑定同一个端口，由内核分配新连接，一个 worker 卡住不会挡住其他 worker。
+主进程只负责管理 worker，不加载配置也不处理请求:
+- worker 处理 max_requests (加上随机的 max_requests_jitter) 个请求后通知主进程，
+  主进程先启动一个新 worker，等它可以接受连接后再让旧的优雅退出，一次只回收一个，端口上一直有 worker 在监听
+- 收到 SIGHUP 逐个滚动重启 worker，新 worker 启动完成后才停旧的
+- 收到 SIGTERM/SIGINT 让所有 worker 处理完正在进行的请求后退出，超过 graceful_timeout 秒强制结束
+
+负载均衡的轮询计数器和熔断状态通过 sharedState 放在共享内存里，所有 worker 一致；
+/metrics 会合并所有 worker 的指标。
+Windows 或者系统不支持 SO_REUSEPORT 时退回单进程运行。
+"""
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.sharedState import SharedState, ENV_PATH, fcntl, get_shared_state
+from app.metrics import ENV_DIR
+
+APP = "app.main:app"
+
+logger = logging.getLogger("proapi.server")
+
+
+def supports_multiprocess() -> bool:
+    return fcntl is not None and hasattr(socket, "SO_REUSEPORT")
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerServer(uvicorn.Server):
+    """启动完成和需要回收时通知主进程
+
+    不用 uvicorn 的 limit_max_requests：它到数量就自己退出，几个 worker 同时到数量时端口上没有人监听。
+    """
+
+    def __init__(self, config: uvicorn.Config, max_requests: Optional[int], ready, recycle):
+        super().__init__(config)
+        self.max_requests = max_requests
+        self.ready = ready
+        self.recycle = recycle
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets)
+        if self.started:
+            self.ready.set()
+
+    async def on_tick(self, counter: int) -> bool:
+        if self.max_requests and self.server_state.total_requests >= self.max_requests and not self.recycle.is_set():
+            self.recycle.set()
+        return await super().on_tick(counter)
+
+
+def worker_main(host: str, port: int, max_requests: Optional[int], graceful_timeout: int, log_level: str,
+                ready, recycle):
+    sock = bind_socket(host, port)
+    config = uvicorn.Config(
+        APP,
+        loop="auto",  # 安装了 uvloop 和 httptools 时自动使用
+        http="auto",
+        ws="none",
+        log_level=log_level,
+        timeout_graceful_shutdown=graceful_timeout,
+    )
+    WorkerServer(config, max_requests, ready, recycle).run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.context = multiprocessing.get_context("spawn")
+        self.workers: List[multiprocessing.Process] = []
+        self.started_at: Dict[int, float] = {}
+        self.retiring: Dict[multiprocessing.Process, float] = {}  # 正在优雅退出的旧 worker: 强制结束的时间
+        self.should_exit = False
+        self.should_reload = False
+        self.shared = get_shared_state()
+
+    def spawn(self) -> multiprocessing.Process:
+        args = self.args
+        max_requests = args.max_requests + random.randint(0, args.max_requests_jitter) if args.max_requests else None
+        ready, recycle = self.context.Event(), self.context.Event()
+        process = self.context.Process(
+            target=worker_main,
+            args=(args.host, args.port, max_requests, args.graceful_timeout, args.log_level, ready, recycle),
+        )
+        process.start()
+        process.ready, process.recycle = ready, recycle
+        self.started_at[process.pid] = time.monotonic()
+        logger.info(f"worker {process.pid} 启动，最多处理 {max_requests or '不限'} 个请求")
+        return process
+
+    def forget(self, process: multiprocessing.Process):
+        """worker 已经退出：扣掉它在共享状态里没有结束的请求数和试探"""
+        self.started_at.pop(process.pid, None)
+        if self.shared is not None and self.shared.release_worker(process.pid):
+            logger.info(f"已回收 worker {process.pid} 在共享状态里的请求数")
+
+    def stop(self, process: multiprocessing.Process):
+        """SIGTERM 让 uvicorn 优雅退出，超时强制结束"""
+        if process.is_alive():
+            process.terminate()
+        process.join(self.args.graceful_timeout + 5)
+        if process.is_alive():
+            logger.warning(f"worker {process.pid} 没有按时退出，强制结束")
+            process.kill()
+            process.join()
+        self.forget(process)
+
+    def replace(self, i: int) -> bool:
+        """先启动新 worker，可以接受连接后再停旧的"""
+        old, new = self.workers[i], self.spawn()
+        if not new.ready.wait(self.args.startup_timeout):
+            logger.error(f"新 worker {new.pid} 没有在 {self.args.startup_timeout} 秒内启动，保留旧 worker")
+            self.stop(new)
+            return False
+        self.workers[i] = new
+        # 旧 worker 可能还在输出很长的流式响应，不在这里等它，主循环里回收
+        old.terminate()
+        self.retiring[old] = time.monotonic() + self.args.graceful_timeout + 5
+        return True
+
+    def reap(self):
+        for process, deadline in list(self.retiring.items()):
+            if process.is_alive() and time.monotonic() < deadline:
+                continue
+            if process.is_alive():
+                logger.warning(f"worker {process.pid} 没有按时退出，强制结束")
+                process.kill()
+            process.join()
+            self.forget(process)
+            del self.retiring[process]
+
+    def rolling_restart(self):
+        logger.info("滚动重启所有 worker")
+        for i in range(len(self.workers)):
+            self.replace(i)
+
+    def recycle_one(self):
+        for i, process in enumerate(self.workers):
+            if process.is_alive() and process.recycle.is_set():
+                logger.info(f"worker {process.pid} 达到最大请求数，回收")
+                self.replace(i)
+                return
+
+    def replace_dead(self):
+        for i, process in enumerate(self.workers):
+            if process.is_alive():
+                continue
+            process.join()
+            lifetime = time.monotonic() - self.started_at.get(process.pid, 0)
+            self.forget(process)
+            logger.error(f"worker {process.pid} 意外退出 exitcode={process.exitcode}，启动新的 worker")
+            if lifetime < 1:
+                time.sleep(1)  # 启动就失败 (比如配置错误) 时不要疯狂重启
+            self.workers[i] = self.spawn()
+
+    def handle_exit(self, signum, frame):
+        self.should_exit = True
+
+    def handle_reload(self, signum, frame):
+        self.should_reload = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        # 启动前先试一次绑定，端口被占用时直接报错，不要让 worker 反复重启
+        bind_socket(self.args.host, self.args.port).close()
+        logger.info(f"主进程 {os.getpid()} 监听 {self.args.host}:{self.args.port}，{self.args.workers} 个 worker")
+        # 第一个 worker 启动完成后再启动其他的：建表和补列 (sync_table_structure) 没有锁，同时执行会报表已存在
+        first = self.spawn()
+        if not first.ready.wait(self.args.startup_timeout):
+            logger.error(f"worker {first.pid} 没有在 {self.args.startup_timeout} 秒内启动")
+        self.workers = [first] + [self.spawn() for _ in range(self.args.workers - 1)]
+        while not self.should_exit:
+            if self.should_reload:
+                self.should_reload = False
+                self.rolling_restart()
+            self.replace_dead()
+            self.recycle_one()
+            self.reap()
+            time.sleep(0.5)
+        logger.info("正在停止所有 worker")
+        processes = self.workers + list(self.retiring)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            self.stop(process)
+
+
+def shared_state_path() -> str:
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"proapi-{os.getpid()}.state")
+
+
+def run_multiprocess(args):
+    state_path = shared_state_path()
+    SharedState.create(state_path).close()
+    metrics_dir = tempfile.mkdtemp(prefix="proapi-metrics-")
+    # spawn 出来的 worker 继承环境变量
+    os.environ[ENV_PATH] = state_path
+    os.environ[ENV_DIR] = metrics_dir
+    try:
+        Supervisor(args).run()
+    finally:
+        for path in glob.glob(state_path + "*"):  # 还有各个 worker 的 <path>.<pid>
+            os.remove(path)
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多进程启动 pro-api")
+    env = os.environ.get
+    parser.add_argument("--host", default=env("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(env("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(env("WORKERS", "0")),
+                        help="worker 进程数，0 表示 CPU 核数")
+    parser.add_argument("--max-requests", type=int, default=int(env("MAX_REQUESTS", "10000")),
+                        help="worker 处理这么多请求后重启，释放碎片化的内存，0 表示不重启")
+    parser.add_argument("--max-requests-jitter", type=int, default=int(env("MAX_REQUESTS_JITTER", "1000")))
+    parser.add_argument("--graceful-timeout", type=int, default=int(env("GRACEFUL_TIMEOUT", "30")),
+                        help="停止 worker 时等待正在进行的请求 (包括流式输出) 结束的秒数")
+    parser.add_argument("--startup-timeout", type=int, default=int(env("STARTUP_TIMEOUT", "60")))
+    parser.add_argument("--log-level", default=env("LOG_LEVEL", "info"))
+    args = parser.parse_args(argv)
+    args.workers = args.workers or os.cpu_count() or 1
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.workers > 1 and supports_multiprocess():
+        run_multiprocess(args)
+        return
+    if args.workers > 1:
+        logger.warning("系统不支持 SO_REUSEPORT 或文件锁，使用单进程运行")
+    uvicorn.run(APP, host=args.host, port=args.port, loop="auto", http="auto", ws="none",
+                log_level=args.log_level, timeout_graceful_shutdown=args.graceful_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # windows 没有 flock，只能单进程运行
+    fcntl = None
+
+ENV_PATH = "PROAPI_SHARED_STATE"
+
+# 每个槽: 8 字节的 key 哈希 + FIELDS 个 double
+FIELDS = ("counter", "in_flight", "requests", "errors", "ttft", "tps", "error_rate", "failures",
+          "state", "opened_at", "probing", "used_at")
+INDEX = {name: i for i, name in enumerate(FIELDS)}
+_SLOT = struct.Struct("<Q" + "d" * len(FIELDS))
+SLOTS = 4096
+SIZE = _SLOT.size * SLOTS
+_USED_AT = struct.calcsize("<Q") + struct.calcsize("<d") * INDEX["used_at"]  # used_at 在槽里的偏移
+RECLAIM_AFTER = 3600  # 槽用完时，超过这么多秒没有写过的槽可以给新的 key 用
+
+
+def _hash(key: str) -> int:
+    # 0 表示空槽
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+
+class SlotsFull(RuntimeError):
+    """共享状态的槽已经用完，调用方退回进程内的状态"""
+
+
+class SharedState:
+    """多个 worker 进程共享的计数器和渠道状态
+
+    mmap 同一个文件 (默认在 /dev/shm，就是共享内存)，每个 key 占一个固定大小的槽，
+    读改写都在 flock 文件锁里完成，一次操作只有一对 flock 系统调用和一次 struct 解包，几微秒。
+    槽按 key 的哈希线性探测分配，每个进程缓存 key 对应的槽位置，用的时候检查槽里的哈希，被回收了就重新分配。
+    槽全部用完时回收最久没有写过的槽 (超过 RECLAIM_AFTER 秒)，没有可回收的抛出 SlotsFull。
+    空槽只会被占用不会再空出来，所以回收后线性探测仍然能找到每个 key。
+
+    worker 在 key 上加的 in_flight 和发起的试探另外记在 pid:<pid>:<key> 里 (owner_key)，
+    worker 被杀掉或者回收时正在进行的请求不会再减回去，由主进程调用 release_worker 扣掉。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < SIZE:
+            os.ftruncate(self.fd, SIZE)
+        self.map = mmap.mmap(self.fd, SIZE)
+        self.slots: Dict[str, tuple] = {}
+        self.owned = set()  # 这个进程已经登记过的 owner_key
+        # flock 只在进程之间互斥，同一个进程的线程和嵌套的 transaction 用可重入锁
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @staticmethod
+    def create(path: str) -> "SharedState":
+        """启动时由主进程调用，清空上一次运行留下的状态"""
+        if os.path.exists(path):
+            os.remove(path)
+        return SharedState(path)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._depth == 0:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _offset(self, key: str):
+        """在锁里调用，返回 (槽位置, key 的哈希)"""
+        cached = self.slots.get(key)
+        if cached is not None and struct.unpack_from("<Q", self.map, cached[0])[0] == cached[1]:
+            return cached
+        h = _hash(key)
+        start = h % SLOTS
+        oldest = None
+        for i in range(SLOTS):
+            offset = ((start + i) % SLOTS) * _SLOT.size
+            current = struct.unpack_from("<Q", self.map, offset)[0]
+            if current == h:
+                break
+            if current == 0:
+                self._reset(offset, h)
+                break
+            used_at = struct.unpack_from("<d", self.map, offset + _USED_AT)[0]
+            if oldest is None or used_at < oldest[1]:
+                oldest = (offset, used_at)
+        else:
+            if oldest is None or time.time() - oldest[1] < RECLAIM_AFTER:
+                raise SlotsFull("共享状态的槽已经用完")
+            offset = oldest[0]
+            self._reset(offset, h)
+        self.slots[key] = (offset, h)
+        return offset, h
+
+    @staticmethod
+    def _init_values() -> List[float]:
+        values = [0.0] * len(FIELDS)
+        values[INDEX["ttft"]] = values[INDEX["tps"]] = math.nan
+        values[INDEX["used_at"]] = time.time()
+        return values
+
+    def _reset(self, offset: int, h: int):
+        _SLOT.pack_into(self.map, offset, h, *self._init_values())
+
+    @contextmanager
+    def transaction(self, key: str):
+        """加锁读出 key 的全部字段，with 块里修改列表，退出时写回"""
+        with self._locked():
+            offset, h = self._offset(key)
+            values = list(_SLOT.unpack_from(self.map, offset)[1:])
+            yield values
+            values[INDEX["used_at"]] = time.time()
+            _SLOT.pack_into(self.map, offset, h, *values)
+
+    def read(self, key: str) -> List[float]:
+        with self._locked():
+            return list(_SLOT.unpack_from(self.map, self._offset(key)[0])[1:])
+
+    def incr(self, key: str, field: str = "counter", amount: float = 1) -> float:
+        """原子加，返回加之前的值"""
+        with self.transaction(key) as values:
+            old = values[INDEX[field]]
+            values[INDEX[field]] = old + amount
+        return old
+
+    def owner_key(self, key: str) -> str:
+        """这个进程在 key 上的份额，第一次用到时把 key 记到 <path>.<pid> 文件里，主进程据此回收"""
+        pid = os.getpid()
+        owner = f"pid:{pid}:{key}"
+        if owner not in self.owned:
+            with open(f"{self.path}.{pid}", "a", encoding="utf-8") as f:
+                f.write(key + "\n")
+            self.owned.add(owner)
+        return owner
+
+    def release_worker(self, pid: int) -> int:
+        """worker 退出后由主进程调用：扣掉它没有减回去的 in_flight，清除它没有结束的试探，返回处理的 key 数
+
+        它的 pid:<pid>:<key> 槽标记为最久没用，槽用完时优先回收。
+        """
+        path = f"{self.path}.{pid}"
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                keys = set(f.read().splitlines())
+        except FileNotFoundError:
+            return 0
+        in_flight, probing = INDEX["in_flight"], INDEX["probing"]
+        for key in keys:
+            owner = f"pid:{pid}:{key}"
+            with self._locked():
+                with self.transaction(key) as values, self.transaction(owner) as owned:
+                    values[in_flight] = max(0.0, values[in_flight] - owned[in_flight])
+                    if owned[probing] and values[probing] == owned[probing]:
+                        values[probing] = 0.0
+                    owned[in_flight] = owned[probing] = 0.0
+                struct.pack_into("<d", self.map, self._offset(owner)[0] + _USED_AT, 0.0)
+        os.remove(path)
+        return len(keys)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+_shared: Optional[SharedState] = None
+
+
+def get_shared_state() -> Optional[SharedState]:
+    """多进程模式下 server.py 通过环境变量传入共享文件路径，单进程时返回 None，状态只保存在进程内"""
+    global _shared
+    path = os.environ.get(ENV_PATH)
+    if not path or fcntl is None:
+        return None
+    if _shared is None or _shared.path != path:
+        _shared = SharedState(path)
+    return _shared
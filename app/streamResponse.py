@@ -0,0 +1,54 @@
+"""把上游剩下的流式数据交给 StreamingResponse，并保证结束时的统计只做一次"""
+import asyncio
+from typing import AsyncGenerator, Callable
+
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+
+from fastapi.logger import logger
+
+DISCONNECTED = ("499", "客户端断开连接")
+
+
+class UpstreamStream:
+    """上游尝试胜出之后的数据块
+
+    结束时的工作 (渠道 finish、监控指标、请求日志) 由 on_finish(api_status, api_error) 完成，close() 保证只调用一次：
+    - 正常结束或者出错时由迭代的 finally 调用
+    - 客户端在开始读取响应体之前就断开时生成器根本不会运行，由 StreamingResponse 的 background 调用，
+      同时关闭上游的生成器，释放上游连接
+    """
+
+    def __init__(self, genData: AsyncGenerator[bytes, None], on_finish: Callable[[str, str], None],
+                 debug: bool = False):
+        self.genData = genData
+        self.on_finish = on_finish
+        self.debug = debug
+        self.api_status, self.api_error = DISCONNECTED
+        self.closed = False
+
+    async def __aiter__(self):
+        try:
+            # chunk 已经是编码好的 SSE 字节，原样交给 ASGI
+            async for chunk in self.genData:
+                yield chunk
+                if self.debug:
+                    await asyncio.sleep(0.1)
+                    logger.info(f"发送到客户端\r\n{chunk.decode()}")
+            self.api_status, self.api_error = "200", ""
+        except Exception as e:
+            self.api_status, self.api_error = "500", str(e)
+            raise
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # 先记录再关闭上游，客户端断开时这里的 await 可能被取消
+        self.on_finish(self.api_status, self.api_error)
+        await self.genData.aclose()
+
+    def response(self, **kwargs) -> StreamingResponse:
+        return StreamingResponse(self, background=BackgroundTask(self.close), **kwargs)
@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.db import comm
+from app.db.comm import create_db_engine
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """每个测试一个新的 sqlite 文件，数据库模块通过 get_engine() 拿到的都是它"""
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'logs.db'}")
+    monkeypatch.setattr(comm, "_engine", engine)
+    monkeypatch.setattr(comm, "_Session", sessionmaker(bind=engine))
+    return engine
+
+
+def log(request_data="{}", response_data="", **kwargs):
+    return {"req_id": "r1", "service_provider": "p", "token": "sk", "model": "m", "prompt": 1, "completion": 2,
+            "quota": 0, "uri": "/v1", "request_data": request_data, "response_data": response_data,
+            "api_status": "200", "api_error": "", **kwargs}
+
+
+def insert_legacy_log(data):
+    """像旧版本一样把请求和响应内容直接写在 req_logs 里，返回 id"""
+    from app.db.reqLogs import ReqLog
+
+    with comm.get_session_factory()() as session:
+        row = ReqLog(**data)
+        session.add(row)
+        session.commit()
+        return row.id
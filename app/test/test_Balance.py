@@ -0,0 +1,130 @@
+import time
+
+from app.Balance import Balance, BalanceManager, OPEN, HALF_OPEN, CLOSED, hedge_primary
+
+
+def providers(*weights):
+    return [{"name": f"P{i + 1}", "provider": "openai", "original_model": "m", "weight": w}
+            for i, w in enumerate(weights)]
+
+
+def names(balance, count, **kwargs):
+    return [balance.next(**kwargs).data["name"] for _ in range(count)]
+
+
+def test_round_robin_matches_readme():
+    balance = Balance("m", providers(1, 2, 0))
+    assert names(balance, 6) == ["P1", "P2", "P2", "P1", "P2", "P2"]
+
+
+def test_smooth_wrr_interleaves():
+    balance = Balance("m", providers(1, 2), "smooth_wrr")
+    assert names(balance, 6) == ["P2", "P1", "P2", "P2", "P1", "P2"]
+
+
+def test_exclude():
+    balance = Balance("m", providers(1, 1))
+    assert names(balance, 3, exclude={"openai_P1:m"}) == ["P2", "P2", "P2"]
+    assert balance.next(exclude={"openai_P1:m", "openai_P2:m"}) is None
+
+
+def test_circuit_breaker_half_open_probe():
+    balance = Balance("m", providers(1, 1), config={"failure_threshold": 2, "cooldown": 0})
+    stats = balance.providers["P1"].stats
+    for _ in range(2):
+        stats.start()
+        stats.finish(False)
+    assert stats.state == OPEN
+    # cooldown 为 0，下一次选择时进入半开，只放一个请求
+    assert stats.available(time.monotonic())
+    assert stats.state == HALF_OPEN
+    stats.start()
+    assert not stats.available(time.monotonic())
+    stats.finish(True, tokens=10, duration=1.0)
+    assert stats.state == CLOSED
+    assert stats.tps == 10
+
+
+def test_open_provider_is_skipped():
+    balance = Balance("m", providers(1, 1), config={"failure_threshold": 1, "cooldown": 60})
+    stats = balance.providers["P1"].stats
+    stats.start()
+    stats.finish(False)
+    assert names(balance, 4) == ["P2", "P2", "P2", "P2"]
+
+
+def test_manager_shares_stats_per_provider():
+    manager = BalanceManager({"policy": "least_in_flight"})
+    data = providers(1, 1)
+    a = manager.get("m", data)
+    assert manager.get("m", data) is a
+    b = manager.get("alias", data)
+    assert b is not a
+    assert a.providers["P1"].stats is b.providers["P1"].stats
+
+
+def test_manager_keeps_recent_balances():
+    manager = BalanceManager(max_size=2)
+    data = providers(1, 1)
+    a = manager.get("a", data)
+    manager.get("b", data)
+    assert manager.get("a", data) is a
+    for i in range(100):
+        manager.get(f"random-{i}", data)  # 随意的模型名称都落到兜底渠道
+    assert list(manager.balances) == ["random-98", "random-99"]
+    assert len(manager.provider_stats) == 2
+
+
+def test_ttft_percentile_and_hedge_cap():
+    balance = Balance("m", providers(1, 1))
+    for i in range(19):
+        balance.record_ttft(i / 100)
+    assert balance.ttft_percentile(0.9) is None
+    balance.record_ttft(0.19)
+    assert balance.ttft_percentile(0.9) == 0.18
+    balance.requests = 10
+    assert balance.allow_hedge(0.1)
+    balance.hedges = 1
+    assert not balance.allow_hedge(0.1)
+
+
+class Attempt:
+    def __init__(self, start_time, hedged=False):
+        self.start_time = start_time
+        self.hedged = hedged
+
+
+def test_hedge_timer_restarts_after_failover():
+    hedge_delay = 1.0
+    first = Attempt(0.0)
+    assert hedge_primary([first]) is first
+    # 第一个渠道 2 秒后失败，换渠道重试，重试的请求要再等一个 p90 才对冲
+    replacement = Attempt(2.0)
+    pending = [replacement]
+    now = 2.0
+    primary = hedge_primary(pending)
+    assert primary is replacement
+    assert now - primary.start_time < hedge_delay
+    assert primary.start_time + hedge_delay - now == hedge_delay
+    hedged = Attempt(3.0, hedged=True)
+    pending.append(hedged)
+    assert hedge_primary(pending) is replacement
+    assert hedge_primary([hedged]) is None
+
+
+def test_stuck_probe_expires():
+    config = {"failure_threshold": 1, "cooldown": 0, "probe_timeout": 60}
+    stats = Balance("m", providers(1), config=config).providers["P1"].stats
+    stats.start()
+    stats.finish(False)
+    now = time.monotonic()
+    assert stats.available(now)
+    stats.start()  # 试探一直没有结束
+    assert not stats.available(now + 30)
+    assert stats.available(now + 61)
+
+
+def test_route_is_the_configured_model():
+    # 监控标签和共享计数器用配置里的模型名，请求里随意的名称落到兜底模型时也一样
+    assert Balance("whatever-the-client-sent", providers(1)).route == "m"
+    assert Balance("m", []).route == "m"
@@ -0,0 +1,123 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+import ujson as json
+
+from app.provider.httpxHelp import upstream_clients
+from app.provider.vertexai import accessToken
+from app.provider.vertexai.accessToken import AccessTokenManager
+
+
+class TokenEndpoint:
+    """假的 oauth2 token 接口：每次返回新的 token，gate 没有打开时卡住"""
+
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.calls = 0
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def handle(self, request):
+        self.calls += 1
+        body = json.loads(request.content)
+        assert body["grant_type"] == "refresh_token" and body["client_id"] == "id"
+        await self.gate.wait()
+        return httpx.Response(200, json={"access_token": f"token-{self.calls}", "expires_in": self.expires_in})
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(accessToken, "time", clock)
+    holder = {}
+
+    @asynccontextmanager
+    async def use(url, http_config=None):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(holder["endpoint"].handle)) as client:
+            yield client
+
+    monkeypatch.setattr(upstream_clients, "use", use)
+
+    def create(**kwargs):
+        holder["endpoint"] = TokenEndpoint(**kwargs)
+        holder["endpoint"].clock = clock
+        return holder["endpoint"]
+
+    return create
+
+
+def get(manager):
+    return manager.get_token("id", "secret", "refresh")
+
+
+def test_concurrent_callers_share_one_refresh(endpoint):
+    async def run():
+        server = endpoint()
+        manager = AccessTokenManager()
+        tokens = await asyncio.gather(*[get(manager) for _ in range(20)])
+        assert tokens == ["token-1"] * 20
+        assert server.calls == 1
+        assert await get(manager) == "token-1" and server.calls == 1
+
+    asyncio.run(run())
+
+
+def test_refresh_before_expiry_serves_old_token(endpoint):
+    async def run():
+        server = endpoint(expires_in=3600)
+        manager = AccessTokenManager(refresh_margin=300, min_valid=60)
+        assert await get(manager) == "token-1"
+
+        server.clock.now += 3600 - 301
+        assert await get(manager) == "token-1" and server.calls == 1  # 还没到 refresh_margin
+
+        server.clock.now += 2
+        server.gate.clear()
+        # 进入 refresh_margin：立即返回旧 token，后台只有一个刷新
+        assert [await get(manager) for _ in range(5)] == ["token-1"] * 5
+        await asyncio.sleep(0)
+        assert server.calls == 2
+        server.gate.set()
+        await manager.tokens["id"].task
+        assert await get(manager) == "token-2" and server.calls == 2
+
+    asyncio.run(run())
+
+
+def test_expired_token_waits_for_refresh(endpoint):
+    async def run():
+        server = endpoint(expires_in=3600)
+        manager = AccessTokenManager(refresh_margin=300, min_valid=60)
+        await get(manager)
+        server.clock.now += 3600 - 30  # 剩下的有效期不够 min_valid，不能再用旧的
+        assert await get(manager) == "token-2"
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_refresh(endpoint):
+    async def run():
+        server = endpoint()
+        server.gate.clear()
+        manager = AccessTokenManager()
+        first = asyncio.create_task(get(manager))
+        second = asyncio.create_task(get(manager))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        server.gate.set()
+        assert await second == "token-1"
+        assert first.cancelled()
+        assert not manager.tokens["id"].task.cancelled() and server.calls == 1
+
+    asyncio.run(run())
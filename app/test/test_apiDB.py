@@ -0,0 +1,55 @@
+from app.apiDB import apiDB
+
+CONFIG = """
+server:
+  default_model: glm-4-flash
+tokens:
+  - api_key: sk-all
+    model: [all]
+  - api_key: sk-glm
+    model: ["glm*", gpt-4o]
+providers:
+  - name: p1
+    provider: openai
+    base_url: http://127.0.0.1
+    api_key: k
+    model: [glm-4-flash, gpt-4o, {gpt-4o: g4}]
+  - name: p2
+    provider: openai
+    base_url: http://127.0.0.1
+    api_key: k
+    model: [glm-4-flash]
+"""
+
+
+def names(result):
+    return [p["name"] for p in result[0]]
+
+
+def test_verify_token():
+    db = apiDB(CONFIG)
+    assert db.verify_token("sk-all")
+    assert db.verify_token("sk-glm")
+    assert not db.verify_token("sk-none")
+
+
+def test_user_provider_wildcard_and_default():
+    db = apiDB(CONFIG)
+    assert names(db.get_user_provider("sk-glm", "glm-4-flash")) == ["p1", "p2"]
+    assert names(db.get_user_provider("sk-glm", "gpt-4o")) == ["p1"]
+    # glm* 允许但没有渠道，使用兜底模型
+    assert names(db.get_user_provider("sk-glm", "glm-x")) == ["p1", "p2"]
+    assert db.get_user_provider("sk-glm", "g4") == ([], "用户无权使用模型: g4")
+    assert names(db.get_user_provider("sk-all", "g4")) == ["p1"]
+    assert db.get_user_provider("sk-none", "g4") == ([], "没有授权")
+
+
+def test_reload_replaces_resolution_cache():
+    db = apiDB(CONFIG)
+    assert names(db.get_user_provider("sk-glm", "gpt-4o")) == ["p1"]
+    db.update_config({
+        "server": {},
+        "tokens": [{"api_key": "sk-glm", "model": ["glm*"]}],
+        "providers": [{"name": "p3", "provider": "openai", "model": ["gpt-4o"]}],
+    })
+    assert db.get_user_provider("sk-glm", "gpt-4o") == ([], "用户无权使用模型: gpt-4o")
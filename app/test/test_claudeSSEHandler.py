@@ -0,0 +1,63 @@
+import ujson as json
+
+from app.provider.vertexai.claudeSSEHandler import claudeSSEHandler
+
+
+def events(*items):
+    return ["data: " + json.dumps(item) for item in items]
+
+
+STREAM = events(
+    {"type": "message_start", "message": {"id": "msg_1", "model": "claude-3-5-sonnet", "usage": {"input_tokens": 10}}},
+    {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+    {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "查一下"}},
+    {"type": "content_block_stop", "index": 0},
+    {"type": "content_block_start", "index": 1,
+     "content_block": {"type": "tool_use", "id": "toolu_a", "name": "get_weather", "input": {}}},
+    {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": ""}},
+    {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": "{\"city\":"}},
+    {"type": "content_block_start", "index": 2,
+     "content_block": {"type": "tool_use", "id": "toolu_b", "name": "get_time", "input": {}}},
+    {"type": "content_block_delta", "index": 2, "delta": {"type": "input_json_delta", "partial_json": "{}"}},
+    {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": "\"北京\"}"}},
+    {"type": "message_delta", "delta": {"stop_reason": "tool_use"}, "usage": {"output_tokens": 20}},
+    {"type": "message_stop"},
+)
+
+
+def deltas(handler, lines):
+    out = []
+    for line in lines:
+        chunk = handler.handle_SSE_data_line(line)
+        if chunk and chunk != b"data: [DONE]\n\n":
+            out.append(json.loads(chunk[6:])["choices"][0])
+    return out
+
+
+def test_incremental_parallel_tool_call_deltas():
+    handler = claudeSSEHandler("id", "m")
+    choices = deltas(handler, STREAM)
+    tool_deltas = [c["delta"]["tool_calls"][0] for c in choices if "tool_calls" in c["delta"]]
+    assert tool_deltas == [
+        {"index": 0, "id": "toolu_a", "type": "function", "function": {"name": "get_weather", "arguments": ""}},
+        {"index": 0, "function": {"arguments": "{\"city\":"}},
+        {"index": 1, "id": "toolu_b", "type": "function", "function": {"name": "get_time", "arguments": ""}},
+        {"index": 1, "function": {"arguments": "{}"}},
+        {"index": 0, "function": {"arguments": "\"北京\"}"}},
+    ]
+    assert choices[-1]["finish_reason"] == "tool_calls"
+    stats = handler.get_stats()
+    assert stats["full_message_content"] == "查一下"
+    assert stats["tool_calls"] == [
+        {"id": "toolu_a", "type": "function", "function": {"name": "get_weather", "arguments": "{\"city\":\"北京\"}"}},
+        {"id": "toolu_b", "type": "function", "function": {"name": "get_time", "arguments": "{}"}},
+    ]
+
+
+def test_output_grows_linearly_with_arguments():
+    fragment = {"type": "content_block_delta", "index": 0, "delta": {"type": "input_json_delta", "partial_json": "x" * 10}}
+    start = {"type": "content_block_start", "index": 0,
+             "content_block": {"type": "tool_use", "id": "toolu_a", "name": "f", "input": {}}}
+    handler = claudeSSEHandler("id", "m", accumulate=False)
+    sizes = [len(handler.handle_SSE_data_line(line)) for line in events(start, *[fragment] * 100)]
+    assert max(sizes[1:]) == min(sizes[1:])
@@ -0,0 +1,48 @@
+import threading
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, text
+
+from app.db.comm import create_db_engine, sync_table_structure
+
+
+def test_pragmas_and_reader_not_blocked_by_writer(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'a.db'}", {"busy_timeout": 200})
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 200
+        conn.execute(text("CREATE TABLE t (v INTEGER)"))
+        conn.execute(text("INSERT INTO t VALUES (1)"))
+        conn.commit()
+
+    writer = engine.connect()
+    writer.execute(text("INSERT INTO t VALUES (2)"))  # 事务没有提交，持有写锁
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        engine.connect().execute(text("SELECT count(*) FROM t")).scalar()))
+    thread.start()
+    thread.join(5)
+    writer.commit()
+    writer.close()
+    assert result == [1]
+
+
+def test_sync_table_structure_adds_columns_once(tmp_path):
+    url = f"sqlite:///{tmp_path / 'b.db'}"
+    old = MetaData()
+    Table("logs", old, Column("id", Integer, primary_key=True))
+    sync_table_structure(old, create_db_engine(url))
+
+    # 升级后重新启动
+    engine = create_db_engine(url)
+    new = MetaData()
+    Table("logs", new, Column("id", Integer, primary_key=True), Column("name", String(10), index=True))
+    sync_table_structure(new, engine)
+    assert {c["name"] for c in inspect(engine).get_columns("logs")} == {"id", "name"}
+    assert [i["name"] for i in inspect(engine).get_indexes("logs")] == ["ix_logs_name"]
+
+    with engine.connect() as conn:
+        conn.execute(text("DROP TABLE logs"))
+        conn.commit()
+    sync_table_structure(new, engine)  # 这个进程已经同步过，不再检查
+    assert not inspect(engine).has_table("logs")
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app.Balance import Balance
+from app.failover import Failover, UpstreamAttempt, first_chunk_timeout
+from app.streamResponse import UpstreamStream
+
+
+class FakeProviders:
+    """假的上游：按渠道名决定行为，记录每个渠道被请求和关闭的次数"""
+
+    def __init__(self, **behaviours):
+        self.behaviours = behaviours
+        self.opened = []
+        self.closed = []
+
+    def open_attempt(self, number, upstream, hedged):
+        name = upstream.data["name"]
+        self.opened.append(name)
+        ctx = SimpleNamespace(labels=(name, "m"))
+        return UpstreamAttempt(number, upstream, name, {}, ctx, self.generate(name), hedged)
+
+    async def generate(self, name):
+        try:
+            for step in self.behaviours[name]:
+                if isinstance(step, Exception):
+                    raise step
+                if isinstance(step, (int, float)):
+                    await asyncio.sleep(step)
+                else:
+                    yield step
+        finally:
+            self.closed.append(name)
+
+
+def balance(count):
+    return Balance("m", [{"name": f"P{i + 1}", "provider": "openai", "original_model": "m", "weight": 1}
+                         for i in range(count)])
+
+
+def run(fake, count=3, **kwargs):
+    async def main():
+        b = balance(count)
+        race = Failover(b, fake.open_attempt, "m", **kwargs)
+        winner = await race.run(b.next())
+        return b, race, winner
+
+    return asyncio.run(main())
+
+
+def test_failover_before_first_chunk():
+    fake = FakeProviders(P1=[HTTPException(status_code=502, detail="bad gateway")], P2=[b"data"], P3=[b"data"])
+    b, race, winner = run(fake)
+    assert fake.opened == ["P1", "P2"]
+    assert winner.upstream.data["name"] == "P2" and winner.number == 2
+    assert winner.task.result() == b"data"
+    assert b.providers["P1"].stats.failures == 1
+    assert b.providers["P1"].stats.in_flight == 0
+
+
+def test_client_error_is_not_retried():
+    fake = FakeProviders(P1=[HTTPException(status_code=400, detail="bad request")], P2=[b"data"])
+    b, race, winner = run(fake, count=2)
+    assert winner is None and fake.opened == ["P1"]
+    assert race.error.status_code == 400
+
+
+def test_max_attempts():
+    error = HTTPException(status_code=503, detail="unavailable")
+    fake = FakeProviders(P1=[error], P2=[error], P3=[b"data"])
+    b, race, winner = run(fake, max_attempts=2)
+    assert winner is None and fake.opened == ["P1", "P2"]
+    assert race.error is error
+
+
+def test_attempt_timeout_fails_over_a_stalled_provider():
+    fake = FakeProviders(P1=[10, b"late"], P2=[b"data"])
+    start = time.perf_counter()
+    b, race, winner = run(fake, count=2, attempt_timeout=0.05)
+    assert time.perf_counter() - start < 1
+    assert winner.upstream.data["name"] == "P2"
+    # 卡住的请求被取消并关闭连接，算作一次渠道失败
+    assert "P1" in fake.closed
+    assert isinstance(race.attempts[0].error, asyncio.TimeoutError)
+    assert b.providers["P1"].stats.failures == 1 and b.providers["P1"].stats.in_flight == 0
+
+
+def test_deadline_stops_all_attempts():
+    fake = FakeProviders(P1=[10], P2=[10], P3=[10])
+    start = time.perf_counter()
+    b, race, winner = run(fake, deadline=0.1, attempt_timeout=0.04)
+    assert time.perf_counter() - start < 1
+    assert winner is None and isinstance(race.error, asyncio.TimeoutError)
+    assert sorted(fake.closed) == sorted(fake.opened)
+    assert all(p.stats.in_flight == 0 for p in b.providers.values())
+
+
+def test_first_chunk_timeout():
+    start = time.perf_counter()
+    assert first_chunk_timeout(start) is None
+    assert first_chunk_timeout(start, attempt_timeout=5) == 5
+    assert 0 < first_chunk_timeout(start, deadline=2, attempt_timeout=5) <= 2
+    assert first_chunk_timeout(start - 3, deadline=2, attempt_timeout=5) == 0
+
+
+def test_no_failover_after_bytes_reach_client():
+    fake = FakeProviders(P1=[b"first", HTTPException(status_code=502, detail="bad gateway")], P2=[b"data"])
+    finished = []
+
+    async def main():
+        b = balance(2)
+        race = Failover(b, fake.open_attempt, "m")
+        winner = await race.run(b.next())
+        chunks = [winner.task.result()]
+        with pytest.raises(HTTPException):
+            async for chunk in UpstreamStream(winner.genData, lambda *args: finished.append(args)):
+                chunks.append(chunk)
+        return race, chunks
+
+    race, chunks = asyncio.run(main())
+    assert chunks == [b"first"]
+    assert fake.opened == ["P1"] and len(race.attempts) == 1
+    assert finished == [("500", "502: bad gateway")]
+
+
+def test_hedge_wins_and_loser_is_cancelled():
+    fake = FakeProviders(P1=[10, b"slow"], P2=[b"fast"])
+
+    async def main():
+        b = balance(2)
+        b.requests = 10
+        race = Failover(b, fake.open_attempt, "m", hedge_delay=0.05, hedge_ratio=0.5)
+        winner = await race.run(b.next())
+        # 胜出的请求还要继续读，只关闭输掉的
+        assert fake.closed == ["P1"]
+        return b, winner
+
+    b, winner = asyncio.run(main())
+    assert winner.upstream.data["name"] == "P2" and winner.hedged
+    assert b.hedges == 1
+    # 对冲输掉不算渠道失败
+    assert b.providers["P1"].stats.failures == 0 and b.providers["P1"].stats.in_flight == 0
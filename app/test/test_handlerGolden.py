@@ -0,0 +1,24 @@
+import contextlib
+import io
+
+import pytest
+import ujson as json
+
+from app.benchmark.handlerFixtures import golden_fixtures, golden_path, handler_classes, normalize, replay
+
+FIXTURES = golden_fixtures()
+
+
+@pytest.mark.parametrize("fixture", FIXTURES, ids=[f.name for f in FIXTURES])
+def test_handler_output_matches_golden(fixture):
+    """handler 的输出和统计要和 golden 文件一致，改了输出格式时用 bench_handlers.py --update-golden 重新生成"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = normalize(*replay(fixture, handler_classes()[fixture.handler]))
+    with open(golden_path(fixture), "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    assert json.loads(json.dumps(result)) == expected
+
+
+def test_recorded_fixtures_found():
+    names = {f.handler for f in FIXTURES}
+    assert {"openai", "gemini", "claude", "cohere", "merlin"} <= names
@@ -0,0 +1,88 @@
+import asyncio
+
+from app.provider import httpxHelp
+from app.provider.baseProvider import baseProvider
+from app.provider.httpxHelp import UpstreamClientPool
+
+
+def test_one_client_per_origin():
+    pool = UpstreamClientPool()
+    client = pool.get_client("https://api.example.com/v1/chat/completions")
+    assert pool.get_client("https://api.example.com/v1/models") is client
+    assert pool.get_client("https://api.example.com:8443/v1/models") is not client
+    assert pool.get_client("http://api.example.com/v1/models") is not client
+    assert pool.get_client("https://other.example.com/v1/models") is not client
+    assert len(pool.entries) == 4
+
+
+def test_http_config_gets_its_own_client():
+    pool = UpstreamClientPool({"max_connections": 50})
+    url = "https://api.example.com/v1/chat/completions"
+    shared = pool.get_client(url)
+    # provider 的 http 配置和默认值一样时还是同一个连接池
+    assert pool.get_client(url, {"max_connections": 50}) is shared
+
+    provider = baseProvider()
+    provider.setHttpConfig({"max_connections": 5, "timeout": {"read": 30}})
+    client = pool.get_client(url, provider.http_config)
+    assert client is not shared
+    assert pool.get_client(url, provider.http_config) is client
+    entry = next(e for e in pool.entries.values() if e.client is client)
+    assert entry.options["max_connections"] == 5
+    # timeout 只覆盖写出来的部分
+    assert entry.options["timeout"] == {**httpxHelp.DEFAULT_HTTP_CONFIG["timeout"], "read": 30}
+    assert client.timeout.read == 30 and client.timeout.connect == 120
+
+    # configure 只影响之后新建的连接池
+    pool.configure({"max_connections": 10})
+    assert pool.get_client(url) is not shared
+
+
+def test_use_counts_requests():
+    async def run():
+        pool = UpstreamClientPool()
+        url = "https://api.example.com/v1/chat/completions"
+        async with pool.use(url) as a:
+            async with pool.use(url) as b:
+                assert a is b
+                assert pool.stats()[0]["in_flight"] == 2
+        stats = pool.stats()[0]
+        assert stats["requests"] == 2 and stats["in_flight"] == 0
+        assert stats["origin"] == "https://api.example.com"
+        await pool.aclose()
+
+    asyncio.run(run())
+
+
+def test_aclose_closes_every_client():
+    async def run():
+        pool = UpstreamClientPool()
+        clients = [pool.get_client("https://a.example.com"), pool.get_client("https://b.example.com"),
+                   pool.get_client("https://a.example.com", {"http2": False, "max_connections": 1})]
+        await pool.aclose()
+        assert all(client.is_closed for client in clients)
+        assert pool.entries == {}
+        # 关闭之后再用会重新创建
+        client = pool.get_client("https://a.example.com")
+        assert client not in clients and not client.is_closed
+        await pool.aclose()
+
+    asyncio.run(run())
+
+
+def test_closed_client_is_replaced():
+    async def run():
+        pool = UpstreamClientPool()
+        client = pool.get_client("https://a.example.com")
+        await client.aclose()
+        assert pool.get_client("https://a.example.com") is not client
+        await pool.aclose()
+
+    asyncio.run(run())
+
+
+def test_http2_without_h2_falls_back(monkeypatch):
+    monkeypatch.setattr(httpxHelp, "HAS_H2", False)
+    pool = UpstreamClientPool({"http2": True})
+    pool.get_client("https://a.example.com")
+    assert pool.stats()[0]["http2"] is False
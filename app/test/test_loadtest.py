@@ -0,0 +1,70 @@
+import asyncio
+
+import httpx
+import yaml
+
+from app.apiDB import apiDB
+from app.loadtest.driver import Workload, run_workload, percentile, added_latency
+from app.loadtest.genConfig import build_config, dump_config, MODELS
+from app.loadtest.mockUpstream import MockConfig, create_app
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_driver_against_mock_openai():
+    app = create_app(MockConfig(tps=0, ttft=0, tokens=5))
+    workload = Workload("http://mock/v1", stream_ratio=0.5)
+    summary = run(run_workload(workload, "closed", concurrency=4, rate=0, duration=0, requests=20,
+                               transport=httpx.ASGITransport(app=app)))
+    assert summary["all"]["requests"] == 20
+    assert summary["all"]["errors"] == 0
+    assert summary["all"]["ttft"]["p50"] is not None
+    assert sum(s["requests"] for name, s in summary.items() if name != "all") == 20
+    assert app.state.mock.requests == 20
+
+
+def test_mock_error_rate():
+    app = create_app(MockConfig(ttft=0, tokens=1, error_rate=1.0))
+    summary = run(run_workload(Workload("http://mock/v1", stream_ratio=0), "closed", 2, 0, 0, requests=4,
+                               transport=httpx.ASGITransport(app=app)))
+    assert summary["all"]["error_rate"] == 1.0
+    assert summary["all"]["error_types"] == {"HTTP 500": 4}
+
+
+def test_mock_formats():
+    async def main():
+        transport = httpx.ASGITransport(app=create_app(MockConfig(tps=0, ttft=0, tokens=3)))
+        async with httpx.AsyncClient(transport=transport, base_url="http://mock") as client:
+            gemini = await client.post("/v1beta/models/mock:streamGenerateContent?alt=sse", json={})
+            claude = await client.post("/v1/projects/p/locations/l/publishers/anthropic/models/m:streamRawPredict",
+                                       json={"stream": True})
+            cloudflare = await client.post("/client/v4/accounts/a/ai/run/@cf/mock/model", json={})
+            config = await client.get("/api.yaml")
+        return gemini, claude, cloudflare, config
+
+    gemini, claude, cloudflare, config = run(main())
+    assert gemini.text.count("data: ") == 4
+    assert "event: message_stop" in claude.text
+    assert cloudflare.json()["result"]["response"] == "你好，这是"
+    assert yaml.safe_load(config.text)["providers"][0]["base_url"] == "http://mock/v1"
+
+
+def test_generated_config_routes_every_model():
+    db = apiDB(dump_config(build_config(["http://127.0.0.1:9200", "http://127.0.0.1:9201"])))
+    for model in MODELS:
+        providers, _ = db.get_user_provider("sk-loadtest", model)
+        assert len(providers) == 2
+    claude = db.get_user_provider("sk-loadtest", "mock-claude")[0][0]
+    assert claude["mapped_model"] == "claude-3-5-sonnet@mock"
+    assert claude["token_url"] == "http://127.0.0.1:9200/token"
+
+
+def test_percentile_and_added_latency():
+    assert percentile([], 0.5) is None
+    assert percentile([0.3, 0.1, 0.2], 0.5) == 0.2
+    gateway = {"ttft": {"p50": 0.3}, "latency": {"p50": None}}
+    baseline = {"ttft": {"p50": 0.1}, "latency": {"p50": 0.2}}
+    assert round(added_latency(gateway, baseline)["ttft"]["p50"], 3) == 0.2
+    assert added_latency(gateway, baseline)["latency"]["p50"] is None
@@ -0,0 +1,70 @@
+from sqlalchemy import text
+
+from app.db.pagination import CountCache
+from app.test.conftest import log
+
+
+def ids(logs):
+    return sorted(item["id"] for item in logs)
+
+
+def test_keyword_search_uses_fts_index(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger
+
+    LogWriter().insert_req_logs([
+        log(req_id="aaaa-1111", model="gpt-4o-mini", uri="/v1/chat/completions"),
+        log(req_id="bbbb-2222", model="glm-4-flash", uri="/v1/chat/completions", token="sk-Secret"),
+        log(req_id="cccc-3333", model="gpt-4o", uri="/v1/embeddings"),
+    ])
+    reader = RequestLogger()
+    reader.counts = CountCache(background=False)
+    assert reader.fts
+
+    logs, total = reader.index("4o", 10, 1)  # 少于 3 个字符走 LIKE
+    assert total == 2
+    logs, total = reader.index("gpt-4o", 10, 1)
+    assert total == 2 and {item["req_id"] for item in logs} == {"aaaa-1111", "cccc-3333"}
+    assert reader.index("SECRET", 10, 1)[1] == 1  # 和 LIKE 一样不区分大小写
+    assert reader.index("embed", 10, 1)[0][0]["req_id"] == "cccc-3333"
+    assert reader.index('say "hi"', 10, 1) == ([], 0)
+
+    # 完整的请求ID直接走 req_id 索引
+    logs, total = reader.index("bbbb-2222", 10, 1)
+    assert total == 1 and logs[0]["model"] == "glm-4-flash"
+
+    # 触发器同步修改和删除
+    first = reader.index("aaaa-1111", 10, 1)[0][0]["id"]
+    reader.update({"id": first, "model": "claude-3"})
+    assert reader.index("gpt-4o", 10, 1)[1] == 1
+    assert reader.index("claude", 10, 1)[0][0]["id"] == first
+    reader.delete(first)
+    assert reader.index("claude", 10, 1) == ([], 0)
+
+    with engine.connect() as connection:
+        plan = " ".join(row[-1] for row in connection.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM req_logs WHERE id IN "
+            "(SELECT rowid FROM req_logs_fts WHERE req_logs_fts MATCH '\"gpt\"')")))
+    assert "VIRTUAL TABLE INDEX" in plan
+
+
+def test_search_index_is_built_for_existing_logs(engine, monkeypatch):
+    from app.db import reqLogs
+    from app.db.logDB import RequestLogger as LogWriter
+
+    LogWriter().insert_req_logs([log(model="old-model"), log(model="other")])
+    with engine.begin() as connection:
+        for name in ("req_logs_fts_delete", "req_logs_fts_update"):
+            connection.execute(text(f"DROP TRIGGER {name}"))
+        connection.execute(text("DROP TABLE req_logs_fts"))
+
+    # 模拟升级后重启
+    monkeypatch.setattr(reqLogs, "_search_indexed", set())
+    assert reqLogs.sync_search_index(engine)
+    reader = reqLogs.RequestLogger()
+    reader.counts = CountCache(background=False)
+    assert reader.index("old-mod", 10, 1)[1] == 1
+    reader.insert(log(model="new-model", md5="x", request_data=""))
+    reader.insert_random_test_data(3)
+    assert reader.index("new-mod", 10, 1)[1] == 1
+    assert reader.index("test_provider", 10, 1)[1] == 3
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+from app.db.logSink import RequestLogSink
+from app.test.conftest import log
+
+
+class Writer:
+    """记录每一批写入的日志，fail 为 True 时写入失败"""
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+
+    def insert_req_logs(self, logs):
+        self.release.wait()
+        if self.fail:
+            raise RuntimeError("database is locked")
+        self.batches.append([record["req_id"] for record in logs])
+
+
+def test_full_queue_truncates_then_drops():
+    async def run():
+        sink = RequestLogSink(Writer(), max_size=10, batch_size=100, flush_interval=60, high_watermark=0.8)
+        assert not sink.put(log(req_id="before-start"))
+        sink.start()
+        # 没有让出事件循环，后台任务取不走，队列一直在涨
+        records = [log('{"big": 1}', "resp", req_id=str(i)) for i in range(15)]
+        results = [sink.put(record) for record in records]
+        assert results == [True] * 10 + [False] * 5
+        assert [r["request_data"] for r in records[:10]] == ['{"big": 1}'] * 8 + [""] * 2  # 超过高水位只留统计
+        assert records[9]["response_data"] == "" and records[9]["prompt"] == 1
+        stats = sink.stats()
+        assert (stats["queue_size"], stats["enqueued"], stats["truncated"], stats["written"]) == (10, 10, 2, 0)
+        assert stats["dropped"] == 6  # 启动前的 1 条加上队列满之后的 5 条
+        await sink.stop()
+        assert sink.written == 10
+
+    asyncio.run(run())
+
+
+def test_batches_by_size_and_interval():
+    async def run():
+        writer = Writer()
+        sink = RequestLogSink(writer, max_size=100, batch_size=3, flush_interval=0.2)
+        sink.start()
+        for i in range(7):
+            sink.put(log(req_id=str(i)))
+        await asyncio.sleep(0.05)
+        # 凑满一批的马上写，不等 flush_interval
+        assert writer.batches == [["0", "1", "2"], ["3", "4", "5"]]
+        await asyncio.sleep(0.3)
+        assert writer.batches[-1] == ["6"]  # 凑不满的等 flush_interval 后写
+        assert sink.stats()["batches"] == 3 and sink.written == 7
+        await sink.stop()
+
+    asyncio.run(run())
+
+
+def test_stop_writes_what_is_queued():
+    async def run():
+        writer = Writer()
+        writer.release.clear()  # 第一批卡在数据库里，后面的都还在队列
+        sink = RequestLogSink(writer, max_size=100, batch_size=2, flush_interval=60)
+        sink.start()
+        for i in range(5):
+            sink.put(log(req_id=str(i)))
+        await asyncio.sleep(0.05)
+        writer.release.set()
+        await sink.stop()
+        assert sorted(r for batch in writer.batches for r in batch) == ["0", "1", "2", "3", "4"]
+        assert sink.written == 5 and sink.stats()["queue_size"] == 0
+
+    asyncio.run(run())
+
+
+def test_failed_batch_is_counted():
+    async def run():
+        sink = RequestLogSink(Writer(fail=True), max_size=100, batch_size=2, flush_interval=60)
+        sink.start()
+        sink.put(log())
+        sink.put(log())
+        await sink.stop()
+        assert sink.failed == 2 and sink.written == 0
+
+    asyncio.run(run())
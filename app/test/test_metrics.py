@@ -0,0 +1,93 @@
+import json
+import os
+
+from app.metrics import Registry, MultiProcessExporter, error_class
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram("t_seconds", "耗时", ("provider", "model"), buckets=(0.1, 1))
+    histogram.observe(0.05, "p", "m")
+    histogram.observe(0.5, "p", "m")
+    histogram.observe(5, "p", "m")
+    text = registry.render()
+    assert 't_seconds_bucket{provider="p",model="m",le="0.1"} 1' in text
+    assert 't_seconds_bucket{provider="p",model="m",le="1"} 2' in text
+    assert 't_seconds_bucket{provider="p",model="m",le="+Inf"} 3' in text
+    assert 't_seconds_sum{provider="p",model="m"} 5.55' in text
+    assert 't_seconds_count{provider="p",model="m"} 3' in text
+    assert "# TYPE t_seconds histogram" in text
+
+
+def test_counter_gauge_and_escaping():
+    registry = Registry()
+    counter = registry.counter("c_total", "次数", ("model",))
+    counter.inc('a"b\\c')
+    counter.inc('a"b\\c', amount=2)
+    gauge = registry.gauge("g", "数量")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    registry.gauge_func("f", "回调", ("origin",), lambda: [(("http://x",), 7)])
+    text = registry.render()
+    assert 'c_total{model="a\\"b\\\\c"} 3' in text
+    assert "\ng 1\n" in text
+    assert 'f{origin="http://x"} 7' in text
+
+
+def test_register_keeps_first_and_gauge_func_replaces():
+    registry = Registry()
+    assert registry.counter("c", "x") is registry.counter("c", "x")
+    registry.gauge_func("f", "x", (), lambda: [((), 1)])
+    registry.gauge_func("f", "x", (), lambda: [((), 2)])
+    assert "\nf 2\n" in registry.render()
+
+
+def test_error_class():
+    assert error_class(429) == "http_429"
+    assert error_class(503) == "http_5xx"
+    assert error_class(400) == "http_4xx"
+    assert error_class(None) == "other"
+
+
+def test_multiprocess_merge(tmp_path):
+    def worker():
+        registry = Registry()
+        registry.counter("c_total", "次数", ("model",)).inc("m")
+        registry.gauge("g", "数量").inc()
+        registry.histogram("t_seconds", "耗时", (), buckets=(1,)).observe(0.5)
+        return registry
+
+    # 另一个还在运行的 worker (用父进程的 pid) 和一个已经退出的 worker
+    for pid, alive in ((os.getppid(), True), (2 ** 22 + 1, False)):
+        with open(tmp_path / f"{pid}.json", "w", encoding="utf-8") as f:
+            json.dump({"pid": pid, "alive": alive, "metrics": worker().snapshot()}, f)
+    text = MultiProcessExporter(worker(), str(tmp_path)).render()
+    assert 'c_total{model="m"} 3' in text
+    assert "\ng 2\n" in text  # 已经退出的 worker 的 gauge 不计入
+    assert 't_seconds_bucket{le="1"} 3' in text
+    assert "t_seconds_sum 1.5" in text
+    assert not (tmp_path / f"{2 ** 22 + 1}.json").exists()  # 退出的 worker 合并到 aggregate.json
+
+
+def test_dead_workers_are_folded_once(tmp_path):
+    registry = Registry()
+    registry.counter("c_total", "次数").inc(amount=2)
+    registry.gauge("g", "数量").inc()
+    for pid in (2 ** 22 + 1, 2 ** 22 + 3):
+        with open(tmp_path / f"{pid}.json", "w", encoding="utf-8") as f:
+            json.dump({"pid": pid, "alive": True, "metrics": registry.snapshot()}, f)
+
+    exporter = MultiProcessExporter(Registry(), str(tmp_path))
+    exporter.registry.counter("c_total", "次数")
+    exporter.registry.gauge("g", "数量")
+    for _ in range(3):
+        text = exporter.render()
+        assert "\nc_total 4\n" in text
+        assert "\ng 0\n" not in text and "\ng 1\n" not in text
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["aggregate.json"]
+
+    with open(tmp_path / f"{2 ** 22 + 5}.json", "w", encoding="utf-8") as f:
+        json.dump({"pid": 2 ** 22 + 5, "alive": False, "metrics": registry.snapshot()}, f)
+    assert "\nc_total 6\n" in exporter.render()
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["aggregate.json"]
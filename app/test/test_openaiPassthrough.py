@@ -0,0 +1,56 @@
+import glob
+import os
+
+import ujson as json
+
+from app.provider.openaiSSEHandler import openaiSSEHandler
+from app.provider.sseFramer import SSEBlockFramer
+
+DEBUGDATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "provider", "debugfile",
+                         "debugdata")
+
+
+def wire(file_name):
+    with open(file_name, "r", encoding="utf-8") as f:
+        return "".join(line.strip() + "\n\n" for line in f if line.strip().startswith("data:")).encode("utf-8")
+
+
+def parsed_stats(data: bytes):
+    handler = openaiSSEHandler("id", "my-model")
+    for line in data.decode("utf-8").split("\n\n"):
+        if line:
+            handler.handle_SSE_data_line(line)
+    return handler.get_stats()
+
+
+def test_passthrough_matches_parsed_stats():
+    files = glob.glob(os.path.join(DEBUGDATA, "*openai*_sse.txt"))
+    assert files
+    for file_name in files:
+        data = wire(file_name)
+        handler = openaiSSEHandler("id", "my-model")
+        framer = SSEBlockFramer()
+        blocks = [framer.feed(data[i:i + 1000]) for i in range(0, len(data), 1000)]
+        out = b"".join(handler.handle_SSE_raw(block) for block in blocks if block)
+        expected = parsed_stats(data)
+        stats = handler.get_stats()
+        for key in ("full_message_content", "prompt_tokens", "completion_tokens", "total_tokens"):
+            assert stats[key] == expected[key], file_name
+        for line in out.decode("utf-8").split("\n\n"):
+            if line and line != "data: [DONE]":
+                assert json.loads(line[6:])["model"] == "my-model"
+
+
+def test_passthrough_rewrites_only_model_field():
+    handler = openaiSSEHandler("id", "gpt-4o")
+    block = (b'data: {"id":"x","model": "gpt-4o-2024-08-06","choices":[{"index":0,'
+             b'"delta":{"content":"the \\"model\\": \\"y\\""}}]}\n\n'
+             b'data: {"choices":[{"index":0,"delta":{"tool_calls":[{"index":0,"id":"call_1",'
+             b'"function":{"name":"f","arguments":"{}"}}]}}],"usage":{"prompt_tokens":3,"completion_tokens":2,'
+             b'"total_tokens":5}}\n\ndata: [DONE]\n\n')
+    out = handler.handle_SSE_raw(block)
+    assert out == block.replace(b'"model": "gpt-4o-2024-08-06"', b'"model":"gpt-4o"')
+    stats = handler.get_stats()
+    assert stats["full_message_content"] == 'the "model": "y"'
+    assert stats["total_tokens"] == 5
+    assert stats["tool_calls"][0]["function"]["name"] == "f"
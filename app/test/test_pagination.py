@@ -0,0 +1,122 @@
+import datetime
+import time
+
+from sqlalchemy import text
+
+from app.db.pagination import CountCache
+from app.test.conftest import log
+
+
+def pages(reader, count, per_page, **kwargs):
+    items = []
+    for page in range(1, count + 1):
+        items += reader.index(kwargs.get("keywords"), per_page, page, kwargs.get("order_by", "id"),
+                              kwargs.get("order_dir", "desc"))[0]
+    return items
+
+
+def test_log_pages_use_cursors(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger
+
+    start = datetime.datetime(2024, 9, 1, 12)
+    LogWriter().insert_req_logs([
+        log(time=start + datetime.timedelta(minutes=i % 7), prompt=i % 3, model=f"m{i % 2}") for i in range(25)
+    ])
+    reader = RequestLogger()
+    reader.counts = CountCache(background=False)
+
+    by_id = pages(reader, 3, 10)
+    assert [item["id"] for item in by_id] == list(range(25, 0, -1))
+    assert reader.index(None, 10, 1)[1] == 25
+
+    # 新日志不会让已经打开的下一页重复
+    LogWriter().insert_req_logs([log()])
+    assert [item["id"] for item in reader.index(None, 10, 2)[0]] == list(range(15, 5, -1))
+
+    # 没有游标时直接跳页和逐页翻结果一样
+    fresh = RequestLogger()
+    assert [item["id"] for item in fresh.index(None, 10, 3)[0]] == list(range(6, 0, -1))
+
+    by_time = pages(reader, 3, 10, order_by="time", order_dir="asc")
+    assert [(item["time"], item["id"]) for item in by_time] == sorted((item["time"], item["id"]) for item in by_time)
+    assert len({item["id"] for item in by_time}) == 26
+
+    by_prompt = pages(reader, 3, 10, order_by="prompt")
+    assert [(item["prompt"], item["id"]) for item in by_prompt] == sorted(
+        ((item["prompt"], item["id"]) for item in by_prompt), reverse=True)
+    assert len({item["id"] for item in by_prompt}) == 26
+
+    items, total = reader.index("m1", 5, 1)
+    assert total == 12 and all(item["model"] == "m1" for item in items)
+    assert reader.bulk_delete([item["id"] for item in items])
+    assert reader.index("m1", 5, 1)[1] == 7
+
+
+def test_total_is_counted_in_background(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger
+
+    LogWriter().insert_req_logs([log() for _ in range(30)])
+    reader = RequestLogger()
+    # 第一次只知道能翻到下一页
+    assert reader.index(None, 10, 1)[1] == 11
+    for _ in range(100):
+        if not reader.counts.refreshing:
+            break
+        time.sleep(0.01)
+    assert reader.index(None, 10, 1)[1] == 30
+
+
+def test_cache_pages_use_cursors(engine):
+    from app.db.reqCache import RequestCacheManager
+
+    manager = RequestCacheManager()
+    manager.counts = CountCache(background=False)
+    for i in range(12):
+        manager.insert({"md5": f"md5-{i}", "req": "{}", "resp": f"resp {i % 3}"})
+    items = pages(manager, 3, 5, order_by="hit_count", order_dir="asc")
+    assert [item["id"] for item in items] == list(range(1, 13))
+    assert manager.index("resp 1", 10, 1)[1] == 4
+
+
+def test_nullable_sort_column_keeps_null_rows(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger
+
+    LogWriter().insert_req_logs([log(attempt=1 + i % 2, api_status="200") for i in range(25)])
+    # 旧版本写入的日志没有 attempt
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE req_logs SET attempt = NULL WHERE id % 3 != 0"))
+        connection.execute(text("UPDATE req_logs SET api_status = NULL WHERE id % 2 = 0"))
+    reader = RequestLogger()
+    reader.counts = CountCache(background=False)
+    for order_by in ("attempt", "api_status"):
+        for order_dir in ("desc", "asc"):
+            items = pages(reader, 3, 10, order_by=order_by, order_dir=order_dir)
+            assert sorted(item["id"] for item in items) == list(range(1, 26)), (order_by, order_dir)
+            assert sum(item[order_by] is None for item in items) > 10
+
+
+def test_delete_clears_cursors(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqCache import RequestCacheManager
+    from app.db.reqLogs import RequestLogger
+
+    LogWriter().insert_req_logs([log() for _ in range(25)])
+    reader = RequestLogger()
+    reader.counts = CountCache(background=False)
+    assert [item["id"] for item in reader.index(None, 10, 1)[0]] == list(range(25, 15, -1))
+    # 删掉第一页的两行，第二页要从新的第十行之后开始，不能用删除前记下的游标
+    assert reader.bulk_delete([25, 24])
+    assert [item["id"] for item in reader.index(None, 10, 2)[0]] == list(range(13, 3, -1))
+    assert reader.delete(23)
+    assert [item["id"] for item in reader.index(None, 10, 2)[0]] == list(range(12, 2, -1))
+
+    manager = RequestCacheManager()
+    manager.counts = CountCache(background=False)
+    for i in range(12):
+        manager.insert({"md5": f"md5-{i}", "req": "{}", "resp": "resp"})
+    assert [item["id"] for item in manager.index(None, 5, 1)[0]] == list(range(12, 7, -1))
+    assert manager.bulk_delete([12, 11])
+    assert [item["id"] for item in manager.index(None, 5, 2)[0]] == list(range(5, 0, -1))
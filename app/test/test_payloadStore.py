@@ -0,0 +1,121 @@
+import datetime
+import gzip
+import json
+
+from sqlalchemy import text
+
+from app.db import payloadCodec
+from app.test.conftest import insert_legacy_log, log
+
+
+def test_codec_roundtrip():
+    text_data = "你好" * 1000
+    codec, request, response, size = payloadCodec.encode(text_data, "")
+    assert codec == payloadCodec.default_codec()
+    assert len(request) < size / 10
+    assert payloadCodec.decode(codec, request) == text_data
+    assert payloadCodec.encode("短", "")[0] == payloadCodec.RAW
+    assert payloadCodec.decode(payloadCodec.GZIP, payloadCodec.encode("x" * 500, "", payloadCodec.GZIP)[1]) == "x" * 500
+
+
+def test_payloads_stored_compressed_and_loaded_on_demand(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger
+
+    big = json.dumps({"messages": [{"role": "user", "content": "写一首诗" * 500}]}, ensure_ascii=False)
+    LogWriter().insert_req_logs([log(big, '{"content": "诗"}'), log("{}")])
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT request_data FROM req_logs")).scalars().all() == ["", ""]
+        codec, stored = conn.execute(text("SELECT codec, length(request_data) FROM req_log_payloads "
+                                          "ORDER BY log_id")).first()
+    assert codec == payloadCodec.default_codec()
+    assert stored < len(big.encode("utf-8")) / 10
+
+    reader = RequestLogger()
+    first = reader.find_one(1)
+    assert first["request_data"] == big
+    assert first["response_data"] == '{"content": "诗"}'
+    assert reader.find_one(2)["request_data"] == "{}"
+    assert reader.delete(1)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM req_log_payloads")).scalar() == 1
+
+
+def test_compaction_retention_and_archive(engine, tmp_path):
+    from app.db.payloadJob import PayloadJob
+    from app.db.reqLogs import RequestLogger
+
+    reader = RequestLogger()
+    now = datetime.datetime(2024, 6, 10, 12)
+    # 旧版本直接写在 req_logs 里的日志
+    for day, content in ((1, "旧" * 300), (9, "新" * 300)):
+        insert_legacy_log(log(content, "resp", md5="x", time=now - datetime.timedelta(days=10 - day)))
+    job = PayloadJob(retention_days=3, archive_dir=str(tmp_path / "archive"), batch_size=1)
+    result = job.run_once(now)
+    assert result["compacted"] == 2
+    assert result["purged"] == 1
+
+    old, new = reader.find_one(1), reader.find_one(2)
+    assert old["request_data"] == "" and old["prompt"] == 1  # 内容删除了，统计字段还在
+    assert new["request_data"] == "新" * 300
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM req_logs WHERE request_data != ''")).scalar() == 0
+        assert conn.execute(text("PRAGMA freelist_count")).scalar() == 0  # 删除后的空间已经归还
+    archived = list((tmp_path / "archive").iterdir())
+    with gzip.open(archived[0], "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [(r["log_id"], r["request_data"]) for r in rows] == [(1, "旧" * 300)]
+    assert job.run_once(now)["compacted"] == 0
+
+
+def test_list_views_skip_payloads_and_detail_streams_them(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqCache import RequestCacheManager
+    from app.db.reqLogs import RequestLogger
+
+    big = "长" * 300000
+    LogWriter().insert_req_logs([log(big, "ok", api_error="e" * 1000)])
+    reader = RequestLogger()
+    insert_legacy_log(log("旧" * 500, "", md5="x"))  # 旧版本写在 req_logs 里的内容
+
+    items, _ = reader.index(None, 10, 1)
+    assert "request_data" not in items[0] and "response_data" not in items[0]
+    assert len(items[1]["api_error"]) == 200
+
+    detail = reader.find_one(1, limit=1000)
+    assert detail["request_data"] == big[:1000] and detail["request_data_truncated"]
+    assert detail["response_data"] == "ok" and not detail["response_data_truncated"]
+    assert len(detail["api_error"]) == 1000
+    chunks = list(reader.open_payload(1, "request_data"))
+    assert len(chunks) > 1 and "".join(chunks) == big
+    assert reader.find_one(2, limit=100)["request_data_truncated"]
+    assert "".join(reader.open_payload(2, "request_data")) == "旧" * 500
+    assert reader.open_payload(3, "request_data") is None
+
+    manager = RequestCacheManager()
+    manager.insert({"md5": "m", "req": "请求" * 1000, "resp": "响应" * 100000})
+    item = manager.index(None, 10, 1)[0][0]
+    assert len(item["req"]) == 200 and "resp" not in item
+    detail = manager.find_one(1, limit=100)
+    assert detail["resp"] == "响应" * 50 and detail["resp_truncated"] and detail["req_truncated"]
+    chunks = list(manager.open_payload(1, "resp"))
+    assert len(chunks) > 1 and "".join(chunks) == "响应" * 100000
+    assert manager.open_payload(2, "resp") is None
+
+
+def test_payload_stream_releases_connection_on_abort(engine):
+    from app.db.reqCache import RequestCacheManager
+
+    manager = RequestCacheManager()
+    manager.insert({"md5": "m", "req": "{}", "resp": "响应" * 100000})
+    chunks = manager.open_payload(1, "resp")
+    next(chunks)
+    assert engine.pool.checkedout() == 1
+    chunks.close()  # 客户端读了一段就断开
+    assert engine.pool.checkedout() == 0
+    assert list(chunks) == []
+
+    manager.open_payload(1, "resp").close()  # 还没开始读
+    assert engine.pool.checkedout() == 0
+    assert "".join(manager.open_payload(1, "resp")) == "响应" * 100000
+    assert engine.pool.checkedout() == 0
@@ -0,0 +1,110 @@
+import datetime
+
+from app.test.conftest import log
+
+
+def test_stats_follow_log_writes_and_rebuild(engine):
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger, ReqStat
+
+    today = datetime.datetime.now().replace(hour=10, minute=5)
+    yesterday = today - datetime.timedelta(days=1)
+    LogWriter().insert_req_logs([
+        log(model="a", prompt=10, completion=1, time=today),
+        log(model="a", prompt=20, completion=2, time=today.replace(minute=50)),
+        log(model="b", prompt=5, completion=5, time=yesterday, api_status="500"),
+    ])
+    LogWriter().insert_req_logs([log(model="a", prompt=1, completion=1, time=today)])
+
+    reader = RequestLogger()
+    assert sorted(reader.statistics(), key=lambda x: x["model"]) == [
+        {"model": "a", "prompt": 31, "completion": 4},
+        {"model": "b", "prompt": 5, "completion": 5},
+    ]
+    chart = reader.statistics_model_day()
+    assert chart["xAxis"]["data"] == [yesterday.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")]
+    assert {"name": "a 提示词", "type": "line", "data": [0, 31]} in chart["series"]
+
+    def rows():
+        with reader.Session() as session:
+            return sorted((r.day, r.hour, r.model, r.requests, r.errors, r.prompt) for r in session.query(ReqStat))
+
+    before = rows()
+    assert before[0][1:] == (10, "b", 1, 1, 5)
+    assert before[1][1:] == (10, "a", 3, 0, 31)
+    assert reader.rebuild_stats() == 4
+    assert rows() == before
+
+
+def test_request_logger_writes_keep_statistics(engine, monkeypatch):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from sqlalchemy import func
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger, ReqLog, ReqLogPayload
+    from app.routers import statistics
+
+    reader = RequestLogger()
+    monkeypatch.setattr(statistics, "request_logger", reader)
+    app = FastAPI()
+    app.include_router(statistics.router, prefix="/admin")
+    client = TestClient(app)
+
+    now = datetime.datetime.now()
+    first = reader.insert(log(model="a", prompt=10, completion=1, time=now, request_data='{"q": 1}', md5="x"))
+    reader.insert_random_test_data(num_entries=20)
+    LogWriter().insert_req_logs([log(req_id="r2", model="b", prompt=3, completion=3, time=now)])
+    assert reader.update({"id": first, "model": "b", "prompt": 7, "response_data": "hello",
+                          "request_data": "{", "request_data_truncated": True})
+    LogWriter().update_req_log("r2", 4, 5, 0.1, "done", "500", "err")
+
+    def expected():
+        with reader.Session() as session:
+            result = session.query(ReqLog.model, func.sum(ReqLog.prompt), func.sum(ReqLog.completion)).group_by(ReqLog.model)
+            return [{"model": model, "prompt": prompt, "completion": completion} for model, prompt, completion in result]
+
+    rows = client.get("/admin/statistics").json()["data"]["rows"]
+    assert sorted(rows, key=lambda x: x["model"]) == expected()
+    assert {"model": "b", "prompt": 11, "completion": 6} in rows
+
+    # 内容都在 req_log_payloads 里，被截断的请求内容没有写回去
+    with reader.Session() as session:
+        assert session.query(ReqLogPayload).count() == session.query(ReqLog).count() == 22
+        assert not session.query(ReqLog).filter((ReqLog.request_data != "") | (ReqLog.response_data != "")).count()
+    data = reader.find_one(first)
+    assert (data["request_data"], data["response_data"]) == ('{"q": 1}', "hello")
+
+
+def test_rebuild_while_logs_are_written(engine):
+    import threading
+    import time
+    from app.db.logDB import RequestLogger as LogWriter
+    from app.db.reqLogs import RequestLogger, ReqStat
+
+    now = datetime.datetime.now().replace(minute=5)
+    writer = LogWriter()
+    writer.insert_req_logs([log(req_id=f"r{i}", model=f"m{i % 3}", time=now) for i in range(200)])
+    reader = RequestLogger()
+
+    def rows():
+        with reader.Session() as session:
+            return sorted((r.day, r.hour, r.model, r.requests, r.errors, r.prompt, r.completion)
+                          for r in session.query(ReqStat))
+
+    def write():
+        for i in range(60):
+            writer.insert_req_logs([log(req_id=f"n{i}", model="m1", prompt=i, time=now)])
+            # 修改旧日志：change_stats 减掉旧值加上新值
+            assert reader.update({"id": 1 + i * 3, "model": "m2", "prompt": 100, "api_status": "500"})
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    while thread.is_alive():
+        reader.rebuild_stats()
+        time.sleep(0.01)
+    thread.join()
+    # 增量累加的结果和完整重新汇总的一样，没有被并发的重建算丢或者算两次
+    incremental = rows()
+    reader.rebuild_stats()
+    assert rows() == incremental
+    assert sum(row[3] for row in incremental) == 260
@@ -0,0 +1,127 @@
+import asyncio
+
+from app.db.responseCache import ResponseCache, canonical_cache_key
+
+
+class MemoryCacheManager:
+    def __init__(self):
+        self.rows = {}
+        self.finds = 0
+        self.hits = {}
+
+    def find_cache(self, md5):
+        self.finds += 1
+        return self.rows.get(md5)
+
+    def add_to_cache(self, md5, req, resp, expires_at=None):
+        self.rows[md5] = type("Row", (), {"resp": resp, "expires_at": expires_at})()
+
+    def add_hit_counts(self, hits):
+        for md5, count in hits.items():
+            self.hits[md5] = self.hits.get(md5, 0) + count
+
+    def delete_expired(self):
+        return 0
+
+
+def test_canonical_key_ignores_order_and_query():
+    a = canonical_cache_key("https://x/v1/chat?key=1", {"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+    b = canonical_cache_key("https://x/v1/chat?key=2", {"messages": [{"content": "hi", "role": "user"}], "model": "m",
+                                                         "user": "u1"})
+    c = canonical_cache_key("https://x/v1/chat", {"model": "m", "messages": [{"role": "user", "content": "hello"}]})
+    assert a == b
+    assert a != c
+    # 要不要 usage 数据块的响应不一样
+    usage = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "stream_options": {"include_usage": True}}
+    assert canonical_cache_key("https://x/v1/chat", usage) != a
+
+
+def test_memory_hit_does_not_touch_db():
+    async def run():
+        manager = MemoryCacheManager()
+        cache = ResponseCache(manager, ttl=60)
+        assert await cache.get("k") is None
+        cache.set("k", "{}", "resp")
+        await asyncio.sleep(0)
+        finds = manager.finds
+        for _ in range(10):
+            assert await cache.get("k") == "resp"
+        assert manager.finds == finds
+        await cache.stop()
+        assert manager.hits == {"k": 10}
+
+    asyncio.run(run())
+
+
+def test_lru_bounded_by_bytes():
+    async def run():
+        manager = MemoryCacheManager()
+        cache = ResponseCache(manager, ttl=0, memory_bytes=10)
+        cache.set("a", "{}", "12345")
+        cache.set("b", "{}", "12345")
+        await cache.get("a")
+        cache.set("c", "{}", "12345")
+        assert list(cache.entries) == ["a", "c"]
+        assert cache.size == 10
+        cache.set("d", "{}", "你好")  # 中文每个字 3 个字节
+        assert list(cache.entries) == ["d"] and cache.size == 6
+        cache.set("e", "{}", "你好你好")
+        assert "e" not in cache.entries
+        await cache.stop()
+        # 被挤出内存的还能从数据库里找回来
+        assert await cache.get("b") == "12345"
+        assert cache.db_hits == 1
+
+    asyncio.run(run())
+
+
+def test_admin_changes_invalidate_memory(engine):
+    from app.db.logDB import CacheManager
+    from app.db.reqCache import RequestCacheManager
+
+    async def run():
+        cache = ResponseCache(CacheManager(), ttl=60)
+        cache.set("md5-a", "{}", "old a")
+        cache.set("md5-b", "{}", "old b")
+        await asyncio.gather(*cache._writes)
+        admin = RequestCacheManager()
+        rows = {row["md5"]: row["id"] for row in admin.index("", 10, 1)[0]}
+        assert admin.update({"id": rows["md5-a"], "resp": "new a"})
+        assert await cache.get("md5-a") == "new a"
+        assert admin.delete(rows["md5-b"])
+        assert await cache.get("md5-b") is None
+        await cache.stop()
+
+    asyncio.run(run())
+
+
+def test_other_worker_changes_clear_memory(tmp_path, monkeypatch):
+    from app.db.responseCache import VERSION_KEY, invalidate_keys
+    from app.sharedState import ENV_PATH, SharedState
+
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    monkeypatch.setenv(ENV_PATH, path)
+
+    async def run():
+        manager = MemoryCacheManager()
+        cache = ResponseCache(manager, ttl=60, shared=SharedState(path))
+        cache.set("a", "{}", "resp a")
+        cache.set("b", "{}", "resp b")
+        await asyncio.sleep(0)
+
+        # 本进程的后台改动只删除对应的一条
+        manager.rows["a"].resp = "new a"
+        invalidate_keys(["a"])
+        assert await cache.get("a") == "new a"
+        finds = manager.finds
+        assert await cache.get("b") == "resp b"
+        assert manager.finds == finds
+
+        # 其他 worker 改动后，下次内存命中时清空
+        manager.rows["b"].resp = "new b"
+        SharedState(path).incr(VERSION_KEY)
+        assert await cache.get("b") == "new b"
+        await cache.stop()
+
+    asyncio.run(run())
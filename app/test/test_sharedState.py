@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from app import sharedState
+from app.Balance import Balance, BalanceManager, OPEN
+from app.sharedState import SharedState, SlotsFull
+
+
+def providers(*weights):
+    return [{"name": f"P{i + 1}", "provider": "openai", "original_model": "m", "weight": w}
+            for i, w in enumerate(weights)]
+
+
+def names(balance, count):
+    return [balance.next().data["name"] for _ in range(count)]
+
+
+def _incr(path, count):
+    shared = SharedState(path)
+    for _ in range(count):
+        shared.incr("n")
+    shared.close()
+
+
+def _start_and_die(path, config):
+    balance = BalanceManager(config, SharedState(path)).get("m", providers(1, 1))
+    for name in ("P1", "P2"):
+        balance.providers[name].stats.available(time.monotonic())
+        balance.providers[name].stats.start()
+    os._exit(1)  # 像被杀掉的 worker 一样，不会调用 finish
+
+
+def test_incr_across_processes(tmp_path):
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_incr, args=(path, 500)) for _ in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert SharedState(path).read("n")[0] == 1500
+
+
+def test_shared_sequence_matches_readme_across_workers(tmp_path):
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    # 两个 worker 交替处理请求，合起来仍然是 README 里的顺序
+    a = Balance("m", providers(1, 2, 0), shared=SharedState(path))
+    b = Balance("m", providers(1, 2, 0), shared=SharedState(path))
+    assert [w.next().data["name"] for w in (a, b, b, a, b, a)] == ["P1", "P2", "P2", "P1", "P2", "P2"]
+    wrr = Balance("w", providers(1, 2), "smooth_wrr", shared=SharedState(path))
+    assert names(wrr, 6) == ["P2", "P1", "P2", "P2", "P1", "P2"]
+
+
+def test_breaker_state_is_shared(tmp_path):
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    config = {"failure_threshold": 1, "cooldown": 60}
+    first = BalanceManager(config, SharedState(path)).get("m", providers(1, 1))
+    second = BalanceManager(config, SharedState(path)).get("m", providers(1, 1))
+    stats = first.providers["P1"].stats
+    stats.start()
+    stats.finish(False)
+    assert second.providers["P1"].stats.to_dict()["state"] == OPEN
+    assert names(second, 3) == ["P2", "P2", "P2"]
+    second.providers["P2"].stats.start()
+    second.providers["P2"].stats.first_chunk(0.5)
+    assert first.providers["P2"].stats.to_dict()["in_flight"] == 1
+    assert first.providers["P2"].stats.to_dict()["ttft"] == 0.5
+    assert first.providers["P2"].stats.available(time.monotonic())
+
+
+def test_counter_is_keyed_by_configured_model(tmp_path):
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    shared = SharedState(path)
+    # 设置了兜底模型时任意的模型名称都落到同一组渠道，共用一个计数器
+    manager = BalanceManager(shared=shared)
+    data = providers(1, 1)
+    assert [manager.get(f"random-{i}", data).next().data["name"] for i in range(4)] == ["P1", "P2", "P1", "P2"]
+    assert len([key for key in shared.slots if key.startswith("balance:")]) == 1
+
+
+def test_full_slots_are_reclaimed_or_fall_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(sharedState, "SLOTS", 4)
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    shared, other = SharedState(path), SharedState(path)
+    for key in "abcd":
+        shared.incr(key)
+    with pytest.raises(SlotsFull):
+        shared.incr("e")
+
+    # 槽用完时退回进程内的计数器和状态，不影响请求
+    balance = Balance("m", providers(1, 1), shared=shared)
+    assert names(balance, 4) == ["P1", "P2", "P1", "P2"]
+    stats = balance.providers["P1"].stats
+    stats.start()
+    assert stats.to_dict()["in_flight"] == 1
+
+    # 很久没有写过的槽给新的 key，其他进程缓存的位置失效后重新分配
+    other.read("a")
+    monkeypatch.setattr(sharedState, "RECLAIM_AFTER", 0)
+    shared.incr("e", amount=5)
+    assert shared.read("e")[0] == 5
+    assert other.read("e")[0] == 5
+    assert other.read("a")[0] == 0
+
+
+def test_dead_worker_share_is_released(tmp_path):
+    path = str(tmp_path / "state")
+    SharedState.create(path).close()
+    config = {"failure_threshold": 1, "cooldown": 0}
+    shared = SharedState(path)
+    balance = BalanceManager(config, shared).get("m", providers(1, 1))
+    p1, p2 = balance.providers["P1"].stats, balance.providers["P2"].stats
+    p1.start()
+    p1.finish(False)  # P1 熔断，cooldown 之后的第一个请求是试探
+    p2.start()
+
+    worker = multiprocessing.get_context("spawn").Process(target=_start_and_die, args=(path, config))
+    worker.start()
+    worker.join()
+    assert p2.to_dict()["in_flight"] == 2
+    assert not p1.available(time.monotonic())  # 死掉的 worker 占着试探
+
+    assert shared.release_worker(worker.pid) == 2
+    assert shared.release_worker(worker.pid) == 0
+    assert p2.to_dict()["in_flight"] == 1  # 本进程的请求不受影响
+    assert p1.to_dict()["in_flight"] == 0
+    assert p1.available(time.monotonic())
@@ -0,0 +1,42 @@
+import ujson as json
+
+from app.provider.openaiSSEHandler import openaiSSEHandler
+from app.provider.sseEncoder import SSEChunkEncoder, SSE_DONE
+
+
+def old_chunk(delta, finish_reason=None, usage=None):
+    """原来 generate_sse_response 拼出来的格式"""
+    chunk = {
+        "id": "chatcmpl-abc",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "system_fingerprint": None,
+        "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+    }
+    if usage:
+        chunk["usage"] = usage
+    return ("data: " + json.dumps(chunk) + "\n\n").encode()
+
+
+def test_same_bytes_as_old_chunk():
+    encoder = SSEChunkEncoder("abc", "gpt-4o", created=1700000000)
+    text = '你好 "quote" \\ </script>\n'
+    calls = [{"index": 0, "id": "call_1", "function": {"name": "f", "arguments": "{\"a\":1}"}}]
+    assert encoder.role() == old_chunk({"role": "assistant", "content": ""})
+    assert encoder.content(text) == old_chunk({"content": text})
+    assert encoder.tool_calls(calls) == old_chunk({"tool_calls": calls})
+    usage = {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}
+    assert encoder.stop(1, 2, 3) == old_chunk({}, "stop", usage)
+    assert json.loads(encoder.stop()[6:])["choices"][0]["finish_reason"] == "stop"
+
+
+def test_handler_recompiles_when_model_changes():
+    handler = openaiSSEHandler("abc", "gpt-4o")
+    first = handler.handle_SSE_data_line('data: {"choices":[{"delta":{"content":"hi"}}]}')
+    handler.model = "gpt-4o-mini"
+    second = handler.handle_SSE_data_line('data: {"choices":[{"delta":{"content":"hi"}}]}')
+    assert json.loads(first[6:])["model"] == "gpt-4o"
+    assert json.loads(second[6:])["model"] == "gpt-4o-mini"
+    assert handler.handle_SSE_data_line("data: [DONE]") is SSE_DONE
+    assert handler.get_stats()["full_message_content"] == "hihi"
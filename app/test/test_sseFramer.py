@@ -0,0 +1,81 @@
+from app.benchmark.handlerFixtures import recorded_fixtures
+from app.provider.sseFramer import SSEFramer, SSEBlockFramer
+
+
+def frame(chunks, multiline=False):
+    framer = SSEFramer(multiline)
+    events = []
+    for chunk in chunks:
+        events.extend(framer.feed(chunk))
+    events.extend(framer.flush())
+    return events
+
+
+def test_split_lines_across_chunks():
+    wire = 'data: {"a": "你好"}\r\n\r\ndata: [DONE]\r\n\r\n'.encode("utf-8")
+    for size in range(1, len(wire) + 1):
+        chunks = [wire[i:i + size] for i in range(0, len(wire), size)]
+        assert [e.data for e in frame(chunks)] == ['{"a": "你好"}', "[DONE]"]
+
+
+def test_event_and_multiline_data():
+    wire = b"event: message_start\ndata: line1\ndata: line2\n\n: ping\n\nevent: ping\ndata:{}\n\n"
+    events = frame([wire], multiline=True)
+    assert [(e.event, e.data) for e in events] == [("message_start", "line1\nline2"), ("ping", "{}")]
+    # 默认和原来的逐行读取一样，每个 data: 行单独输出
+    events = frame([wire])
+    assert [(e.event, e.data) for e in events] == [("message_start", "line1"), ("message_start", "line2"),
+                                                   ("ping", "{}")]
+
+
+def test_single_newline_streams_match_line_reader():
+    """调试缓存录制的数据只用单个换行分隔，要和原来的逐行读取得到一样的行"""
+    fixtures = [f for f in recorded_fixtures() if f.mode == "sse"]
+    assert fixtures
+    for fixture in fixtures:
+        data_lines = [line for line in fixture.payload if line.startswith("data:")]
+        wire = "\n".join(fixture.payload).encode("utf-8") + b"\n"
+        for size in (7, 4096):
+            chunks = [wire[i:i + size] for i in range(0, len(wire), size)]
+            assert ["data: " + e.data for e in frame(chunks)] == [
+                "data: " + line[5:].removeprefix(" ") for line in data_lines]
+
+
+def test_flush_last_event_without_blank_line():
+    assert [e.data for e in frame([b"data: a\n\ndata: b"])] == ["a", "b"]
+
+
+def test_block_framer_only_complete_events():
+    wire = 'data: {"a": "你好"}\r\n\r\ndata: {"b": 1}\n\ndata: [DONE]\n\n'.encode("utf-8")
+    for size in range(1, len(wire) + 1):
+        framer = SSEBlockFramer()
+        blocks = [framer.feed(wire[i:i + size]) for i in range(0, len(wire), size)]
+        blocks.append(framer.flush())
+        assert b"".join(blocks) == wire
+        assert all(not block or block.endswith((b"\n\n", b"\n\r\n")) for block in blocks)
+    framer = SSEBlockFramer()
+    assert framer.feed(b"data: a\n\ndata: b") == b"data: a\n\n"
+    assert framer.flush() == b"data: b\n\n"
+
+
+def test_api_data_keeps_data_prefix(monkeypatch):
+    """sendChatCompletions 把 get_api_data 的每一行写进调试缓存，要和原来一样带 data: 前缀"""
+    import asyncio
+    from contextlib import asynccontextmanager
+
+    import httpx
+    from app.provider import httpxHelp
+
+    wire = b'data: {"a": 1}\ndata:{"b": 2}\n\ndata: [DONE]\n\n'
+
+    @asynccontextmanager
+    async def use(url, http_config=None):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=wire))) as client:
+            yield client
+
+    async def run():
+        ready = {"url": "http://upstream/v1/chat/completions", "headers": {}, "body": {}, "stream": True}
+        return [line async for line in httpxHelp.get_api_data(ready)]
+
+    monkeypatch.setattr(httpxHelp.upstream_clients, "use", use)
+    assert asyncio.run(run()) == ['data: {"a": 1}', 'data: {"b": 2}', "data: [DONE]"]
@@ -0,0 +1,71 @@
+from app.provider.openaiSSEHandler import openaiSSEHandler
+from app.provider.streamAccumulator import StreamAccumulator
+
+
+def test_text_joined_lazily():
+    acc = StreamAccumulator()
+    for text in ["a", "", "b", "c"]:
+        acc.add_text(text)
+    assert acc.text == "abc"
+    acc.add_text("d")
+    assert acc.text == "abcd"
+    acc.set_text("x")
+    assert acc.text == "x"
+
+
+def test_openai_parallel_tool_call_deltas():
+    acc = StreamAccumulator()
+    acc.add_tool_call_delta({"index": 0, "id": "call_a", "type": "function", "function": {"name": "f", "arguments": ""}})
+    acc.add_tool_call_delta({"index": 1, "id": "call_b", "type": "function", "function": {"name": "g", "arguments": "{"}})
+    acc.add_tool_call_delta({"index": 0, "function": {"arguments": "{\"x\":"}})
+    acc.add_tool_call_delta({"index": 1, "function": {"arguments": "}"}})
+    acc.add_tool_call_delta({"index": 0, "function": {"arguments": "1}"}})
+    assert acc.tool_calls == [
+        {"id": "call_a", "type": "function", "function": {"name": "f", "arguments": "{\"x\":1}"}},
+        {"id": "call_b", "type": "function", "function": {"name": "g", "arguments": "{}"}},
+    ]
+
+
+def test_fragments_without_index_follow_id_or_last_call():
+    acc = StreamAccumulator()
+    acc.add_tool_call_delta({"id": "call_a", "function": {"name": "f", "arguments": "["}})
+    acc.add_tool_call_delta({"function": {"arguments": "1"}})
+    acc.add_tool_call_delta({"id": "call_b", "function": {"name": "g", "arguments": "2"}})
+    acc.add_tool_call_delta({"id": "call_a", "function": {"arguments": "]"}})
+    assert [c["function"]["arguments"] for c in acc.tool_calls] == ["[1]", "2"]
+
+
+def test_disabled_keeps_usage_only():
+    handler = openaiSSEHandler("id", "m", accumulate=False)
+    handler.handle_SSE_data_line('data: {"choices":[{"delta":{"content":"hi"}}]}')
+    handler.handle_SSE_data_line('data: {"choices":[{"delta":{"tool_calls":[{"index":0,"id":"c","function":'
+                                 '{"name":"f","arguments":"{}"}}]}}]}')
+    handler.handle_SSE_data_line('data: {"choices":[{"delta":{},"finish_reason":"stop"}],'
+                                 '"usage":{"prompt_tokens":1,"completion_tokens":2,"total_tokens":3}}')
+    stats = handler.get_stats()
+    assert stats["full_message_content"] == ""
+    assert stats["tool_calls"] == []
+    assert stats["total_tokens"] == 3
+
+    handler = openaiSSEHandler("id", "m", accumulate=False)
+    handler.handle_SSE_raw(b'data: {"model":"x","choices":[{"delta":{"content":"hi"}}],"usage":null}\n\n')
+    handler.handle_SSE_raw(b'data: {"model":"x","choices":[],"usage":{"prompt_tokens":1,"completion_tokens":2,'
+                           b'"total_tokens":3}}\n\ndata: [DONE]\n\n')
+    stats = handler.get_stats()
+    assert stats["full_message_content"] == ""
+    assert stats["completion_tokens"] == 2
+
+
+def test_tool_call_only_response_keeps_empty_content():
+    handler = openaiSSEHandler("id", "m")
+    handler.handle_SSE_data_line('data: {"choices":[{"delta":{"role":"assistant","tool_calls":[{"index":0,"id":"c",'
+                                 '"type":"function","function":{"name":"f","arguments":"{}"}}]}}]}')
+    message = handler.generate_response()["choices"][0]["message"]
+    # 和原来一样 content 是空字符串，不是 None
+    assert message["content"] == ""
+    assert message["tool_calls"] == [{"id": "c", "type": "function", "function": {"name": "f", "arguments": "{}"}}]
+
+    handler = openaiSSEHandler("id", "m")
+    handler.handle_SSE_data_line('data: {"choices":[{"delta":{"content":"hi"}}]}')
+    message = handler.generate_response()["choices"][0]["message"]
+    assert message == {"role": "assistant", "content": "hi", "tool_calls": None}
@@ -0,0 +1,79 @@
+import asyncio
+
+from app.streamResponse import UpstreamStream
+
+
+class Upstream:
+    """假的上游生成器，记录有没有开始和关闭"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.started = False
+        self.closed = False
+
+    async def gen(self):
+        self.started = True
+        try:
+            for chunk in self.chunks:
+                await asyncio.sleep(0)
+                yield chunk
+        finally:
+            self.closed = True
+
+
+def serve(stream, receive_messages):
+    """用 ASGI 的方式执行响应，返回发送的消息"""
+    sent = []
+
+    async def receive():
+        if receive_messages:
+            return receive_messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        await asyncio.sleep(0.01)  # 客户端读得慢，断开的消息先到
+        sent.append(message)
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    asyncio.run(stream.response(media_type="text/event-stream")(scope, receive, send))
+    return sent
+
+
+def test_disconnect_before_first_body_chunk_still_finishes():
+    upstream = Upstream([b"data: 1\n\n", b"data: 2\n\n"])
+    finished = []
+    stream = UpstreamStream(upstream.gen(), lambda *args: finished.append(args))
+    sent = serve(stream, [{"type": "http.disconnect"}])
+    assert not any(m.get("body") for m in sent)
+    assert finished == [("499", "客户端断开连接")]
+    assert not upstream.started and stream.genData.ag_frame is None  # 上游生成器已经关闭
+
+
+def test_complete_stream_finishes_once():
+    upstream = Upstream([b"data: 1\n\n", b"data: 2\n\n"])
+    finished = []
+    stream = UpstreamStream(upstream.gen(), lambda *args: finished.append(args))
+    sent = serve(stream, [])
+    assert b"".join(m.get("body", b"") for m in sent) == b"data: 1\n\ndata: 2\n\n"
+    assert finished == [("200", "")]
+    assert upstream.closed
+
+
+def test_upstream_error_is_recorded():
+    async def broken():
+        yield b"data: 1\n\n"
+        raise ValueError("boom")
+
+    finished = []
+    stream = UpstreamStream(broken(), lambda *args: finished.append(args))
+
+    async def consume():
+        async for _ in stream:
+            pass
+
+    try:
+        asyncio.run(consume())
+    except ValueError:
+        pass
+    asyncio.run(stream.close())
+    assert finished == [("500", "boom")]
@@ -0,0 +1,128 @@
+import asyncio
+
+from app.provider.tokenCounter import StreamCounter, TokenCache, count_messages, get_tokenizer
+
+
+def test_tokenizer_is_selected_by_model():
+    assert get_tokenizer("gpt-4o-mini").name == "o200k"
+    assert get_tokenizer("gpt-4-turbo").name == "cl100k"
+    assert get_tokenizer("@cf/qwen/qwen1.5-14b-chat-awq").name == "cjk"
+    assert get_tokenizer("@cf/meta/llama-3-8b-instruct").name == "llama3"
+    assert get_tokenizer("command-r-plus-08-2024").name == "cohere"
+    assert get_tokenizer("unknown-model").name == "default"
+
+
+def test_estimate_counts_cjk_per_character():
+    tokenizer = get_tokenizer("gpt-4")
+    if tokenizer.encoder() is not None:
+        return  # 装了 tiktoken 时是精确计数
+    assert tokenizer.count("Hello world, how are you today?") == 8
+    assert tokenizer.count("请用三句话描述春天。") == 10
+    assert tokenizer.count("") == 0
+
+
+def test_repeated_system_prompt_is_counted_once(monkeypatch):
+    cache = TokenCache()
+    monkeypatch.setattr("app.provider.tokenCounter.token_cache", cache)
+    system = {"role": "system", "content": "你是一个有用的助手。" * 50}
+    history = [system, {"role": "user", "content": "hi"}]
+    first = count_messages(history, "gpt-4o")
+    assert cache.misses == 1 and cache.hits == 0
+
+    history += [{"role": "assistant", "content": "hello"}, {"role": "user", "content": "again"}]
+    second = count_messages(history, "gpt-4o")
+    assert cache.misses == 1 and cache.hits == 1
+    assert second == first + 2 * 3 + get_tokenizer("gpt-4o").count("hello") + get_tokenizer("gpt-4o").count("again")
+
+
+def test_stream_count_matches_whole_text():
+    words = ["你好", "，", "world", ' "quote"', "\n", "def f(x):", " return", " x", "。", "😀"] * 50
+    tokenizer = get_tokenizer("gpt-4o")
+    counter = StreamCounter(tokenizer)
+    for word in words:
+        counter.feed(word)
+    assert counter.total == tokenizer.count("".join(words))
+
+
+def test_missing_usage_is_filled_locally():
+    from app.provider.merlin.merlinProvider import merlinSSEHandler
+
+    handler = merlinSSEHandler("id", "my-model")
+    handler.usage.set_request({"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "你是什么模型"}]})
+    for text in ["我是", " GPT", "-4o", " mini"]:
+        handler.handle_SSE_data_line('data: {"status":"success","data":{"content":"%s"}}' % text)
+    stats = handler.get_stats()
+    assert stats["prompt_tokens"] == count_messages([{"role": "user", "content": "你是什么模型"}], "gpt-4o-mini")
+    assert stats["completion_tokens"] == get_tokenizer("gpt-4o").count("我是 GPT-4o mini")
+    assert stats["total_tokens"] == stats["prompt_tokens"] + stats["completion_tokens"]
+    assert handler.generate_response()["usage"]["total_tokens"] == stats["total_tokens"]
+
+
+def test_upstream_usage_is_kept():
+    from app.provider.cohere.cohereProvider import cohereSSEHandler
+
+    handler = cohereSSEHandler("id", "command-r")
+    handler.usage.set_request({"messages": [{"role": "user", "content": "hi"}]})
+    handler.handle_SSE_data_line("hello")
+    handler.prompt_tokens, handler.completion_tokens, handler.total_tokens = 7, 1, 8
+    stats = handler.get_stats()
+    assert (stats["prompt_tokens"], stats["completion_tokens"], stats["total_tokens"]) == (7, 1, 8)
+
+
+def test_injected_usage_chunk_is_not_forwarded():
+    from app.provider.openaiSSEHandler import openaiSSEHandler
+
+    content = b'data: {"id":"x","model":"gpt-4o","choices":[{"index":0,"delta":{"content":"[]"}}],"usage":null}\n\n'
+    usage = (b'data: {"id":"x","model":"gpt-4o","choices":[],"usage":{"prompt_tokens":3,"completion_tokens":1,'
+             b'"total_tokens":4}}\n\n')
+    handler = openaiSSEHandler("id", "gpt-4o")
+    handler.hide_usage = True
+    assert handler.handle_SSE_raw(content) == content
+    assert handler.handle_SSE_raw(usage) == b""
+    assert handler.handle_SSE_raw(usage + b"data: [DONE]\n\n") == b"data: [DONE]\n\n"
+    assert handler.get_stats()["total_tokens"] == 4
+
+    # 客户端自己要求的 usage 照常转发
+    handler = openaiSSEHandler("id", "gpt-4o")
+    assert handler.handle_SSE_raw(usage) == usage
+
+    # 关闭直接转发时逐行解析也不转发
+    handler = openaiSSEHandler("id", "gpt-4o")
+    handler.hide_usage = True
+    assert handler.handle_SSE_data_line(content.decode().strip())
+    assert handler.handle_SSE_data_line(usage.decode().strip()) is None
+    assert handler.get_stats()["total_tokens"] == 4
+
+
+def test_include_usage_is_added_to_stream_requests():
+    from app.provider.openai.openaiProvider import openaiProvider
+
+    sent = []
+
+    async def passthrough(request, pushdata, ctx):
+        sent.append((pushdata["body"], ctx.DataHeadler.hide_usage))
+        yield True
+
+    async def run(request, include_usage=True):
+        provider = openaiProvider("key", "http://127.0.0.1:1/v1")
+        if include_usage is not None:
+            provider.setIncludeUsage(include_usage)
+        provider.chat2api_passthrough = passthrough
+        async for _ in provider.chat2api(request, "gpt-4o", "id"):
+            pass
+
+    messages = [{"role": "user", "content": "hi"}]
+    asyncio.run(run({"model": "gpt-4o", "messages": messages, "stream": True}))
+    assert sent[-1] == ({"model": "gpt-4o", "messages": messages, "stream": True,
+                        "stream_options": {"include_usage": True}}, True)
+
+    options = {"include_usage": False}
+    asyncio.run(run({"model": "gpt-4o", "messages": messages, "stream": True, "stream_options": options}))
+    assert sent[-1][0]["stream_options"] is options and not sent[-1][1]
+
+    asyncio.run(run({"model": "gpt-4o", "messages": messages, "stream": True}, include_usage=False))
+    assert "stream_options" not in sent[-1][0]
+
+    # 默认不加，只有确认支持的渠道才开启
+    asyncio.run(run({"model": "gpt-4o", "messages": messages, "stream": True}, include_usage=None))
+    assert "stream_options" not in sent[-1][0] and not sent[-1][1]